@@ -0,0 +1,396 @@
+import argparse
+import itertools
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+MODELS = ["Quest", "R'nessa", "March / Micra", "Gloria", "Avenir", "Pulsar", "Cedric", "Townstar",
+          "Bluebird Sylphy", "Xterra", "Cima", "Almera", "Murano", "Frontier", "Sentra", "Altima"]
+COLORS = ["Green", "Red", "Purple", "Yellow", "Blue", "Silver", "Black", "Orange", "White", "Gray",
+          "Mauv", "Fuscia", "Teal", "Khaki"]
+CONDITIONS = ["bad", "very bad", "old", "very good", "new", "good"]
+GENDERS = ["Male", "Female", "Genderfluid", "Polygender", "Non-binary"]
+
+
+def synthetic_rows(count, seed=1978, empty_rate=0.085):
+    """Генерирует документы в формате nissan-dataset.csv (около 8.5% пустых значений, как в исходных данных)"""
+    rnd = random.Random(seed)
+
+    def maybe(value):
+        return None if rnd.random() < empty_rate else value
+
+    for i in range(1, count + 1):
+        yield {
+            "id": i,
+            "full_name": maybe(f"Name{rnd.randrange(10 ** 6)} Surname{rnd.randrange(10 ** 6)}"),
+            "age": maybe(rnd.randint(18, 69)),
+            "gender": maybe(rnd.choice(GENDERS)),
+            "model": maybe(rnd.choice(MODELS)),
+            "color": maybe(rnd.choice(COLORS)),
+            "performance": maybe(rnd.randint(0, 399)),
+            "km": maybe(rnd.randint(800, 999999)),
+            "condition": maybe(rnd.choice(CONDITIONS)),
+            "price": maybe(round(rnd.uniform(5000, 50000), 2)) if rnd.random() > 0.01 else float("nan"),
+        }
+
+
+def current_rss_bytes():
+    """Текущий RSS процесса (Linux /proc), иначе пиковый RSS из getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """Фоновый замер RSS: пик относительно значения на старте"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+    @property
+    def peak_delta_mb(self):
+        return (self.peak - self.baseline) / (1024 * 1024)
+
+
+# Пачки, на которых схема по первой пачке ломалась: пустая в начале колонка, целые, затем дробные и "None";
+# id, mixed и dirty - с известными типами (как column_types схемы), empty_first и price - по первой пачке
+PARQUET_CHECK_BATCHES = [
+    [{"id": 1, "empty_first": None, "price": 10, "mixed": 5, "dirty": 20}],
+    [{"id": 2, "empty_first": 3, "price": 10.5, "mixed": "abc", "dirty": "None"}],
+    [{"id": 3, "empty_first": "x", "price": None, "mixed": [1, 2], "dirty": 31.0}],
+]
+PARQUET_CHECK_EXPECTED = {
+    "id": [1, 2, 3],
+    "empty_first": [None, "3", "x"],
+    "price": [10.0, 10.5, None],
+    "mixed": ["5", "abc", "[1, 2]"],
+    "dirty": [20, None, 31],
+}
+
+
+def check_parquet_types():
+    """Пишет пачки со смешанными и пустыми в начале колонками и сверяет прочитанное; SystemExit при расхождении"""
+    import pyarrow.parquet as pq
+
+    from export import open_writer, write_batches
+
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        writer, _ = open_writer(path, "parquet", column_types={"id": "int64", "mixed": "object", "dirty": "int"})
+        for batch in PARQUET_CHECK_BATCHES:
+            write_batches(batch, writer)
+        writer.close()
+        result = pq.read_table(path).to_pydict()
+    finally:
+        os.remove(path)
+    if result != PARQUET_CHECK_EXPECTED:
+        raise SystemExit(f"Parquet: прочитано {result}, ожидалось {PARQUET_CHECK_EXPECTED}")
+    print("parquet  типы колонок: пустые в первой пачке и смешанные колонки записываются")
+
+
+def bench_export(args):
+    """Пропускная способность и память потокового экспорта"""
+    from export import export_query, open_writer, write_batches
+
+    formats = args.formats.split(",")
+    print(f"Экспорт {args.rows:,} строк, пачка {args.batch_size:,}")
+    if "parquet" in formats:
+        try:
+            check_parquet_types()
+        except ImportError:
+            print("parquet  проверка типов пропущена: нет pyarrow")
+
+    for fmt in formats:
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+        os.close(fd)
+        try:
+            with RssSampler() as sampler:
+                start = time.perf_counter()
+                if args.mongo:
+                    from pymongo import MongoClient
+                    client = MongoClient(args.mongo)
+                    collection = client[args.db][args.collection]
+                    written = export_query(collection, {}, path, fmt=fmt, batch_size=args.batch_size)
+                    client.close()
+                else:
+                    writer, out = open_writer(path, fmt)
+                    written = write_batches(synthetic_rows(args.rows), writer, args.batch_size)
+                    writer.close()
+                    if out is not None:
+                        out.close()
+                elapsed = time.perf_counter() - start
+        except RuntimeError as e:
+            print(f"{fmt:<8} пропущен: {e}")
+            continue
+        finally:
+            size_mb = os.path.getsize(path) / (1024 * 1024) if os.path.exists(path) else 0
+            if os.path.exists(path):
+                os.remove(path)
+
+        print(f"{fmt:<8} {written:>12,} строк  {elapsed:8.2f} с  {written / elapsed:>12,.0f} строк/с  "
+              f"файл {size_mb:8.1f} МБ  пик RSS +{sampler.peak_delta_mb:.1f} МБ")
+
+
+STARTUP_PROBE = """
+import json, os, sys, time
+sys.path.insert(0, os.getcwd())
+start = time.perf_counter()
+import main
+result = {"import_ms": (time.perf_counter() - start) * 1000,
+          "heavy_modules": [name for name in ("pandas", "numpy", "pymongo") if name in sys.modules]}
+if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+    main.EnhancedNissanGUI.start_backend = lambda self: None
+    app = main.EnhancedNissanGUI()
+    app.root.update()
+    result["first_frame_ms"] = (time.perf_counter() - start) * 1000
+    app.root.destroy()
+print(json.dumps(result))
+"""
+
+
+def bench_startup(args):
+    """Время до первого кадра: импорт main и построение окна без подключения к базе"""
+    import json
+
+    results = []
+    for _ in range(args.runs):
+        # Каждый запуск - в отдельном процессе, чтобы импорты не кэшировались
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    import_ms = sorted(result["import_ms"] for result in results)[len(results) // 2]
+    print(f"Импорт main: медиана {import_ms:.0f} мс за {args.runs} запусков")
+
+    frames = sorted(result["first_frame_ms"] for result in results if "first_frame_ms" in result)
+    if frames:
+        print(f"Первый кадр окна: медиана {frames[len(frames) // 2]:.0f} мс")
+    else:
+        print("Первый кадр окна: пропущен (нет дисплея)")
+
+    heavy = sorted({name for result in results for name in result["heavy_modules"]})
+    if heavy:
+        print(f"При запуске загружены тяжелые модули: {', '.join(heavy)}")
+
+    if heavy or (args.max_import_ms and import_ms > args.max_import_ms):
+        sys.exit(1)
+
+
+def legacy_render(tree, rows):
+    """Прежний способ показа страницы: удалить все строки, вставить по одной, теги отдельным вызовом"""
+    for item in tree.get_children():
+        tree.delete(item)
+    for row_idx, values in enumerate(rows):
+        item = tree.insert("", "end", iid=str(row_idx), values=values)
+        tree.item(item, tags=('even_row',) if row_idx % 2 == 0 else ('odd_row',))
+    tree.tag_configure('even_row', background='#2b2b2b')
+    tree.tag_configure('odd_row', background='#252525')
+
+
+def bench_render(args):
+    """Время показа страниц в Treeview и самая долгая блокировка окна: прежний способ и TreeRenderer"""
+    import tkinter as tk
+    from tkinter import ttk
+
+    from table_renderer import TreeRenderer
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Бенчмарк пропущен (нет дисплея): {e}")
+        return
+    root.geometry("1600x900")
+
+    source = synthetic_rows(args.rows * args.pages)
+    columns = ["id", "full_name", "age", "gender", "model", "color", "performance", "km", "condition", "price"]
+    pages = []
+    for _ in range(args.pages):
+        pages.append([["[ПУСТО]" if row[col] is None else str(row[col]) for col in columns]
+                      for row in itertools.islice(source, args.rows)])
+    # Последняя страница повторяет предыдущую: обновление без изменений
+    pages.append(pages[-1])
+
+    def make_tree():
+        tree = ttk.Treeview(root, columns=columns, show="headings", height=25)
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=140)
+        tree.pack(fill="both", expand=True)
+        root.update()
+        return tree
+
+    print(f"Страниц: {len(pages)} по {args.rows:,} строк, бюджет порции {args.frame_budget_ms} мс")
+
+    tree = make_tree()
+    timings = []
+    for rows in pages:
+        start = time.perf_counter()
+        legacy_render(tree, rows)
+        root.update()
+        timings.append((time.perf_counter() - start) * 1000)
+    tree.destroy()
+    print(f"{'прежний':<10} страница: медиана {sorted(timings)[len(timings) // 2]:7.1f} мс  "
+          f"блокировка окна до {max(timings):7.1f} мс")
+
+    tree = make_tree()
+    renderer = TreeRenderer(tree, frame_budget_ms=args.frame_budget_ms)
+    timings, slices = [], []
+    for rows in pages:
+        done = []
+        start = time.perf_counter()
+        renderer.render(columns, rows, on_done=lambda: done.append(True))
+        while not done:
+            root.update()
+        timings.append((time.perf_counter() - start) * 1000)
+        slices.append(renderer.max_slice_ms)
+    print(f"{'порциями':<10} страница: медиана {sorted(timings)[len(timings) // 2]:7.1f} мс  "
+          f"блокировка окна до {max(slices):7.1f} мс  без изменений {timings[-1]:.1f} мс")
+    root.destroy()
+
+
+def legacy_stats(rows):
+    """Прежний способ: все документы списком и DataFrame, статистика по колонкам DataFrame"""
+    import pandas as pd
+    from distributions import column_distribution
+
+    records = list(rows)
+    df = pd.DataFrame(records)
+    distributions = {col: column_distribution(df[col].to_numpy()) for col in df.columns}
+    return {col: int(df[col].notna().sum()) for col in df.columns}, distributions
+
+
+def bench_stats(args):
+    """Память потоковой статистики (streaming_stats): пик не должен расти с числом документов"""
+    import tracemalloc
+
+    from streaming_stats import StreamingStats
+
+    client = None
+    if args.mongo:
+        from pymongo import MongoClient
+        from shadow_fields import document_projection
+
+        client = MongoClient(args.mongo)
+        source = client[args.db][args.collection].find({}, document_projection(), batch_size=args.batch_size)
+    else:
+        source = synthetic_rows(args.rows)
+
+    report_every = max(args.batch_size, (args.rows // 10) // args.batch_size * args.batch_size)
+    if args.tracemalloc:
+        tracemalloc.start()
+    stats = StreamingStats()
+    peaks = []
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        while True:
+            batch = list(itertools.islice(source, args.batch_size))
+            if not batch:
+                break
+            stats.update(batch)
+            if stats.rows % report_every == 0:
+                traced = ""
+                if args.tracemalloc:
+                    traced = f"  tracemalloc пик {tracemalloc.get_traced_memory()[1] / 2 ** 20:7.1f} МБ"
+                peaks.append(sampler.peak_delta_mb)
+                print(f"{'потоковый':<10} {stats.rows:>12,} документов  {time.perf_counter() - start:8.2f} с  "
+                      f"пик RSS +{sampler.peak_delta_mb:.1f} МБ{traced}")
+        stats.distributions()
+        elapsed = time.perf_counter() - start
+    if args.tracemalloc:
+        tracemalloc.stop()
+    if client is not None:
+        client.close()
+
+    print(f"Итого {stats.rows:,} документов за {elapsed:.2f} с ({stats.rows / elapsed:,.0f} док/с), "
+          f"пик RSS +{sampler.peak_delta_mb:.1f} МБ")
+    # Прежний способ - после потокового: освобожденная им память осталась бы в RSS и скрыла бы пик
+    if args.legacy:
+        with RssSampler() as legacy_sampler:
+            start = time.perf_counter()
+            legacy_stats(synthetic_rows(args.legacy))
+            legacy_elapsed = time.perf_counter() - start
+        print(f"{'прежний':<10} {args.legacy:>12,} документов  {legacy_elapsed:8.2f} с  "
+              f"пик RSS +{legacy_sampler.peak_delta_mb:.1f} МБ")
+
+    # Потолок держится, если после первой десятой части пик почти не растет
+    if peaks and sampler.peak_delta_mb > max(peaks[0] * 1.5, peaks[0] + 16):
+        print(f"Пик памяти растет с числом документов: {peaks[0]:.1f} -> {sampler.peak_delta_mb:.1f} МБ")
+        sys.exit(1)
+    if args.max_mb and sampler.peak_delta_mb > args.max_mb:
+        print(f"Пик памяти больше {args.max_mb} МБ")
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки Nissan Vehicles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Потоковый экспорт в CSV/JSONL/Parquet")
+    export_parser.add_argument("--rows", type=int, default=2_000_000)
+    export_parser.add_argument("--batch-size", type=int, default=5000)
+    export_parser.add_argument("--formats", default="csv,jsonl,parquet")
+    export_parser.add_argument("--mongo", help="URI MongoDB: выгружать реальную коллекцию вместо синтетики")
+    export_parser.add_argument("--db", default="nissan")
+    export_parser.add_argument("--collection", default="vehicles")
+    export_parser.set_defaults(func=bench_export)
+
+    startup_parser = subparsers.add_parser("startup", help="Время холодного старта окна")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--max-import-ms", type=float, default=0,
+                                help="Завершиться с ошибкой, если медиана импорта дольше (0 - не проверять)")
+    startup_parser.set_defaults(func=bench_startup)
+
+    render_parser = subparsers.add_parser("render", help="Показ страниц в таблице окна")
+    render_parser.add_argument("--rows", type=int, default=1000, help="Строк на странице")
+    render_parser.add_argument("--pages", type=int, default=10)
+    render_parser.add_argument("--frame-budget-ms", type=float, default=8)
+    render_parser.set_defaults(func=bench_render)
+
+    stats_parser = subparsers.add_parser("stats", help="Память потоковой статистики по колонкам")
+    stats_parser.add_argument("--rows", type=int, default=10_000_000)
+    stats_parser.add_argument("--batch-size", type=int, default=10_000)
+    stats_parser.add_argument("--legacy", type=int, default=0,
+                              help="Сначала замерить прежний способ (список и DataFrame) на стольких документах")
+    stats_parser.add_argument("--tracemalloc", action="store_true", help="Пик выделений Python (медленнее в 2-3 раза)")
+    stats_parser.add_argument("--max-mb", type=float, default=0,
+                              help="Завершиться с ошибкой, если пик RSS больше (0 - не проверять)")
+    stats_parser.add_argument("--mongo", help="URI MongoDB: читать реальную коллекцию вместо синтетики")
+    stats_parser.add_argument("--db", default="nissan")
+    stats_parser.add_argument("--collection", default="vehicles")
+    stats_parser.set_defaults(func=bench_stats)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import math
+import numbers
+
+
+EMPTY = "[ПУСТО]"
+ERROR = "[ОШИБКА]"
+LIST_PREVIEW = 5
+MAX_CACHED_VALUES = 10000
+
+# Типы значений, при которых колонка форматируется быстрым путем своего вида
+_INT_TYPES = {int, type(None)}
+_FLOAT_TYPES = {float, type(None)}
+_TEXT_TYPES = {str, type(None)}
+
+
+def format_value(value):
+    """Форматирование одного значения любого типа (для колонок без известного вида)"""
+    if value is None:
+        return EMPTY
+
+    # Проверяем на NaN (не число)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return EMPTY
+        return f"{value:.2f}"
+
+    if isinstance(value, (int, numbers.Integral)):
+        return str(value)
+
+    # Для списков показываем первые значения (полный размер - в отдельной колонке агрегации)
+    if isinstance(value, list):
+        preview = ", ".join(EMPTY if item is None else str(item) for item in value[:LIST_PREVIEW])
+        return f"{preview}, …" if len(value) > LIST_PREVIEW else preview
+
+    if isinstance(value, dict):
+        return "{...}"
+
+    return str(value)
+
+
+def kind_from_dtype(dtype, integer=False):
+    """Вид колонки по строке dtype (как в column_types); целые с пропусками хранятся как float64"""
+    dtype = str(dtype)
+    if dtype.lower().startswith(("int", "uint")) or (integer and dtype.startswith("float")):
+        return "int"
+    if dtype.lower().startswith("float"):
+        return "float"
+    return "text" if dtype in ("object", "str", "string") else "object"
+
+
+def format_int_column(values):
+    """Целые колонки: str без цепочки проверок на каждое значение; None - в колонке есть другие типы"""
+    if not set(map(type, values)) <= _INT_TYPES:
+        return None
+    return [EMPTY if value is None else str(value) for value in values]
+
+
+def format_float_column(values):
+    """Дробные колонки: два знака после запятой, NaN и None - пусто; None - в колонке есть другие типы"""
+    if not set(map(type, values)) <= _FLOAT_TYPES:
+        return None
+    return [EMPTY if value is None or value != value else f"{value:.2f}" for value in values]
+
+
+def format_text_column(values):
+    if not set(map(type, values)) <= _TEXT_TYPES:
+        return None
+    return [EMPTY if value is None else value for value in values]
+
+
+class ObjectFormatter:
+    """Форматирование текстовых и смешанных колонок: строки показываются как есть,
+    остальные хешируемые значения форматируются один раз и берутся из кэша"""
+
+    def __init__(self):
+        self.cache = {}
+
+    def __call__(self, values):
+        if len(self.cache) > MAX_CACHED_VALUES:
+            self.cache.clear()
+        cache = self.cache
+        result = []
+        for value in values:
+            if value.__class__ is str:
+                result.append(value)
+                continue
+            # Ключ с типом: 1, 1.0 и True равны как ключи словаря, но показываются по-разному
+            key = (value.__class__, value)
+            try:
+                text = cache.get(key)
+            except TypeError:  # Списки и словари не хешируются
+                result.append(format_value(value))
+                continue
+            if text is None:
+                text = cache[key] = format_value(value)
+            result.append(text)
+        return result
+
+
+COLUMN_FORMATTERS = {"int": format_int_column, "float": format_float_column, "text": format_text_column}
+
+
+class ColumnFormatter:
+    """Форматирует страницу по колонкам сразу, вид колонки берется из схемы (column_kinds).
+
+    Типы значений колонки проверяются одним проходом, и вся колонка форматируется циклом своего вида.
+    Если в колонке встречаются другие типы (например, строка в числовой колонке), значения
+    форматируются по одному с кэшем; ошибки сообщаются один раз на колонку.
+    """
+
+    def __init__(self, kinds=None):
+        self.kinds = dict(kinds or {})
+        self._object_formatters = {}
+
+    def set_kinds(self, kinds):
+        self.kinds = dict(kinds or {})
+        self._object_formatters.clear()
+
+    def format_column(self, col, values):
+        fast = COLUMN_FORMATTERS.get(self.kinds.get(col))
+        if fast is not None:
+            formatted = fast(values)
+            if formatted is not None:
+                return formatted
+
+        formatter = self._object_formatters.get(col)
+        if formatter is None:
+            formatter = self._object_formatters[col] = ObjectFormatter()
+        try:
+            return formatter(values)
+        except Exception as e:
+            print(f"Ошибка форматирования колонки {col}: {e}")
+            return [self._safe_format(value) for value in values]
+
+    @staticmethod
+    def _safe_format(value):
+        try:
+            return format_value(value)
+        except Exception:
+            return ERROR
+
+    def format_rows(self, rows, columns):
+        """Кортежи отформатированных значений для вставки в таблицу"""
+        formatted = [self.format_column(col, [row.get(col, "") for row in rows]) for col in columns]
+        return list(zip(*formatted))
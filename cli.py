@@ -0,0 +1,252 @@
+import argparse
+import os
+import sys
+
+from pymongo import MongoClient
+
+from query_builder import (QueryBuilder, NUMERIC_FIELDS, OPERATORS, AGGREGATION_FUNCTIONS, group_filters,
+                           build_group_pipeline, group_result_row, has_approximate_metrics)
+from export import (CsvExportWriter, JsonlExportWriter, EXPORT_FORMATS, open_writer,
+                    write_batches)
+from fuzzy import FuzzyIndexes
+from query_log import SlowQueryLog
+from query_timeouts import limit_cursor, progressive_count, time_limit
+from shadow_fields import document_projection, shadow_columns
+from sorting import with_tiebreaker
+from sketches import SketchManager, approximate_group_rows, sort_rows
+from type_registry import TypeRegistry, overrides_from_env
+from validation import COLUMN_TYPES, is_validated
+
+
+DEFAULT_URI = "mongodb://localhost:27017"
+BATCH_SIZE = 1000
+STREAM_WRITERS = {"csv": CsvExportWriter, "jsonl": JsonlExportWriter}
+
+
+class FilterAction(argparse.Action):
+    """Собирает условия --filter/--or/--not в общий список с сохранением порядка"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        col, operator, value = values
+        if operator not in OPERATORS:
+            parser.error(f"Неизвестный оператор '{operator}'. Доступные: {', '.join(OPERATORS)}")
+        filters = getattr(namespace, self.dest, None) or []
+        filters.append((self.const, col, operator, value))
+        setattr(namespace, self.dest, filters)
+
+
+def parse_sort(sort_args):
+    """Преобразует ['price:desc', 'km'] в спецификацию сортировки pymongo"""
+    sort_spec = []
+    for item in sort_args or []:
+        col, _, direction = item.partition(":")
+        sort_spec.append((col, -1 if direction.lower() in ("desc", "-1") else 1))
+    return sort_spec
+
+
+def connect(args):
+    client = MongoClient(args.uri)
+    return client, client[args.db][args.collection]
+
+
+def make_query_builder(collection, args):
+    """Создает построитель запросов; колонки для глобального поиска берутся из первого документа"""
+    def on_regex_error(error):
+        raise SystemExit(f"Некорректное регулярное выражение: {error}")
+
+    def on_query_error(error):
+        raise SystemExit(f"Некорректное условие: {error}")
+
+    first = collection.find_one({}, document_projection()) or {}
+    validated = is_validated(collection)
+    # В проверенной коллекции типы колонок известны из метаданных импорта
+    registry = TypeRegistry.from_numeric_fields(COLUMN_TYPES if validated else NUMERIC_FIELDS, overrides_from_env())
+    return QueryBuilder(columns=list(first.keys()), on_regex_error=on_regex_error, validated=validated,
+                        registry=registry, shadow_columns=shadow_columns(collection),
+                        fuzzy=FuzzyIndexes(collection, max_time_ms=args.max_time_ms), on_query_error=on_query_error)
+
+
+def stream_cursor(cursor, query_log, operation, collection, query):
+    """Отдает документы курсора по одному и пишет время всего прохода в журнал"""
+    with query_log.track(operation, collection, query) as entry:
+        count = 0
+        for document in cursor:
+            count += 1
+            yield document
+        entry['result_size'] = count
+
+
+def write_output(rows, args, columns, column_types=None):
+    """Пишет строки в stdout или файл пачками по batch_size; column_types - типы колонок Parquet"""
+    if not args.output or args.output == "-":
+        if args.format == "parquet":
+            raise SystemExit("Формат parquet требует файл вывода (-o FILE)")
+        writer = STREAM_WRITERS[args.format](sys.stdout, columns)
+        write_batches(rows, writer, args.batch_size)
+        writer.close()
+        return
+
+    writer, out = open_writer(args.output, args.format, columns, column_types)
+    try:
+        write_batches(rows, writer, args.batch_size)
+        writer.close()
+    finally:
+        if out is not None:
+            out.close()
+
+
+def run_query(args, collection, query_log):
+    builder = make_query_builder(collection, args)
+    query = builder.build_query(group_filters(args.filters), args.search)
+
+    columns = args.columns.split(",") if args.columns else None
+    sort_spec = with_tiebreaker(parse_sort(args.sort))
+    cursor = collection.find(query, document_projection(columns), batch_size=args.batch_size,
+                             allow_disk_use=bool(sort_spec))
+    if sort_spec:
+        cursor = cursor.sort(sort_spec)
+    if args.skip:
+        cursor = cursor.skip(args.skip)
+    if args.limit:
+        cursor = cursor.limit(args.limit)
+    cursor = limit_cursor(cursor, args.max_time_ms)
+
+    rows = stream_cursor(cursor, query_log, "find", collection, query)
+    return rows, columns
+
+
+def run_aggregate(args, collection, query_log):
+    builder = make_query_builder(collection, args)
+    query = builder.build_query(group_filters(args.filters), args.search)
+
+    sort_column, sort_direction = None, 1
+    sort_spec = parse_sort(args.sort)
+    if sort_spec:
+        sort_column, sort_direction = sort_spec[0]
+
+    group_by = [col.strip() for col in args.group_by.split(",") if col.strip()]
+    metrics = parse_metrics(args)
+
+    if has_approximate_metrics(metrics):
+        # Приближенные функции: скетчи партиций, если подходят к фильтрам, иначе один проход по документам
+        try:
+            rows, _ = approximate_group_rows(collection, query, group_by, metrics, SketchManager(collection),
+                                             args.array_limit or None, query_log, args.max_time_ms)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        return iter(sort_rows(rows, sort_column, sort_direction, group_by)), None
+
+    try:
+        pipeline = build_group_pipeline(query, group_by, metrics, sort_column, sort_direction,
+                                        array_limit=args.array_limit or None)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=args.batch_size,
+                                  **time_limit(args.max_time_ms))
+    records = stream_cursor(cursor, query_log, "aggregate", collection, pipeline)
+    rows = (group_result_row(record, group_by, metrics) for record in records)
+    return rows, None
+
+
+def parse_metrics(args):
+    """Собирает метрики из --func/--column и повторяемых --metric FUNC [COL]"""
+    metrics = []
+    if args.func:
+        metrics.append((args.func, args.column))
+    for values in args.metrics or []:
+        if len(values) > 2 or values[0] not in AGGREGATION_FUNCTIONS:
+            raise SystemExit(f"--metric ожидает FUNC [COL], FUNC из списка: {', '.join(AGGREGATION_FUNCTIONS)}")
+        metrics.append((values[0], values[1] if len(values) > 1 else ""))
+    if not metrics:
+        raise SystemExit("Укажите --func или хотя бы одну --metric")
+    return metrics
+
+
+def run_count(args, collection, query_log):
+    builder = make_query_builder(collection, args)
+    query = builder.build_query(group_filters(args.filters), args.search)
+    count, exact = progressive_count(collection, query, args.max_time_ms, query_log=query_log)
+    if not exact:
+        print(f"Подсчет прерван по лимиту {args.max_time_ms} мс, найдено не меньше:", file=sys.stderr)
+    print(count)
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", DEFAULT_URI))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    parser.add_argument("-f", "--filter", dest="filters", nargs=3, action=FilterAction, const="И",
+                        metavar=("COL", "OP", "VALUE"), help="Условие фильтра (объединяется через И)")
+    parser.add_argument("--or", dest="filters", nargs=3, action=FilterAction, const="ИЛИ",
+                        metavar=("COL", "OP", "VALUE"), help="Условие, объединяемое через ИЛИ с предыдущим по колонке")
+    parser.add_argument("--not", dest="filters", nargs=3, action=FilterAction, const="НЕ",
+                        metavar=("COL", "OP", "VALUE"), help="Условие, исключаемое (НЕ) из предыдущих по колонке")
+    parser.add_argument("-s", "--search", default="", help="Поиск по всем полям (текст или regex)")
+    # Выгрузка может идти долго и законно, поэтому по умолчанию без лимита (в отличие от приложения и сервиса)
+    parser.add_argument("--max-time-ms", type=int, default=0,
+                        help="Лимит времени операции на сервере, мс (0 - без лимита)")
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv",
+                        help="parquet доступен только с -o и требует pyarrow")
+    parser.add_argument("-o", "--output", default="-", help="Файл для записи (по умолчанию stdout)")
+    parser.add_argument("--sort", action="append", metavar="COL[:desc]",
+                        help="Колонка сортировки (можно несколько), ':desc' - по убыванию")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Запросы и агрегации Nissan Vehicles без графического интерфейса")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = subparsers.add_parser("query", help="Отфильтрованные записи")
+    add_common_arguments(query_parser)
+    add_output_arguments(query_parser)
+    query_parser.add_argument("--columns", help="Колонки через запятую")
+    query_parser.add_argument("--skip", type=int, default=0)
+    query_parser.add_argument("--limit", type=int, default=0)
+
+    agg_parser = subparsers.add_parser("aggregate", help="Группировка с агрегационной функцией")
+    add_common_arguments(agg_parser)
+    add_output_arguments(agg_parser)
+    agg_parser.add_argument("--group-by", required=True, help="Колонки группировки через запятую")
+    agg_parser.add_argument("--func", choices=list(AGGREGATION_FUNCTIONS))
+    agg_parser.add_argument("--column", default="")
+    agg_parser.add_argument("-m", "--metric", dest="metrics", nargs="+", action="append", metavar="FUNC [COL]",
+                            help="Дополнительная метрика (можно несколько), все считаются одним проходом")
+    agg_parser.add_argument("--array-limit", type=int, default=0,
+                            help="Обрезать массивы (все/уникальные значения) до N элементов с колонкой размера")
+
+    count_parser = subparsers.add_parser("count", help="Количество отфильтрованных записей")
+    add_common_arguments(count_parser)
+
+    args = parser.parse_args(argv)
+    query_log = SlowQueryLog.from_env()
+    client, collection = connect(args)
+
+    try:
+        if args.command == "count":
+            run_count(args, collection, query_log)
+            return
+
+        column_types = None
+        if args.command == "query":
+            rows, columns = run_query(args, collection, query_log)
+            # Типы числовых колонок гарантированы только в проверенной коллекции
+            if is_validated(collection):
+                column_types = COLUMN_TYPES
+        else:
+            rows, columns = run_aggregate(args, collection, query_log)
+
+        write_output(rows, args, columns, column_types)
+    except BrokenPipeError:
+        # Вывод обрезан (например, через head) - это не ошибка
+        sys.stderr.close()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
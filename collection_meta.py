@@ -0,0 +1,119 @@
+import threading
+import time
+
+
+DEFAULT_POLL_INTERVAL = 2.0
+# Метаданные импорта по коллекциям (validation.py, shadow_fields.py); здесь же счетчик записей на месте
+INGEST_META_COLLECTION = "ingest_meta"
+
+
+def read_ingest_meta(collection):
+    """Документ коллекции в ingest_meta: validated, shadow_columns, write_version и т.д."""
+    return collection.database[INGEST_META_COLLECTION].find_one({"_id": collection.name}) or {}
+
+
+def write_version(collection):
+    """Счетчик замен и удалений документов из ingest_meta; None - коллекция их не отмечает"""
+    return read_ingest_meta(collection).get("write_version")
+
+
+def bump_write_version(collection):
+    """Отмечает замену или удаление документов (или смену флагов ingest_meta, от которых зависят запросы):
+    по максимальному id и количеству они не видны"""
+    collection.database[INGEST_META_COLLECTION].update_one(
+        {"_id": collection.name}, {"$inc": {"write_version": 1}}, upsert=True)
+
+
+def tracks_writes(version):
+    """True, если по отметке видны и замены документов на месте, а не только вставки"""
+    return version is not None and version[2] is not None
+
+
+class CollectionMetadata:
+    """Кэш общего количества документов, сбрасываемый по отметке записи.
+
+    Отметка - максимальный id (по индексу), estimated_document_count (из метаданных коллекции)
+    и счетчик замен и удалений из ingest_meta (importer.py): все читаются без обхода документов.
+    Пока отметка не изменилась, точное количество отдается из кэша; отметка проверяется не чаще раза
+    в poll_interval секунд. Вместе с ней перечитываются флаги ingest_meta (ingest_meta()).
+    """
+
+    def __init__(self, collection, poll_interval=DEFAULT_POLL_INTERVAL, query_log=None):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.query_log = query_log
+        self._lock = threading.Lock()
+        self._count = None
+        self._watermark = None
+        self._ingest_meta = None
+        self._checked_at = 0.0
+
+    def ensure_index(self):
+        """Индекс по id: без него отметка (и догоняющие запросы по id) читают всю коллекцию"""
+        self.collection.create_index("id")
+
+    def watermark(self):
+        last = self.collection.find_one({}, {"_id": 0, "id": 1}, sort=[("id", -1)])
+        self._ingest_meta = read_ingest_meta(self.collection)
+        return ((last or {}).get("id"), self.collection.estimated_document_count(),
+                self._ingest_meta.get("write_version"))
+
+    def ingest_meta(self):
+        """Флаги ingest_meta (validated, shadow_columns), прочитанные вместе с последней отметкой записи"""
+        with self._lock:
+            if self._ingest_meta is None:
+                self._ingest_meta = read_ingest_meta(self.collection)
+            return self._ingest_meta
+
+    def total_count(self):
+        """Точное количество документов; пересчитывается, только если изменилась отметка записи"""
+        with self._lock:
+            now = time.monotonic()
+            if self._count is not None and now - self._checked_at < self.poll_interval:
+                return self._count
+
+            watermark = self.watermark()
+            self._checked_at = now
+            if self._count is None or watermark != self._watermark:
+                self._count = self._count_documents()
+                self._watermark = watermark
+            return self._count
+
+    def current_version(self):
+        """Отметка записи, проверенная не позже poll_interval назад (без подсчета документов);
+        если она изменилась, количество пересчитается при следующем total_count"""
+        with self._lock:
+            now = time.monotonic()
+            if self._watermark is None or now - self._checked_at >= self.poll_interval:
+                watermark = self.watermark()
+                self._checked_at = now
+                if watermark != self._watermark:
+                    self._count = None
+                    self._watermark = watermark
+            return self._watermark
+
+    def version(self):
+        """Последняя прочитанная отметка записи (без запроса к базе); меняется вместе с коллекцией"""
+        with self._lock:
+            return self._watermark
+
+    def note_inserted(self, inserted):
+        """Учитывает вставку, сделанную самим приложением, без пересчета коллекции"""
+        with self._lock:
+            if self._count is None:
+                return
+            self._count += inserted
+            self._watermark = self.watermark()
+            self._checked_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._count = None
+
+    def _count_documents(self):
+        if self.query_log is None:
+            return self.collection.count_documents({})
+        with self.query_log.track("count", self.collection, {}) as entry:
+            count = self.collection.count_documents({})
+            entry['result_size'] = count
+        return count
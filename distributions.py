@@ -0,0 +1,163 @@
+import math
+from collections import Counter
+
+import numpy as np
+
+from query_builder import build_column_stats_pipeline, column_stats_from_result
+
+
+HISTOGRAM_BINS = 8
+TOP_VALUES = 2
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def compact_number(value):
+    """Короткая запись числа для заголовка: 27.4k, 1.2M, 42"""
+    magnitude = abs(value)
+    if magnitude >= 1e6:
+        return f"{value / 1e6:.1f}M"
+    if magnitude >= 1e4:
+        return f"{value / 1e3:.0f}k"
+    if magnitude >= 1e3:
+        return f"{value / 1e3:.1f}k"
+    if float(value).is_integer():
+        return str(int(value))
+    return f"{value:.2f}"
+
+
+def median_from_buckets(buckets):
+    """Медиана по корзинам [(нижняя, верхняя, количество)] с линейной интерполяцией внутри корзины"""
+    total = sum(count for _, _, count in buckets)
+    if not total:
+        return None
+    half = total / 2
+    seen = 0
+    for low, high, count in buckets:
+        if count and seen + count >= half:
+            return low + (high - low) * (half - seen) / count
+        seen += count
+    return buckets[-1][1]
+
+
+def numeric_distribution(values, bins=HISTOGRAM_BINS):
+    """min/медиана/max и гистограмма равной ширины по числовому массиву (NaN отбрасываются)"""
+    array = np.asarray(values, dtype=np.float64)
+    array = array[~np.isnan(array)]
+    if not array.size:
+        return None
+    counts, edges = np.histogram(array, bins=bins)
+    return {
+        "kind": "numeric",
+        "min": float(array.min()),
+        "median": float(np.median(array)),
+        "max": float(array.max()),
+        "buckets": [[float(edges[i]), float(edges[i + 1]), int(count)] for i, count in enumerate(counts)],
+    }
+
+
+def categorical_distribution(values, top=TOP_VALUES):
+    """Самые частые непустые значения и их доля среди непустых"""
+    counter = Counter(value for value in (str(item).strip() for item in values
+                                          if item is not None and not (isinstance(item, float) and math.isnan(item)))
+                      if value)
+    non_empty = sum(counter.values())
+    if not non_empty:
+        return None
+    return {
+        "kind": "categorical",
+        "distinct": len(counter),
+        "non_empty": non_empty,
+        "top": [[value, count] for value, count in counter.most_common(top)],
+    }
+
+
+def column_distribution(values):
+    """Гистограмма для числового массива, частые значения - для остальных"""
+    array = np.asarray(values)
+    if array.dtype.kind in "iuf":
+        return numeric_distribution(array)
+    return categorical_distribution(array)
+
+
+def snapshot_distributions(snapshot):
+    """Распределения по колонкам снимка: числовые массивы читаются через mmap, строковые - без пропусков"""
+    distributions = {}
+    for col in snapshot.columns:
+        array = snapshot.arrays[col]
+        mask = snapshot.masks.get(col)
+        if mask is not None:
+            distributions[col] = categorical_distribution(array[~np.asarray(mask)].tolist())
+        else:
+            distributions[col] = column_distribution(array)
+    return distributions
+
+
+def build_distribution_pipeline(match_query, columns, bins=HISTOGRAM_BINS, top=TOP_VALUES, validated=False):
+    """Один проход на сервере: статистика заполненности, $bucketAuto по числам и частые строки по каждой колонке"""
+    pipeline = build_column_stats_pipeline(match_query, columns, validated)
+    facets = {"stats": [pipeline.pop()]}
+    for i, col in enumerate(columns):
+        facets[f"n{i}"] = [{"$match": {col: {"$type": "number", "$ne": float("nan")}}},
+                           {"$bucketAuto": {"groupBy": f"${col}", "buckets": bins}}]
+        strings = {"$match": {col: {"$type": "string", "$regex": r"\S"}}}
+        facets[f"t{i}"] = [strings, {"$sortByCount": f"${col}"}, {"$limit": top}]
+        facets[f"s{i}"] = [strings, {"$group": {"_id": f"${col}"}}, {"$count": "distinct"}]
+    pipeline.append({"$facet": facets})
+    return pipeline
+
+
+def distributions_from_result(result, columns):
+    """Разбирает результат build_distribution_pipeline в (статистика, распределения)"""
+    result = result or {}
+    stats = column_stats_from_result(next(iter(result.get("stats") or []), None), columns)
+
+    distributions = {}
+    for i, col in enumerate(columns):
+        buckets = [[bucket["_id"]["min"], bucket["_id"]["max"], bucket["count"]]
+                   for bucket in result.get(f"n{i}") or []]
+        numeric_count = sum(count for _, _, count in buckets)
+        top = [[record["_id"], record["count"]] for record in result.get(f"t{i}") or []]
+        non_empty = stats[col]["non_empty"]
+
+        # Колонку считаем числовой, если чисел в ней не меньше половины непустых значений
+        if buckets and numeric_count * 2 >= non_empty:
+            distributions[col] = {"kind": "numeric", "min": buckets[0][0], "median": median_from_buckets(buckets),
+                                  "max": buckets[-1][1], "buckets": buckets}
+        elif top:
+            distinct = next(iter(result.get(f"s{i}") or []), {}).get("distinct", len(top))
+            distributions[col] = {"kind": "categorical", "distinct": distinct,
+                                  "non_empty": non_empty - numeric_count, "top": top}
+        else:
+            distributions[col] = None
+    return stats, distributions
+
+
+def sparkline(buckets):
+    """Гистограмма одной строкой: высота символа - плотность значений в корзине"""
+    densities = []
+    for low, high, count in buckets:
+        width = high - low
+        densities.append(count / width if width > 0 else count)
+    peak = max(densities) if densities else 0
+    if not peak:
+        return ""
+    return "".join(" " if not count else SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(density / peak * len(SPARK_CHARS)))]
+                   for density, (_, _, count) in zip(densities, buckets))
+
+
+def format_distribution(distribution, max_value_len=8):
+    """Строки для заголовка таблицы: гистограмма и min|медиана|max или частые значения с долями"""
+    if not distribution:
+        return ""
+    if distribution["kind"] == "numeric":
+        return (f"{sparkline(distribution['buckets'])}\n"
+                f"{compact_number(distribution['min'])} | {compact_number(distribution['median'])} | "
+                f"{compact_number(distribution['max'])}")
+
+    parts = []
+    for value, count in distribution["top"]:
+        value = str(value)
+        if len(value) > max_value_len:
+            value = value[:max_value_len - 1] + "…"
+        parts.append(f"{value} {count / distribution['non_empty'] * 100:.0f}%")
+    return f"{distribution['distinct']:,} знач.\n" + " · ".join(parts)
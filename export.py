@@ -0,0 +1,283 @@
+import csv
+import json
+import math
+import os
+
+from shadow_fields import document_projection
+
+
+EXPORT_FORMATS = ["csv", "jsonl", "parquet"]
+DEFAULT_BATCH_SIZE = 5000
+# Строки-пропуски непроверенных коллекций (как validation.NULL_VALUES): в числовых колонках Parquet - null
+NULL_STRINGS = {"", "none", "null", "nan"}
+
+
+class ExportCancelled(Exception):
+    """Экспорт остановлен пользователем"""
+
+
+def clean_value(value, for_csv):
+    """Готовит значение к записи: NaN становится пустым, вложенные значения - JSON"""
+    if isinstance(value, float) and math.isnan(value):
+        return "" if for_csv else None
+    if for_csv and isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return value
+
+
+def format_from_path(path, default="csv"):
+    """Определяет формат экспорта по расширению файла"""
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension in ("jsonl", "ndjson"):
+        return "jsonl"
+    if extension in ("parquet", "pq"):
+        return "parquet"
+    if extension == "csv":
+        return "csv"
+    return default
+
+
+class CsvExportWriter:
+    """Пишет пачки строк в CSV; без списка колонок берет их из первой пачки"""
+
+    def __init__(self, out, columns=None):
+        self.out = out
+        self.columns = columns
+        self.writer = None
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        if self.writer is None:
+            self.columns = self.columns or list(rows[0].keys())
+            self.writer = csv.writer(self.out)
+            self.writer.writerow(self.columns)
+        columns = self.columns
+        self.writer.writerows([clean_value(row.get(col, ""), True) for col in columns] for row in rows)
+
+    def abort(self):
+        pass
+
+    def close(self):
+        # Пустой результат: пишем хотя бы заголовок, если колонки известны
+        if self.writer is None and self.columns:
+            csv.writer(self.out).writerow(self.columns)
+        self.out.flush()
+
+
+class JsonlExportWriter:
+    """Пишет пачки строк в JSON Lines одной операцией записи на пачку"""
+
+    def __init__(self, out, columns=None):
+        self.out = out
+        self.columns = columns
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        lines = []
+        for row in rows:
+            if self.columns:
+                row = {col: row.get(col) for col in self.columns}
+            row = {key: clean_value(value, False) for key, value in row.items()}
+            lines.append(json.dumps(row, ensure_ascii=False, default=str))
+        lines.append("")
+        self.out.write("\n".join(lines))
+
+    def abort(self):
+        pass
+
+    def close(self):
+        self.out.flush()
+
+
+def parquet_kind(dtype):
+    """Вид колонки Parquet по dtype (column_types из detect_schema, снимка или validation.COLUMN_TYPES)"""
+    dtype = str(dtype).lower()
+    if dtype.startswith(("int", "uint")):
+        return "int"
+    if dtype.startswith("float"):
+        return "float"
+    if dtype == "bool":
+        return "bool"
+    return "string"
+
+
+def infer_parquet_kind(values):
+    """Вид колонки по первой пачке: только числа - float (целые и дробные в одной колонке не конфликтуют),
+    только bool - bool, иначе (строки, смесь, одни пропуски) - строка, в которую войдет любое значение"""
+    present = [value for value in values if value is not None]
+    if not present:
+        return "string"
+    types = set(map(type, present))
+    if types == {bool}:
+        return "bool"
+    if types <= {int, float}:
+        return "float"
+    return "string"
+
+
+def parquet_values(values, kind, col):
+    """Приводит значения пачки к виду колонки; пропуски (None, NaN, "None") в числовых колонках - null"""
+    if kind == "string":
+        return [None if value is None else value if isinstance(value, str)
+                else json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (list, dict))
+                else str(value) for value in values]
+
+    result = []
+    for value in values:
+        if isinstance(value, str):
+            if value.strip().lower() in NULL_STRINGS:
+                value = None
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError(f"Колонка {col}: значение {value!r} не подходит к типу {kind}")
+        if value is None:
+            result.append(None)
+        elif kind == "bool":
+            if not isinstance(value, bool):
+                raise ValueError(f"Колонка {col}: значение {value!r} не подходит к типу bool")
+            result.append(value)
+        elif not isinstance(value, (int, float)):
+            raise ValueError(f"Колонка {col}: значение {value!r} не подходит к типу {kind}")
+        elif kind == "float":
+            result.append(float(value))
+        elif isinstance(value, float) and not value.is_integer():
+            raise ValueError(f"Колонка {col}: значение {value!r} не целое")
+        else:
+            result.append(int(value))
+    return result
+
+
+class ParquetExportWriter:
+    """Пишет пачки строк в Parquet: каждая пачка - отдельная группа строк.
+
+    Схема файла задается один раз: типы колонок берутся из column_types (известная схема коллекции),
+    для остальных колонок - по первой пачке с запасом (числа - float, смесь и пропуски - строка).
+    Каждая пачка приводится к схеме по значениям, поэтому пустая в начале колонка, целые и дробные
+    вперемешку и строки "None" не ломают запись.
+    """
+
+    def __init__(self, path, columns=None, column_types=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для экспорта в Parquet установите pyarrow: pip install pyarrow")
+
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.columns = columns
+        self.column_types = dict(column_types or {})
+        self.kinds = None
+        self.schema = None
+        self.writer = None
+
+    def arrow_type(self, kind):
+        return {"int": self.pa.int64(), "float": self.pa.float64(), "bool": self.pa.bool_()}.get(
+            kind, self.pa.string())
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        if self.columns is None:
+            self.columns = list(rows[0].keys())
+
+        data = {col: [clean_value(row.get(col), False) for row in rows] for col in self.columns}
+        if self.schema is None:
+            self.kinds = {col: parquet_kind(self.column_types[col]) if col in self.column_types
+                          else infer_parquet_kind(data[col]) for col in self.columns}
+            self.schema = self.pa.schema([(col, self.arrow_type(self.kinds[col])) for col in self.columns])
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+
+        data = {col: parquet_values(values, self.kinds[col], col) for col, values in data.items()}
+        self.writer.write_table(self.pa.table(data, schema=self.schema))
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def close(self):
+        if self.writer is None:
+            # Пустой результат: создаем файл с известными типами, остальные колонки - строковые
+            self.schema = self.pa.schema([(col, self.arrow_type(parquet_kind(self.column_types.get(col, ""))))
+                                          for col in self.columns or []])
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        self.writer.close()
+
+
+def open_writer(path, fmt, columns=None, column_types=None):
+    """Открывает файл и писатель нужного формата; возвращает (писатель, файл или None).
+
+    column_types (колонка -> dtype) задают типы колонок Parquet; CSV и JSONL их не используют.
+    """
+    if fmt == "parquet":
+        return ParquetExportWriter(path, columns, column_types), None
+    out = open(path, "w", encoding="utf-8", newline="")
+    if fmt == "jsonl":
+        return JsonlExportWriter(out, columns), out
+    return CsvExportWriter(out, columns), out
+
+
+def iter_batches(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """Разбивает поток строк на списки фиксированного размера"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_batches(rows, writer, batch_size=DEFAULT_BATCH_SIZE, progress=None, cancel_event=None):
+    """Пишет поток строк пачками; память ограничена одной пачкой"""
+    written = 0
+    for batch in iter_batches(rows, batch_size):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCancelled()
+        writer.write_batch(batch)
+        written += len(batch)
+        if progress is not None:
+            progress(written)
+    return written
+
+
+def export_query(collection, query, path, fmt=None, sort_spec=None, columns=None,
+                 batch_size=DEFAULT_BATCH_SIZE, progress=None, cancel_event=None, query_log=None,
+                 column_types=None):
+    """Потоково выгружает результат запроса в файл; при отмене или ошибке недописанный файл удаляется"""
+    fmt = fmt or format_from_path(path)
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+
+    # Большая сортировка без индекса сбрасывается на диск, а не упирается в лимит памяти сервера
+    cursor = collection.find(query, document_projection(columns), batch_size=batch_size,
+                             allow_disk_use=bool(sort_spec))
+    if sort_spec:
+        cursor = cursor.sort(sort_spec)
+
+    writer, out = open_writer(path, fmt, columns, column_types)
+    completed = False
+    try:
+        if query_log is not None:
+            with query_log.track("find", collection, query) as entry:
+                written = write_batches(cursor, writer, batch_size, progress, cancel_event)
+                entry['result_size'] = written
+        else:
+            written = write_batches(cursor, writer, batch_size, progress, cancel_event)
+        writer.close()
+        completed = True
+        return written
+    finally:
+        cursor.close()
+        if not completed:
+            writer.abort()
+        if out is not None:
+            out.close()
+        if not completed and os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,186 @@
+import argparse
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from query_timeouts import time_limit
+
+
+# Колонки с нечетким поиском по умолчанию (имена и модели с опечатками)
+FUZZY_COLUMNS = ["full_name", "model"]
+# Как в pg_trgm: доля общих триграмм от всех триграмм двух строк
+DEFAULT_THRESHOLD = 0.3
+DEFAULT_LIMIT = 20
+
+_WORDS = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """Триграммы строки: по словам в нижнем регистре, слово дополняется двумя пробелами слева и одним справа"""
+    grams = set()
+    for word in _WORDS.findall(str(text).lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Обратный индекс триграмм по различным значениям колонки.
+
+    Для каждой триграммы хранится отсортированный массив номеров значений (CSR: offsets + postings).
+    Поиск склеивает списки триграмм запроса, считает совпадения одним np.unique и выбирает
+    лучшие по сходству через argpartition - без перебора всех значений в Python.
+    """
+
+    def __init__(self, values, counts=None):
+        self.values = list(values)
+        self.counts = np.asarray(counts if counts is not None else [1] * len(self.values), dtype=np.int64)
+        self.gram_ids = {}
+        sizes = np.zeros(len(self.values), dtype=np.int32)
+        gram_column, value_column = [], []
+        for i, value in enumerate(self.values):
+            grams = trigrams(value)
+            sizes[i] = len(grams)
+            for gram in grams:
+                gram_column.append(self.gram_ids.setdefault(gram, len(self.gram_ids)))
+                value_column.append(i)
+
+        gram_column = np.asarray(gram_column, dtype=np.int32)
+        order = np.argsort(gram_column, kind="stable")  # Внутри триграммы номера значений остаются по возрастанию
+        self.postings = np.asarray(value_column, dtype=np.int32)[order]
+        self.offsets = np.searchsorted(gram_column[order], np.arange(len(self.gram_ids) + 1))
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.values)
+
+    def search(self, text, limit=DEFAULT_LIMIT, threshold=DEFAULT_THRESHOLD):
+        """[(значение, сходство, число документов)] по убыванию сходства, не больше limit"""
+        grams = trigrams(text)
+        ids = [self.gram_ids[gram] for gram in grams if gram in self.gram_ids]
+        if not ids:
+            return []
+
+        hits = np.concatenate([self.postings[self.offsets[i]:self.offsets[i + 1]] for i in ids])
+        candidates, common = np.unique(hits, return_counts=True)
+        scores = common / (len(grams) + self.sizes[candidates] - common)
+
+        keep = scores >= threshold
+        candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            candidates, scores = candidates[top], scores[top]
+        # По убыванию сходства, при равенстве - более частые значения выше
+        order = np.lexsort((-self.counts[candidates], -scores))
+        return [(self.values[i], float(scores[j]), int(self.counts[i]))
+                for j, i in zip(order, candidates[order])]
+
+
+def distinct_values(collection, col, query_log=None, max_time_ms=None):
+    """Различные строковые значения колонки с числом документов (один $group на сервере)"""
+    pipeline = [{"$match": {col: {"$ne": None}}}, {"$group": {"_id": f"${col}", "count": {"$sum": 1}}}]
+    values, counts = [], []
+    if query_log is not None:
+        with query_log.track("aggregate", collection, pipeline) as entry:
+            records = list(collection.aggregate(pipeline, allowDiskUse=True, **time_limit(max_time_ms)))
+            entry['result_size'] = len(records)
+    else:
+        records = collection.aggregate(pipeline, allowDiskUse=True, **time_limit(max_time_ms))
+    for record in records:
+        if isinstance(record["_id"], str):
+            values.append(record["_id"])
+            counts.append(record["count"])
+    return values, counts
+
+
+class FuzzyIndexes:
+    """Индексы триграмм по колонкам коллекции, строятся по требованию и привязаны к версии коллекции.
+
+    С build_on_demand search строит недостающий индекс сразу (консольная утилита, сервис);
+    приложение строит их в фоне через refresh и до его завершения ищет по предыдущим.
+    """
+
+    def __init__(self, collection, columns=None, query_log=None, build_on_demand=True, max_time_ms=None):
+        self.collection = collection
+        self.columns = list(columns if columns is not None else FUZZY_COLUMNS)
+        self.query_log = query_log
+        # Лимит на $group по различным значениям; None - NISSAN_MAX_TIME_MS
+        self.max_time_ms = max_time_ms
+        self.build_on_demand = build_on_demand
+        self.indexes = {}
+        self.version = None
+        self._lock = threading.Lock()
+
+    def supports(self, col):
+        return col in self.columns
+
+    def build(self, col):
+        values, counts = distinct_values(self.collection, col, self.query_log, self.max_time_ms)
+        return TrigramIndex(values, counts)
+
+    def index(self, col):
+        index = self.indexes.get(col)
+        if index is None:
+            with self._lock:
+                index = self.indexes.get(col)
+                if index is None:
+                    index = self.indexes[col] = self.build(col)
+        return index
+
+    def expire(self, version):
+        """Сбрасывает индексы, если коллекция изменилась с момента их построения"""
+        if version != self.version:
+            self.indexes = {}
+            self.version = version
+
+    def stale(self, version):
+        """Индексы еще не построены или построены по другой версии коллекции"""
+        return not self.indexes or version != self.version
+
+    def refresh(self, version=None):
+        """Строит индексы всех колонок и подменяет ими прежние одной операцией"""
+        self.indexes = {col: self.build(col) for col in self.columns}
+        self.version = version
+
+    def search(self, col, text, limit=DEFAULT_LIMIT, threshold=DEFAULT_THRESHOLD):
+        """Похожие значения колонки; None - колонка без индекса или индекс еще строится"""
+        if not self.supports(col):
+            return None
+        if not self.build_on_demand and col not in self.indexes:
+            return None
+        return self.index(col).search(text, limit, threshold)
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Нечеткий поиск по триграммам")
+    parser.add_argument("column", choices=FUZZY_COLUMNS)
+    parser.add_argument("text")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    indexes = FuzzyIndexes(client[args.db][args.collection], [args.column])
+
+    start = time.perf_counter()
+    index = indexes.index(args.column)
+    built = time.perf_counter()
+    matches = index.search(args.text, args.limit, args.threshold)
+    searched = time.perf_counter()
+
+    print(f"Индекс: {len(index):,} значений за {built - start:.2f} с, поиск: {(searched - built) * 1000:.2f} мс")
+    for value, score, count in matches:
+        print(f"{score:.3f}  {value}  ({count:,})")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
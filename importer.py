@@ -0,0 +1,347 @@
+import argparse
+import csv
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from collection_meta import bump_write_version
+from shadow_fields import add_shadow_fields, ensure_shadow_indexes, shadow_columns
+from validation import frame_documents, mark_validated, validate_frame
+
+
+DEFAULT_BATCH_SIZE = 5000
+RANGE_SIZE = 16 * 1024 * 1024  # Примерный размер куска файла на одну задачу
+MAX_ERROR_SAMPLES = 5
+
+
+def hashes_collection_name(collection_name):
+    """Коллекция хешей строк по id для инкрементального импорта"""
+    return f"{collection_name}_row_hashes"
+
+
+def row_hashes(frame):
+    """64-битные хеши проверенных строк пачки: совпал - запись не менялась"""
+    return [f"{digest:016x}" for digest in pd.util.hash_pandas_object(frame, index=False).tolist()]
+
+
+def split_ranges(path, range_size=RANGE_SIZE):
+    """Делит файл после заголовка на диапазоны байт, выровненные по концам строк.
+
+    Кавычки с переводами строк внутри полей не поддерживаются - в выгрузках их нет.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.readline()
+        start = f.tell()
+        ranges = []
+        while start < size:
+            f.seek(min(start + range_size, size))
+            if f.tell() < size:
+                f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_header(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return next(csv.reader(f))
+
+
+def parse_range(path, start, end, columns, batch_size=DEFAULT_BATCH_SIZE):
+    """Читает диапазон байт пачками: (DataFrame строковых полей, [(поля, причина)] строк с неверным числом полей)"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+
+    rows, bad = [], []
+    for fields in csv.reader(io.StringIO(text, newline="")):
+        if not fields:
+            continue
+        if len(fields) != len(columns):
+            bad.append((fields, f"ожидалось {len(columns)} полей, получено {len(fields)}"))
+        else:
+            rows.append(fields)
+        if len(rows) >= batch_size:
+            yield pd.DataFrame(rows, columns=columns, dtype=object), bad
+            rows, bad = [], []
+    if rows or bad:
+        yield pd.DataFrame(rows, columns=columns, dtype=object), bad
+
+
+def new_stats():
+    return {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0, "write_errors": 0,
+            "errors": [], "ids": [], "rejects": []}
+
+
+def merge_stats(total, part):
+    for key in ("rows", "inserted", "updated", "unchanged", "rejected", "write_errors"):
+        total[key] += part[key]
+    total["errors"].extend(part["errors"][:MAX_ERROR_SAMPLES - len(total["errors"])])
+    total["ids"].extend(part["ids"])
+    total["rejects"].extend(part["rejects"])
+
+
+def write_full(collection, hashes, batch):
+    """Полная загрузка: неупорядоченная вставка документов и их хешей"""
+    from pymongo.errors import BulkWriteError
+
+    errors = 0
+    for target, docs in ((collection, [doc for _, doc in batch]),
+                         (hashes, [{"_id": doc["id"], "h": digest} for digest, doc in batch])):
+        try:
+            target.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors += len(e.details.get("writeErrors", []))
+    return {"inserted": len(batch), "updated": 0, "unchanged": 0, "write_errors": errors}
+
+
+def write_incremental(collection, hashes, batch):
+    """Инкрементальная загрузка: upsert только новых и изменившихся по хешу записей"""
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError
+
+    ids = [doc["id"] for _, doc in batch]
+    known = {item["_id"]: item["h"] for item in hashes.find({"_id": {"$in": ids}})}
+
+    changed = [(digest, doc) for digest, doc in batch if known.get(doc["id"]) != digest]
+    result = {"inserted": sum(1 for _, doc in changed if doc["id"] not in known),
+              "updated": sum(1 for _, doc in changed if doc["id"] in known),
+              "unchanged": len(batch) - len(changed), "write_errors": 0}
+    if not changed:
+        return result
+
+    for target, requests in ((collection, [ReplaceOne({"id": doc["id"]}, doc, upsert=True) for _, doc in changed]),
+                             (hashes, [ReplaceOne({"_id": doc["id"]}, {"h": digest}, upsert=True)
+                                       for digest, doc in changed])):
+        try:
+            target.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            result["write_errors"] += len(e.details.get("writeErrors", []))
+    if result["updated"]:
+        # Замены на месте не меняют ни максимальный id, ни количество - отмечаем их отдельно
+        bump_write_version(collection)
+    return result
+
+
+def copy_indexes(source, target):
+    """Переносит индексы source (кроме _id_) на target: подмена коллекции не должна их терять.
+    Индексы, уже построенные на target (по имени или ключу), пропускаются"""
+    existing = target.index_information()
+    existing_keys = [info["key"] for info in existing.values()]
+    for name, info in source.index_information().items():
+        if name == "_id_" or name in existing or info["key"] in existing_keys:
+            continue
+        options = {key: value for key, value in info.items() if key not in ("key", "v", "ns")}
+        target.create_index(info["key"], name=name, **options)
+
+
+def import_range(collection, hashes, path, start, end, columns, mode, batch_size=DEFAULT_BATCH_SIZE,
+                 collect_ids=False, collect_rejects=False, shadow=()):
+    """Разбирает, проверяет и записывает один диапазон файла пачками; возвращает статистику.
+
+    collect_rejects сохраняет отклоненные строки с причинами в stats["rejects"] для файла отказов,
+    shadow - колонки, для которых в документы дописываются теневые поля.
+    """
+    write = write_full if mode == "full" else write_incremental
+    stats = new_stats()
+
+    def reject(fields, reason):
+        stats["rejected"] += 1
+        if len(stats["errors"]) < MAX_ERROR_SAMPLES:
+            stats["errors"].append(f"{reason}: {','.join(fields)[:80]}")
+        if collect_rejects:
+            # Короткие строки дополняются, чтобы причина попала в колонку reason
+            stats["rejects"].append(list(fields) + [""] * (len(columns) - len(fields)) + [reason])
+
+    for raw, bad in parse_range(path, start, end, columns, batch_size):
+        stats["rows"] += len(raw) + len(bad)
+        for fields, reason in bad:
+            reject(fields, reason)
+        if raw.empty:
+            continue
+
+        clean, rejected = validate_frame(raw)
+        for fields, reason in zip(rejected[columns].itertuples(index=False, name=None), rejected["reason"]):
+            reject(fields, reason)
+        if clean.empty:
+            continue
+
+        docs = add_shadow_fields(frame_documents(clean), shadow)
+        if collect_ids:
+            stats["ids"].extend(doc["id"] for doc in docs)
+        for key, value in write(collection, hashes, list(zip(row_hashes(clean), docs))).items():
+            stats[key] += value
+    return stats
+
+
+def write_rejects(path, columns, rejects):
+    """Файл отказов: исходные поля строки и причина отклонения"""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns) + ["reason"])
+        writer.writerows(rejects)
+
+
+# --- Процессы пула: у каждого свое подключение ---
+
+_worker = {}
+
+
+def _init_worker(uri, db_name, collection_name, hashes_name):
+    from pymongo import MongoClient
+
+    client = MongoClient(uri)
+    _worker["collection"] = client[db_name][collection_name]
+    _worker["hashes"] = client[db_name][hashes_name]
+
+
+def _pool_import_range(task):
+    return import_range(_worker["collection"], _worker["hashes"], *task)
+
+
+def import_csv(collection, path, mode="incremental", uri=None, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+               range_size=RANGE_SIZE, delete_missing=False, progress=None, reject_path=None):
+    """Импортирует выгрузку CSV в коллекцию.
+
+    mode="full" загружает файл во временную коллекцию и атомарно подменяет ею основную
+    (при ошибке старые данные остаются); mode="incremental" записывает только новые
+    и изменившиеся по хешу строки, delete_missing удаляет записи, которых нет в файле.
+    Строки проверяются и приводятся к типам validation.validate_frame; отклоненные
+    с причинами пишутся в reject_path (если задан). Если для коллекции включены теневые поля
+    (shadow_fields.py), они дописываются в каждый документ.
+    При workers > 1 диапазоны файла обрабатываются пулом процессов (нужен uri).
+    """
+    if mode not in ("full", "incremental"):
+        raise ValueError(f"Неизвестный режим импорта: {mode}")
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and uri is None:
+        raise ValueError("Для пула процессов нужен uri базы")
+
+    db = collection.database
+    target = db[f"{collection.name}_import"] if mode == "full" else collection
+    hashes_name = hashes_collection_name(collection.name)
+    hashes = db[f"{hashes_name}_import"] if mode == "full" else db[hashes_name]
+    if mode == "full":
+        target.drop()
+        hashes.drop()
+
+    columns = read_header(path)
+    if "id" not in columns:
+        raise ValueError("В файле нет колонки id")
+    collect_ids = mode == "incremental" and delete_missing
+    # Теневые поля включаются shadow_fields.py и поддерживаются при каждом импорте
+    shadow = shadow_columns(collection)
+    tasks = [(path, start, end, columns, mode, batch_size, collect_ids, reject_path is not None, shadow)
+             for start, end in split_ranges(path, range_size)]
+
+    stats = new_stats()
+    if workers == 1:
+        for task in tasks:
+            merge_stats(stats, import_range(target, hashes, *task))
+            if progress is not None:
+                progress(stats)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(uri, db.name, target.name, hashes.name)) as pool:
+            for future in as_completed([pool.submit(_pool_import_range, task) for task in tasks]):
+                merge_stats(stats, future.result())
+                if progress is not None:
+                    progress(stats)
+
+    if reject_path is not None:
+        write_rejects(reject_path, columns, stats["rejects"])
+
+    stats["deleted"] = 0
+    if mode == "full":
+        # Индекс строится один раз после загрузки, затем подмена одной операцией
+        target.create_index("id")
+        ensure_shadow_indexes(target, shadow)
+        # Индексы сортировки (sorting.py), созданные вручную и т.д. переносятся со старой коллекции
+        copy_indexes(collection, target)
+        target.rename(collection.name, dropTarget=True)
+        hashes.rename(hashes_name, dropTarget=True)
+        # После полной загрузки все документы проверены: чтение может не учитывать "None"/NaN/строки-числа
+        mark_validated(collection, True, stats["rejected"])
+        bump_write_version(collection)
+    elif delete_missing:
+        stats["deleted"] = delete_missing_ids(collection, db[hashes_name], set(stats["ids"]), batch_size)
+
+    del stats["ids"], stats["rejects"]
+    return stats
+
+
+def delete_missing_ids(collection, hashes, seen_ids, batch_size=DEFAULT_BATCH_SIZE):
+    """Удаляет записи, чьих id не было в файле; возвращает число удаленных"""
+    missing = [item["_id"] for item in hashes.find({}, {"_id": 1}) if item["_id"] not in seen_ids]
+    deleted = 0
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        deleted += collection.delete_many({"id": {"$in": chunk}}).deleted_count
+        hashes.delete_many({"_id": {"$in": chunk}})
+    if deleted:
+        bump_write_version(collection)
+    return deleted
+
+
+def refresh_derived(collection, stats, mode):
+    """Обновляет свертки и скетчи: новые id догоняются, изменения и удаления требуют пересчета"""
+    from rollups import RollupManager
+    from sketches import SketchManager
+
+    rollups, sketches = RollupManager(collection), SketchManager(collection)
+    if mode == "full" or stats["updated"] or stats["deleted"]:
+        for rollup in rollups.rollups():
+            rollups.rebuild(rollup)
+        for store in sketches.stores():
+            sketches.rebuild(store)
+        # Кэши агрегаций по сверткам, посчитанные во время пересчета, сбрасываются со сменой отметки
+        bump_write_version(collection)
+    else:
+        rollups.catch_up()
+        sketches.catch_up()
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Параллельный импорт выгрузок CSV в формате nissan-dataset.csv")
+    parser.add_argument("path")
+    parser.add_argument("--mode", choices=["incremental", "full"], default="incremental",
+                        help="incremental - только новые и изменившиеся строки, full - полная подмена коллекции")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--delete-missing", action="store_true",
+                        help="Удалить записи, которых нет в файле (incremental)")
+    parser.add_argument("--reject-file", help="CSV для отклоненных строк с колонкой reason")
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    collection = client[args.db][args.collection]
+
+    def progress(stats):
+        print(f"\rСтрок: {stats['rows']:,}", end="", flush=True)
+
+    start = time.perf_counter()
+    stats = import_csv(collection, args.path, args.mode, args.uri, args.workers, args.batch_size,
+                       delete_missing=args.delete_missing, progress=progress, reject_path=args.reject_file)
+    elapsed = time.perf_counter() - start
+    print(f"\rСтрок: {stats['rows']:,} за {elapsed:.2f} с ({stats['rows'] / elapsed:,.0f} строк/с)")
+    print(f"Добавлено: {stats['inserted']:,}, изменено: {stats['updated']:,}, без изменений: {stats['unchanged']:,}, "
+          f"удалено: {stats['deleted']:,}, отклонено: {stats['rejected']:,}, ошибок записи: {stats['write_errors']:,}")
+    for error in stats["errors"]:
+        print(f"  {error}")
+
+    refresh_derived(collection, stats, args.mode)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,32 @@
 import customtkinter as ctk
-from tkinter import ttk, messagebox
-from pymongo import MongoClient
-import pandas as pd
+from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
 from collections import defaultdict
 import math
-import numbers
-import re
-from decimal import Decimal, InvalidOperation
+import os
+import threading
+
+from query_builder import (QueryBuilder, NUMERIC_FIELDS, OPERATORS, LOGIC_OPERATORS, AGGREGATION_FUNCTIONS,
+                           ARRAY_PREVIEW_SIZE, build_group_pipeline, group_result_row, group_result_columns,
+                           paginate_pipeline, facet_page, has_approximate_metrics, is_approximate_metric,
+                           is_impossible)
+from result_cache import ResultCache, cache_key
+from export import export_query, format_from_path, ExportCancelled
+from query_log import SlowQueryLog
+from shadow_fields import add_shadow_fields, document_projection, shadow_columns
+from table_renderer import TreeRenderer
+from type_registry import TypeRegistry, overrides_from_env
+from sorting import SORT_INDEX_WARN_ROWS, SortIndexAdvisor, sort_symbols, toggle_sort, with_tiebreaker
+from prefetch import PagePrefetcher, page_key, reversed_sort
+from query_timeouts import is_timeout, limit_cursor, max_time_ms, progressive_count, time_limit
+
+# pandas, pymongo и numpy (через snapshot) импортируются лениво в фоновом потоке запуска,
+# чтобы окно появлялось сразу
+
+# Карточки фильтров создаются по мере прокрутки панели: сначала первые FILTER_CARDS_INITIAL,
+# затем по FILTER_CARDS_STEP, когда прокрутка подходит к концу созданных
+FILTER_CARDS_INITIAL = 12
+FILTER_CARDS_STEP = 6
 
 
 class EnhancedNissanGUI:
@@ -19,12 +38,26 @@ class EnhancedNissanGUI:
         self.root.title("Nissan Vehicles Database - Enhanced")
         self.root.geometry("1800x1000")
 
-        self.client = MongoClient('localhost', 27017)
-        self.db = self.client['nissan']
-        self.collection = self.db['vehicles']
-
-        # Инициализируем базу тестовыми данными
-        self.initialize_test_data()
+        # Подключение к базе создается в фоне после показа окна (см. start_backend)
+        self.client = None
+        self.db = None
+        self.collection = None
+        self.rollups = None
+        self.sketches = None
+        self.metadata = None
+        self.fuzzy = None  # Индексы триграмм для "похоже на", строятся в фоне
+        self.fuzzy_refreshing = False
+        self.backend_ready = False
+
+        # Журнал медленных запросов (порог и путь задаются переменными окружения)
+        self.query_log = SlowQueryLog.from_env()
+
+        # Построитель запросов, общий с консольной утилитой
+        # Типы колонок уточняются по схеме (detect_schema, снимок), ручные - из NISSAN_COLUMN_TYPES
+        self.query_builder = QueryBuilder(on_regex_error=self.show_regex_error,
+                                          on_query_error=self.show_query_error,
+                                          registry=TypeRegistry.from_numeric_fields(NUMERIC_FIELDS,
+                                                                                    overrides_from_env()))
 
         self.current_page = 0
         self.page_size = 100
@@ -32,20 +65,41 @@ class EnhancedNissanGUI:
         self.filtered_records = 0
         self.all_columns = []
         self.column_types = {}
+        self.column_kinds = {}
+        self.cell_formatter = None
         self.column_stats = {}  # Хранит статистику по колонкам для всех данных
         self.filtered_column_stats = {}  # Хранит статистику по колонкам для отфильтрованных данных
+        self.column_distributions = {}  # Гистограммы и частые значения по всем данным
+        self.filtered_distributions = {}  # То же для отфильтрованных данных
+        # Статистика и распределения по отпечатку запроса: смена страницы и повтор фильтра не пересчитывают их
+        self.stats_cache = ResultCache(max_entries=32, ttl_seconds=300)
+        # Соседние страницы (и первая страница обратной сортировки) загружаются в фоне после каждого показа
+        self.page_prefetcher = PagePrefetcher(self.fetch_page_rows)
+        self.prefetch_reversed = os.environ.get("NISSAN_PREFETCH_REVERSED", "1") != "0"
+        # (ключ запроса и версии коллекции, количество найденных, точное ли): смена страницы или сортировки их не меняет
+        self.view_counts = None
+        # Прогрессивный режим: страница показывается сразу, количество считается в фоне с лимитом времени
+        # и при его нехватке показывается нижней границей (отключается NISSAN_PROGRESSIVE=0)
+        self.progressive = os.environ.get("NISSAN_PROGRESSIVE", "1") != "0"
+        self.count_lower_bound = False
         self.unique_values_cache = defaultdict(list)
 
         self.filters = {}
         self.sort_column = None
         self.sort_direction = 1
+        # Сортировка записей по нескольким колонкам (Shift+клик); sort_column/sort_direction - первая из них
+        self.sort_spec = []
+        self.sort_index_advisor = None
+        self.sort_index_asked = set()  # Сортировки, для которых уже предлагали создать индекс
         self.aggregation_pipeline = []
 
         # Для управления агрегацией
         self.aggregation_mode = False
         self.group_by_column = None
-        self.aggregation_function = None
-        self.aggregation_column = None
+        self.aggregation_metrics = []
+        self.aggregation_rows = []
+        self.aggregation_source = None
+        self.approximate_cache = None
 
         # Для управления динамическими фильтрами
         self.filter_conditions = []  # Список всех условий фильтрации
@@ -60,17 +114,46 @@ class EnhancedNissanGUI:
 
         # Для хранения ссылок на заголовки фильтров
         self.filter_header_labels = {}
+        # Следующая по порядку колонка без карточки фильтра и флаг незавершенного создания порций
+        self.filter_cards_next = 0
+        self.filter_cards_pending = False
+        # Последние показанные тексты виджетов и заголовков таблицы: неизменившиеся не перенастраиваются
+        self.widget_texts = {}
+        self.heading_texts = {}
 
         # Флаг для определения, используем ли регулярные выражения
         self.regex_mode_var = ctk.StringVar(value="true")
 
+        # Оценка по выборке для больших коллекций: сначала приближенные значения с интервалами,
+        # точные приходят из фонового потока (по умолчанию включается NISSAN_SAMPLING=1)
+        self.sampling_var = ctk.StringVar(value="true" if os.environ.get("NISSAN_SAMPLING", "0") == "1" else "false")
+        # Номер обновления: результаты фоновых точных расчетов для устаревших запросов отбрасываются
+        self.refresh_generation = 0
+
+        # Колоночный снимок коллекции на диске для быстрого холодного старта (включается NISSAN_SNAPSHOT=1)
+        self.snapshot_enabled = os.environ.get("NISSAN_SNAPSHOT", "0") == "1"
+        self.snapshot = None
+        self.serving_from_snapshot = False
+
         self.setup_ui()
 
+        # Окно уже построено - подключение, схема и данные подгружаются в фоне
+        self.root.after_idle(self.start_backend)
+
+    def show_regex_error(self, error):
+        """Показывает предупреждение о некорректном регулярном выражении"""
+        messagebox.showwarning("Ошибка регулярного выражения",
+                               f"Некорректное регулярное выражение: {str(error)}")
+
+    def show_query_error(self, error):
+        """Показывает предупреждение об условии, которое пропущено при построении запроса"""
+        messagebox.showwarning("Условие пропущено", f"Условие пропущено: {error}")
+
     def initialize_test_data(self):
         """Инициализирует базу данных тестовыми записями"""
         try:
             # Проверяем, есть ли уже данные
-            count = self.collection.count_documents({})
+            count = self.metadata.total_count()
             if count == 0:
                 test_data = [
                     {"id": 1, "full_name": "Dominic Applin", "age": 42, "gender": "Male", "model": "Quest",
@@ -126,7 +209,11 @@ class EnhancedNissanGUI:
                     {"id": 25, "full_name": "Emma Davis", "age": 31, "gender": "Female", "model": "Rogue",
                      "color": "Gray", "performance": 170, "km": 80000, "condition": "good", "price": 27000.00}
                 ]
+                add_shadow_fields(test_data, self.query_builder.shadow_columns)
                 self.collection.insert_many(test_data)
+                self.metadata.note_inserted(len(test_data))
+                self.rollups.apply_documents(test_data)
+                self.sketches.apply_documents(test_data)
                 print(f"Добавлено {len(test_data)} тестовых записей")
         except Exception as e:
             print(f"Ошибка инициализации тестовых данных: {e}")
@@ -165,8 +252,6 @@ class EnhancedNissanGUI:
         # Создаем панель агрегации под таблицей
         self.create_aggregation_panel(table_agg_container)
 
-        self.load_initial_data()
-
     def configure_treeview_style(self):
         """Настраивает стиль для Treeview без границ ячеек"""
         style = ttk.Style()
@@ -253,6 +338,10 @@ class EnhancedNissanGUI:
                                           command=self.toggle_regex_mode)
         self.regex_toggle.pack(side="left", padx=20)
 
+        ctk.CTkSwitch(filter_header, text="Оценка", variable=self.sampling_var,
+                      onvalue="true", offvalue="false",
+                      command=self.reload_current_page).pack(side="left")
+
         ctk.CTkButton(filter_header, text="Очистить все",
                       width=80, command=self.clear_all_filters).pack(side="right", padx=5)
 
@@ -261,12 +350,25 @@ class EnhancedNissanGUI:
                                                 font=ctk.CTkFont(weight="bold"))
         self.records_count_label.pack(padx=10, pady=(0, 10))
 
+        # Переход к фильтру любой колонки: карточка создается, даже если до нее еще не прокручивали
+        self.filter_column_combo = ctk.CTkComboBox(filters_container, values=[], width=450,
+                                                   command=self.show_filter_for_column)
+        self.filter_column_combo.set("Перейти к колонке...")
+        self.filter_column_combo.pack(padx=10, pady=(0, 10))
+
         self.filters_scroll = ctk.CTkScrollableFrame(
             filters_container,
             width=450,
             corner_radius=8
         )
         self.filters_scroll.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+        # Прокрутка панели передается полосе прокрутки и создает карточки у нижнего края
+        self.filters_scroll._parent_canvas.configure(yscrollcommand=self.on_filters_scrolled)
+
+    def on_filters_scrolled(self, first, last):
+        self.filters_scroll._scrollbar.set(first, last)
+        if float(last) > 0.9:
+            self.create_more_filters()
 
     def toggle_regex_mode(self):
         """Переключает режим регулярных выражений"""
@@ -313,7 +415,12 @@ class EnhancedNissanGUI:
             border_width=1,
             border_color=("#3a3a3a", "#3a3a3a")
         )
-        condition_frame.pack(fill="x", padx=5, pady=5, ipadx=5, ipady=5)
+        # Карточки идут в порядке колонок, даже если созданы не по порядку
+        following = min((condition['widgets'] for condition in self.filter_conditions
+                         if condition['widgets']['index'] > index),
+                        key=lambda widgets: widgets['index'], default=None)
+        pack_options = {"before": following['frame']} if following is not None else {}
+        condition_frame.pack(fill="x", padx=5, pady=5, ipadx=5, ipady=5, **pack_options)
 
         # Заголовок с номером условия и статистикой
         header_frame = ctk.CTkFrame(condition_frame, fg_color="transparent")
@@ -323,10 +430,10 @@ class EnhancedNissanGUI:
         stats_text = ""
         if col_name in self.column_stats:
             stats = self.column_stats[col_name]
-            stats_text = f" ({stats['non_empty']:,}/{stats['total']:,})"
+            stats_text = f" {self.fill_text(stats)}"
 
         header_label = ctk.CTkLabel(header_frame,
-                                    text=f"Фильтр #{filter_id + 1}: {col_name}{stats_text}",
+                                    text=f"Фильтр #{index + 1}: {col_name}{stats_text}",
                                     font=ctk.CTkFont(weight="bold", size=14))
         header_label.pack(side="left")
 
@@ -376,7 +483,8 @@ class EnhancedNissanGUI:
             'value_count': 1,  # Текущее количество строк значений
             'is_preset': True,  # Флаг, что это предустановленный фильтр
             'header_label': header_label,  # Сохраняем ссылку на заголовок
-            'col_name': col_name  # Сохраняем имя колонки
+            'col_name': col_name,  # Сохраняем имя колонки
+            'index': index  # Позиция колонки в схеме
         }
 
         self.filter_conditions.append({
@@ -396,7 +504,7 @@ class EnhancedNissanGUI:
         if not is_first:
             logic_var = ctk.StringVar(value="И")
             logic_combo = ctk.CTkComboBox(row_frame,
-                                          values=["И", "ИЛИ", "НЕ"],
+                                          values=LOGIC_OPERATORS,
                                           variable=logic_var,
                                           width=70,
                                           height=28)
@@ -406,13 +514,8 @@ class EnhancedNissanGUI:
 
         # Оператор сравнения для этого значения
         operator_var = ctk.StringVar(value="содержит")
-        operator_values = ["равно", "не равно", "больше", "больше или равно",
-                           "меньше", "меньше или равно", "в списке", "не в списке",
-                           "содержит", "не содержит", "начинается с", "заканчивается на",
-                           "regex содержит", "regex не содержит"]
-
         operator_combo = ctk.CTkComboBox(row_frame,
-                                         values=operator_values,
+                                         values=OPERATORS,
                                          variable=operator_var,
                                          width=160,
                                          height=28)
@@ -469,6 +572,8 @@ class EnhancedNissanGUI:
             # Для операторов регулярных выражений показываем подсказку
             elif operator in ["regex содержит", "regex не содержит"]:
                 row['value_entry'].configure(placeholder_text="Введите регулярное выражение")
+            elif operator == "похоже на":
+                row['value_entry'].configure(placeholder_text="Значение с опечатками")
             else:
                 row['value_entry'].configure(placeholder_text="Введите значение")
 
@@ -566,7 +671,7 @@ class EnhancedNissanGUI:
                                     stats_text = ""
                                     if col_name in self.column_stats:
                                         stats = self.column_stats[col_name]
-                                        stats_text = f" ({stats['non_empty']:,}/{stats['total']:,})"
+                                        stats_text = f" {self.fill_text(stats)}"
                                     grandchild.configure(text=f"Фильтр #{i + 1}: {col_name}{stats_text}")
                                 else:
                                     grandchild.configure(text=f"Фильтр #{i + 1}")
@@ -584,380 +689,81 @@ class EnhancedNissanGUI:
 
     def build_query(self):
         """Строит MongoDB запрос из условий фильтрации"""
-        final_query = {}
+        # Границы значений колонок устаревают, как только коллекция изменилась
+        registry = self.query_builder.registry
+        if registry.stats and self.metadata is not None:
+            self.metadata.total_count()
+            registry.expire(self.metadata.version())
+        if self.metadata is not None:
+            # Флаги импорта перечитываются вместе с отметкой записи: shadow_fields.py enable/disable ее меняет
+            self.metadata.current_version()
+            meta = self.metadata.ingest_meta()
+            self.query_builder.validated = bool(meta.get("validated"))
+            self.query_builder.shadow_columns = set(meta.get("shadow_columns") or [])
+        if self.fuzzy is not None and self.fuzzy.stale(self.metadata.version()):
+            self.refresh_fuzzy_indexes()
+        return self.query_builder.build_query(self.collect_column_filters(),
+                                              self.search_entry.get())
+
+    def refresh_fuzzy_indexes(self):
+        """Перестраивает индексы триграмм в фоне; до завершения "похоже на" ищет по прежним"""
+        if self.fuzzy_refreshing:
+            return
+        self.fuzzy_refreshing = True
+        version = self.metadata.version()
 
-        # Сначала применяем условия фильтрации из фильтров-панелей
-        if self.filter_conditions:
-            filter_parts = []
+        def done(_):
+            self.fuzzy_refreshing = False
 
-            for i, condition in enumerate(self.filter_conditions):
-                widgets = condition['widgets']
+        def failed(error):
+            self.fuzzy_refreshing = False
+            print(f"Ошибка построения индекса триграмм: {error}")
 
-                col = widgets['col_var'].get()
+        self.run_in_background(lambda: self.fuzzy.refresh(version), done, failed)
 
-                # Получаем значения, операторы сравнения и логические операторы из всех строк
-                value_conditions = []
-                logic_operators = []
+    def collect_column_filters(self):
+        """Собирает условия из фильтров-панелей в виде (колонка, условия значений, логические операторы)"""
+        column_filters = []
 
-                for j, row in enumerate(widgets['value_rows']):
-                    val = row['value_entry'].get().strip()
-                    operator = row['operator_var'].get()
+        for i, condition in enumerate(self.filter_conditions):
+            widgets = condition['widgets']
 
-                    if val:
-                        value_conditions.append({
-                            'value': val,
-                            'operator': operator
-                        })
+            col = widgets['col_var'].get()
 
-                        # Для первой строки нет логического оператора
-                        if j > 0:
-                            logic = row['logic_var'].get() if row['logic_var'] else "И"
-                            logic_operators.append(logic)
+            # Получаем значения, операторы сравнения и логические операторы из всех строк
+            value_conditions = []
+            logic_operators = []
 
-                # Пропускаем пустые условия
-                if not col or not value_conditions:
-                    continue
+            for j, row in enumerate(widgets['value_rows']):
+                val = row['value_entry'].get().strip()
+                operator = row['operator_var'].get()
 
-                # Строим условие с учетом логических операторов между значениями
-                condition_dict = self.build_value_conditions(col, value_conditions, logic_operators)
+                if val:
+                    value_conditions.append({
+                        'value': val,
+                        'operator': operator
+                    })
 
-                if condition_dict:
-                    filter_parts.append(condition_dict)
+                    # Для первой строки нет логического оператора
+                    if j > 0:
+                        logic = row['logic_var'].get() if row['logic_var'] else "И"
+                        logic_operators.append(logic)
 
-            # Если есть условия фильтрации, объединяем их через И
-            if filter_parts:
-                if len(filter_parts) == 1:
-                    final_query = filter_parts[0]
-                else:
-                    final_query = {"$and": filter_parts}
-
-        # Затем применяем глобальный поиск по всем полям
-        search_value = self.search_entry.get().strip()
-        if search_value:
-            search_query = self.build_search_conditions(search_value)
-            if search_query:
-                # Если уже есть условия фильтрации, объединяем с поиском через И
-                if final_query:
-                    final_query = {"$and": [final_query, search_query]}
-                else:
-                    final_query = search_query
+            column_filters.append((col, value_conditions, logic_operators))
 
-        return final_query
+        return column_filters
 
     def build_search_conditions(self, search_value):
         """Строит условия поиска по всем полям с поддержкой регулярных выражений"""
-        if not search_value:
-            return None
-
-        try:
-            # Всегда используем режим regex для поиска
-            is_regex = True
-
-            # Проверяем, является ли значение валидным регулярным выражением
-            try:
-                re.compile(search_value)
-                # Это валидное регулярное выражение
-                pattern = search_value
-                is_valid_regex = True
-            except:
-                # Не валидное regex, используем как обычный текст
-                pattern = re.escape(search_value)
-                is_valid_regex = False
-
-            # Создаем список условий для поиска по всем полям
-            or_conditions = []
-
-            # Определяем числовые поля
-            numeric_fields = ['id', 'age', 'performance', 'km', 'price']
-
-            # Для числовых полей нужно специальное условие для regex
-            for col in self.all_columns:
-                if col in numeric_fields:
-                    # Для числовых полей преобразуем в строку для regex поиска
-                    if is_valid_regex:
-                        # Для валидных regex создаем условие $toString для преобразования числа в строку
-                        or_conditions.append({
-                            "$expr": {
-                                "$regexMatch": {
-                                    "input": {"$toString": f"${col}"},
-                                    "regex": pattern,
-                                    "options": "i"
-                                }
-                            }
-                        })
-                    else:
-                        # Для простого текста используем прямое сравнение через $regex
-                        or_conditions.append({
-                            "$expr": {
-                                "$regexMatch": {
-                                    "input": {"$toString": f"${col}"},
-                                    "regex": pattern,
-                                    "options": "i"
-                                }
-                            }
-                        })
-                else:
-                    # Для текстовых полей используем обычный regex поиск
-                    if is_valid_regex:
-                        or_conditions.append({col: {"$regex": pattern, "$options": "i"}})
-                    else:
-                        or_conditions.append({col: {"$regex": pattern, "$options": "i"}})
-
-            # Если есть условия поиска, возвращаем их
-            if or_conditions:
-                return {"$or": or_conditions}
-            else:
-                return None
-
-        except Exception as e:
-            print(f"Ошибка построения условий поиска: {e}")
-            # Возвращаем простой regex поиск по всем полям
-            or_conditions = []
-            for col in self.all_columns:
-                or_conditions.append({col: {"$regex": search_value, "$options": "i"}})
-
-            return {"$or": or_conditions} if or_conditions else None
+        return self.query_builder.build_search_conditions(search_value)
 
     def build_value_conditions(self, col, value_conditions, logic_operators):
         """Строит условия для колонки с учетом операторов сравнения и логических операторов между значениями"""
-        if not col or not value_conditions:
-            return None
-
-        try:
-            # Если только одно условие
-            if len(value_conditions) == 1:
-                vc = value_conditions[0]
-                return self.build_single_condition(col, vc['operator'], vc['value'])
-
-            # Если несколько условия, объединяем их с учетом логических операторов
-            conditions = []
-
-            for vc in value_conditions:
-                condition = self.build_single_condition(col, vc['operator'], vc['value'])
-                if condition:
-                    conditions.append(condition)
-
-            if not conditions:
-                return None
-
-            if len(conditions) == 1:
-                return conditions[0]
-
-            # Объединяем условия с учетом логических операторов
-            combined_condition = conditions[0]
-
-            for i in range(1, len(conditions)):
-                if i - 1 < len(logic_operators):
-                    logic = logic_operators[i - 1]
-                else:
-                    logic = "И"  # По умолчанию
-
-                if logic == "И":
-                    combined_condition = {"$and": [combined_condition, conditions[i]]}
-                elif logic == "ИЛИ":
-                    combined_condition = {"$or": [combined_condition, conditions[i]]}
-                elif logic == "НЕ":
-                    combined_condition = {"$and": [combined_condition, {"$not": conditions[i]}]}
-
-            return combined_condition
-
-        except Exception as e:
-            print(f"Ошибка построения условий: {e}")
-            return None
+        return self.query_builder.build_value_conditions(col, value_conditions, logic_operators)
 
     def build_single_condition(self, col, operator, value):
         """Строит одно условие для MongoDB с обработкой числовых значений и регулярных выражений"""
-        if not col or not value:
-            return None
-
-        try:
-            # Проверяем специальные значения
-            if value.lower() in ["nan", "null", "none", "[пусто]", ""]:
-                # Обработка пустых значений
-                if operator == "равно":
-                    return {"$or": [
-                        {col: None},
-                        {col: {"$type": "null"}},
-                        {col: float('nan')}
-                    ]}
-                elif operator == "не равно":
-                    return {"$nor": [
-                        {col: None},
-                        {col: {"$type": "null"}},
-                        {col: float('nan')}
-                    ]}
-                else:
-                    return None
-
-            # Определяем, является ли поле числовым
-            is_numeric_field = col in ['id', 'age', 'performance', 'km', 'price']
-
-            # Для операторов "regex содержит" и "regex не содержит" - всегда используем regex
-            if operator in ["regex содержит", "regex не содержит"]:
-                try:
-                    # Проверяем валидность regex
-                    re.compile(value)
-
-                    if is_numeric_field:
-                        # Для числовых полей используем $toString для преобразования в строку
-                        if operator == "regex содержит":
-                            return {
-                                "$expr": {
-                                    "$regexMatch": {
-                                        "input": {"$toString": f"${col}"},
-                                        "regex": value,
-                                        "options": "i"
-                                    }
-                                }
-                            }
-                        else:  # "regex не содержит"
-                            return {
-                                "$expr": {
-                                    "$not": {
-                                        "$regexMatch": {
-                                            "input": {"$toString": f"${col}"},
-                                            "regex": value,
-                                            "options": "i"
-                                        }
-                                    }
-                                }
-                            }
-                    else:
-                        # Для текстовых полей используем обычный regex
-                        if operator == "regex содержит":
-                            return {col: {"$regex": value, "$options": "i"}}
-                        else:  # "regex не содержит"
-                            return {col: {"$not": {"$regex": value, "$options": "i"}}}
-
-                except re.error as e:
-                    messagebox.showwarning("Ошибка регулярного выражения",
-                                           f"Некорректное регулярное выражение: {str(e)}")
-                    return None
-
-            # Для текстовых операторов (содержит, не содержит, начинается с, заканчивается на)
-            elif operator in ["содержит", "не содержит", "начинается с", "заканчивается на"]:
-                # Создаем pattern в зависимости от оператора
-                if operator == "содержит":
-                    pattern = re.escape(value)
-                elif operator == "не содержит":
-                    pattern = re.escape(value)
-                elif operator == "начинается с":
-                    pattern = "^" + re.escape(value)
-                elif operator == "заканчивается на":
-                    pattern = re.escape(value) + "$"
-
-                if is_numeric_field:
-                    # Для числовых полей преобразуем в строку
-                    if operator == "не содержит":
-                        return {
-                            "$expr": {
-                                "$not": {
-                                    "$regexMatch": {
-                                        "input": {"$toString": f"${col}"},
-                                        "regex": pattern,
-                                        "options": "i"
-                                    }
-                                }
-                            }
-                        }
-                    else:
-                        return {
-                            "$expr": {
-                                "$regexMatch": {
-                                    "input": {"$toString": f"${col}"},
-                                    "regex": pattern,
-                                    "options": "i"
-                                }
-                            }
-                        }
-                else:
-                    # Для текстовых полей используем обычный regex
-                    if operator == "не содержит":
-                        return {col: {"$not": {"$regex": pattern, "$options": "i"}}}
-                    else:
-                        return {col: {"$regex": pattern, "$options": "i"}}
-
-            # Для числовых операторов (равно, не равно, больше, меньше и т.д.)
-            elif operator in ["равно", "не равно", "больше", "больше или равно", "меньше", "меньше или равно"]:
-                # Пробуем преобразовать в число
-                is_numeric_value = False
-                numeric_value = None
-
-                try:
-                    # Убираем возможные пробелы и запятые
-                    clean_value = value.replace(' ', '').replace(',', '')
-                    # Пробуем преобразовать в Decimal
-                    numeric_value = Decimal(clean_value)
-                    if numeric_value == numeric_value.to_integral_value():
-                        numeric_value = int(numeric_value)
-                    else:
-                        numeric_value = float(numeric_value)
-                    is_numeric_value = True
-                except (ValueError, InvalidOperation):
-                    is_numeric_value = False
-
-                # Если значение числовое и поле числовое
-                if is_numeric_field and is_numeric_value:
-                    operator_map = {
-                        "равно": "$eq",
-                        "не равно": "$ne",
-                        "больше": "$gt",
-                        "больше или равно": "$gte",
-                        "меньше": "$lt",
-                        "меньше или равно": "$lte"
-                    }
-
-                    if operator in operator_map:
-                        return {col: {operator_map[operator]: numeric_value}}
-
-                # Если значение не числовое или поле не числовое
-                else:
-                    # Используем строковое сравнение
-                    if operator == "равно":
-                        return {col: value}
-                    elif operator == "не равно":
-                        return {col: {"$ne": value}}
-                    else:
-                        # Для других операторов с нечисловыми значениями возвращаем None
-                        return None
-
-            # Для операторов списка
-            elif operator in ["в списке", "не в списке"]:
-                # Разделяем значения, если они введены через запятую
-                if ',' in value:
-                    values_list = [v.strip() for v in value.split(',')]
-                else:
-                    values_list = [value]
-
-                # Преобразуем числовые значения если поле числовое
-                final_values = []
-                for val in values_list:
-                    if is_numeric_field:
-                        try:
-                            clean_val = val.replace(' ', '').replace(',', '')
-                            num_val = Decimal(clean_val)
-                            if num_val == num_val.to_integral_value():
-                                final_values.append(int(num_val))
-                            else:
-                                final_values.append(float(num_val))
-                        except (ValueError, InvalidOperation):
-                            final_values.append(val)
-                    else:
-                        final_values.append(val)
-
-                if operator == "в списке":
-                    return {col: {"$in": final_values}}
-                else:  # "не в списке"
-                    return {col: {"$nin": final_values}}
-
-            else:
-                return None
-
-        except Exception as e:
-            print(f"Ошибка построения условия для {col} с оператором {operator} и значением {value}: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+        return self.query_builder.build_single_condition(col, operator, value)
 
     def create_search_panel(self, parent):
         """Создает панель поиска над таблицей"""
@@ -998,6 +804,9 @@ class EnhancedNissanGUI:
         ctk.CTkButton(button_frame, text="Очистить", width=80, height=32,
                       command=self.clear_search).pack(side="left")
 
+        ctk.CTkButton(button_frame, text="Экспорт", width=80, height=32,
+                      command=self.start_export).pack(side="left", padx=(5, 0))
+
     def clear_search(self):
         """Очищает поле поиска"""
         self.search_entry.delete(0, 'end')
@@ -1039,6 +848,8 @@ class EnhancedNissanGUI:
 
         # Привязываем события
         self.tree.bind("<Button-1>", self.on_tree_click)
+        self.tree.bind("<Double-1>", self.on_tree_double_click)
+        self.table_renderer = TreeRenderer(self.tree)
 
     def create_table_headers(self, columns):
         """Создает заголовки таблицы для Treeview с фиксированной шириной и многострочным текстом"""
@@ -1049,6 +860,7 @@ class EnhancedNissanGUI:
         for col in self.tree["columns"]:
             self.tree.heading(col, text="")
             self.tree.column(col, width=0)
+        self.heading_texts.clear()
 
         # Устанавливаем новые колонки
         self.tree["columns"] = columns
@@ -1058,27 +870,17 @@ class EnhancedNissanGUI:
         # Рассчитываем общую ширину всех столбцов
         total_width = 0
 
+        sort_symbols = self.current_sort_symbols()
         for i, col in enumerate(columns):
             # Создаем заголовок с символом сортировки
-            sort_symbol = ""
-            if self.sort_column == col:
-                sort_symbol = " ↑" if self.sort_direction == 1 else " ↓"
-
-            # Добавляем статистику во вторую строку заголовка
-            stats_text = ""
-            if col in self.filtered_column_stats and not self.aggregation_mode:
-                stats = self.filtered_column_stats[col]
-                stats_text = f"\n({stats['non_empty']:,}/{stats['total']:,})"
-            elif col in self.column_stats:
-                stats = self.column_stats[col]
-                stats_text = f"\n({stats['non_empty']:,}/{stats['total']:,})"
+            sort_symbol = sort_symbols.get(col, "")
 
             # Создаем многострочный текст заголовка
-            header_text = f"{col}{sort_symbol}{stats_text}"
+            header_text = f"{col}{sort_symbol}{self.header_stats_text(col)}"
 
             # Настраиваем колонку
-            self.tree.heading(col, text=header_text, anchor="center",
-                              command=lambda c=col: self.on_header_click(c))
+            self.set_heading_text(col, header_text, anchor="center",
+                                  command=lambda c=col: self.on_header_click(c))
 
             # Устанавливаем ширину
             if col in self.column_widths:
@@ -1097,6 +899,33 @@ class EnhancedNissanGUI:
         # Настраиваем растягивание, чтобы столбцы заполняли всю ширину таблицы
         self.configure_column_stretch(columns, total_width)
 
+    def header_stats_text(self, col):
+        """Строки статистики под названием колонки: заполненность и распределение значений"""
+        # Используем статистику для отфильтрованных данных, если она есть
+        if col in self.filtered_column_stats and not self.aggregation_mode:
+            stats = self.filtered_column_stats[col]
+            distribution = self.filtered_distributions.get(col)
+            if stats['total'] == 0:
+                stats = self.column_stats.get(col, {'non_empty': 0, 'total': 0})
+                distribution = self.column_distributions.get(col)
+        elif col in self.column_stats:
+            stats = self.column_stats[col]
+            distribution = None if self.aggregation_mode else self.column_distributions.get(col)
+        else:
+            return ""
+
+        stats_text = f"\n{self.fill_text(stats)}"
+        if distribution:
+            from distributions import format_distribution
+            stats_text += "\n" + format_distribution(distribution)
+        return stats_text
+
+    def fill_text(self, stats):
+        """(непустых/всего); для оценки по выборке - доля заполненных с погрешностью"""
+        if stats.get('estimated'):
+            return f"(≈{stats['fill_rate']:.0f}% ±{stats['fill_rate_margin']:.1f}% из ≈{stats['total']:,})"
+        return f"({stats['non_empty']:,}/{stats['total']:,})"
+
     def calculate_column_width(self, col_name, header_text):
         """Рассчитывает фиксированную ширину для колонки на основе содержимого заголовка"""
         # Разделяем текст на строки
@@ -1139,12 +968,9 @@ class EnhancedNissanGUI:
                     self.tree.column(col, width=new_width)
 
     def create_table_rows(self, data):
-        """Создает строки таблицы с данными в Treeview"""
-        # Очищаем предыдущие данные
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-
+        """Показывает строки данных в Treeview: отличия от текущей страницы применяются порциями"""
         if not data:
+            self.table_renderer.clear()
             # Создаем заголовки даже при отсутствии данных
             if not self.aggregation_mode:
                 columns = self.all_columns
@@ -1166,26 +992,10 @@ class EnhancedNissanGUI:
             self.tree["columns"] = columns
             self.create_table_headers(columns)
 
-        # Добавляем данные в Treeview
-        for row_idx, row_data in enumerate(data):
-            values = []
-            for col in columns:
-                value = row_data.get(col, "")
-                formatted_value = self.safe_format_value(value)
-                values.append(formatted_value)
-
-            # Добавляем строку в Treeview
-            item = self.tree.insert("", "end", iid=str(row_idx), values=values)
-
-            # Альтернативный цвет для четных строк
-            if row_idx % 2 == 0:
-                self.tree.item(item, tags=('even_row',))
-            else:
-                self.tree.item(item, tags=('odd_row',))
-
-        # Настраиваем теги для альтернативных цветов строк
-        self.tree.tag_configure('even_row', background='#2b2b2b')
-        self.tree.tag_configure('odd_row', background='#252525')
+        # Значения форматируются по колонкам целиком, по видам колонок из схемы
+        if self.cell_formatter is None:
+            self.set_column_kinds(self.column_kinds)
+        self.table_renderer.render(columns, self.cell_formatter.format_rows(data, columns))
 
     def on_tree_click(self, event):
         """Обработка клика в Treeview"""
@@ -1197,9 +1007,10 @@ class EnhancedNissanGUI:
                 columns = self.tree["columns"]
                 if col_index < len(columns):
                     col_name = columns[col_index]
-                    self.on_header_click(col_name)
+                    # Shift+клик добавляет колонку к сортировке
+                    self.on_header_click(col_name, additive=bool(event.state & 0x0001))
 
-    def on_header_click(self, column):
+    def on_header_click(self, column, additive=False):
         """Обработка клика на заголовок таблицы"""
         current_time = datetime.now().timestamp()
 
@@ -1219,7 +1030,7 @@ class EnhancedNissanGUI:
         if self.aggregation_mode:
             self.apply_aggregation_sort(column)
         else:
-            self.apply_sort(column, -1 if self.sort_direction == 1 else 1)
+            self.apply_sort(column, additive)
 
     def apply_aggregation_sort(self, column):
         """Применяет сортировку в режиме агрегации"""
@@ -1228,9 +1039,11 @@ class EnhancedNissanGUI:
         else:
             self.sort_column = column
             self.sort_direction = 1
+        self.sort_spec = [(self.sort_column, self.sort_direction)]
 
-        # Перезагружаем агрегацию с новой сортировкой
-        self.apply_aggregation()
+        # Перезагружаем агрегацию с новой сортировкой с первой страницы
+        self.current_page = 0
+        self.load_aggregation_page()
 
     def create_pagination_panel(self, parent):
         """Создает панель пагинации под таблицей"""
@@ -1354,6 +1167,8 @@ class EnhancedNissanGUI:
                                               width=180,
                                               height=32)
         self.group_by_combo.pack(side="left")
+        self.group_by_vars = [self.group_by_var]
+        self.group_by_combos = [self.group_by_combo]
 
         # Функция
         func_frame = ctk.CTkFrame(controls_row, fg_color="transparent")
@@ -1362,10 +1177,7 @@ class EnhancedNissanGUI:
         ctk.CTkLabel(func_frame, text="Функция:").pack(side="left", padx=(0, 8))
         self.agg_func_var = ctk.StringVar(value="")
         agg_func_combo = ctk.CTkComboBox(func_frame,
-                                         values=["сумма", "среднее", "минимум", "максимум",
-                                                 "первое значение", "последнее значение", "все значения",
-                                                 "уникальные значения", "количество", "выборочная дисперсия",
-                                                 "генерируемая дисперсия"],
+                                         values=list(AGGREGATION_FUNCTIONS),
                                          variable=self.agg_func_var,
                                          width=180,
                                          height=32)
@@ -1383,56 +1195,216 @@ class EnhancedNissanGUI:
                                              width=180,
                                              height=32)
         self.agg_col_combo.pack(side="left")
+        self.metric_vars = [(self.agg_func_var, self.agg_col_var)]
+        self.agg_col_combos = [self.agg_col_combo]
 
         # Кнопки управления агрегацией
         button_frame = ctk.CTkFrame(controls_row, fg_color="transparent")
         button_frame.pack(side="left", padx=(0, 10))
 
+        ctk.CTkButton(button_frame, text="+ Ключ", width=80, height=32,
+                      command=self.add_group_by_key).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="+ Метрика", width=90, height=32,
+                      command=self.add_aggregation_metric).pack(side="left", padx=5)
         ctk.CTkButton(button_frame, text="Применить агрегацию", width=160, height=32,
                       command=self.apply_aggregation).pack(side="left", padx=5)
         ctk.CTkButton(button_frame, text="Сбросить агрегацию", width=160, height=32,
                       command=self.reset_aggregation).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Сохранить свертку", width=150, height=32,
+                      command=self.register_rollup).pack(side="left", padx=5)
+
+        # Дополнительные ключи группировки и метрики - все считаются одним $group
+        self.agg_extra_frame = ctk.CTkFrame(agg_main_controls, fg_color="transparent")
+        self.agg_extra_frame.pack(fill="x")
+        self.agg_extra_rows = []
+
+    def add_group_by_key(self):
+        """Добавляет еще одну колонку в составной ключ группировки"""
+        row = ctk.CTkFrame(self.agg_extra_frame, fg_color="transparent")
+        row.pack(fill="x", pady=(5, 0))
+
+        ctk.CTkLabel(row, text="И по:").pack(side="left", padx=(0, 8))
+        var = ctk.StringVar(value="")
+        combo = ctk.CTkComboBox(row, values=self.all_columns, variable=var, width=180, height=32)
+        combo.pack(side="left")
+        self.group_by_vars.append(var)
+        self.group_by_combos.append(combo)
+
+        def remove():
+            self.group_by_vars.remove(var)
+            self.group_by_combos.remove(combo)
+            self.agg_extra_rows.remove(row)
+            row.destroy()
+
+        ctk.CTkButton(row, text="✕", width=32, height=32, command=remove).pack(side="left", padx=5)
+        self.agg_extra_rows.append(row)
+
+    def add_aggregation_metric(self):
+        """Добавляет еще одну пару (функция, колонка) к агрегации"""
+        row = ctk.CTkFrame(self.agg_extra_frame, fg_color="transparent")
+        row.pack(fill="x", pady=(5, 0))
+
+        ctk.CTkLabel(row, text="Функция:").pack(side="left", padx=(0, 8))
+        func_var = ctk.StringVar(value="")
+        ctk.CTkComboBox(row, values=list(AGGREGATION_FUNCTIONS), variable=func_var,
+                        width=180, height=32).pack(side="left", padx=(0, 20))
+
+        ctk.CTkLabel(row, text="Колонка:").pack(side="left", padx=(0, 8))
+        col_var = ctk.StringVar(value="")
+        col_combo = ctk.CTkComboBox(row, values=self.all_columns, variable=col_var, width=180, height=32)
+        col_combo.pack(side="left")
+
+        metric = (func_var, col_var)
+        self.metric_vars.append(metric)
+        self.agg_col_combos.append(col_combo)
+
+        def remove():
+            self.metric_vars.remove(metric)
+            self.agg_col_combos.remove(col_combo)
+            self.agg_extra_rows.remove(row)
+            row.destroy()
+
+        ctk.CTkButton(row, text="✕", width=32, height=32, command=remove).pack(side="left", padx=5)
+        self.agg_extra_rows.append(row)
+
+    def collect_aggregation_spec(self):
+        """Возвращает (ключи группировки, метрики) из панели агрегации"""
+        group_by = []
+        for var in self.group_by_vars:
+            col = var.get()
+            if col and col not in group_by:
+                group_by.append(col)
+        metrics = [(func_var.get(), col_var.get()) for func_var, col_var in self.metric_vars if func_var.get()]
+        return group_by, metrics
+
+    def set_column_kinds(self, kinds):
+        """Виды колонок для форматирования страниц (int, float, text, object)"""
+        from cell_format import ColumnFormatter
+
+        self.column_kinds = dict(kinds)
+        if self.cell_formatter is None:
+            self.cell_formatter = ColumnFormatter()
+        self.cell_formatter.set_kinds(self.column_kinds)
+
+    def start_backend(self):
+        """Запускает подключение к базе и определение схемы в фоновом потоке"""
+        self.records_count_label.configure(text="Подключение к базе...")
+        self.run_in_background(self.prepare_backend, self.load_initial_data, self.on_backend_error)
+
+    def prepare_backend(self):
+        """Подключается к базе, готовит тестовые данные и схему (в фоновом потоке, без обращений к Tk)"""
+        from pymongo import MongoClient
+        from collection_meta import CollectionMetadata
+        from rollups import RollupManager
+        from sketches import SketchManager
+
+        self.client = MongoClient('localhost', 27017)
+        self.db = self.client['nissan']
+        self.collection = self.db['vehicles']
+        # Общее количество документов кэшируется и пересчитывается только при изменении отметки записи
+        self.metadata = CollectionMetadata(self.collection, query_log=self.query_log)
+        try:
+            self.metadata.ensure_index()
+        except Exception as e:
+            print(f"Не удалось создать индекс по id: {e}")
+        # Коллекция после проверенного импорта: пропуски только null, категории канонические
+        try:
+            from validation import is_validated
+            self.query_builder.validated = is_validated(self.collection)
+            # Теневые поля (shadow_fields.py): "начинается с" и текстовые условия по числам через индекс
+            self.query_builder.shadow_columns = set(shadow_columns(self.collection))
+        except Exception as e:
+            print(f"Не удалось прочитать метаданные импорта: {e}")
+        self.rollups = RollupManager(self.collection, self.query_log)
+        self.sketches = SketchManager(self.collection, self.query_log)
+        self.sort_index_advisor = SortIndexAdvisor(self.collection)
+        from fuzzy import FuzzyIndexes
+        self.fuzzy = FuzzyIndexes(self.collection, query_log=self.query_log, build_on_demand=False)
+        self.query_builder.fuzzy = self.fuzzy
+
+        # Инициализируем базу тестовыми данными
+        self.initialize_test_data()
 
-    def safe_format_value(self, value):
-        """Безопасное форматирование значения с обработкой различных типов данных"""
+        # Свертки и скетчи догоняем до коллекции: документы могли добавиться без приложения
         try:
-            if value is None:
-                return "[ПУСТО]"
+            for name, added in self.rollups.catch_up().items():
+                print(f"Свертка {name}: " + ("перестроена" if added < 0 else f"добавлено документов: {added:,}"))
+            for name, added in self.sketches.catch_up().items():
+                print(f"Скетчи {name}: " + ("пересчитаны" if added < 0 else f"добавлено документов: {added:,}"))
+        except Exception as e:
+            print(f"Ошибка обновления сверток: {e}")
 
-            # Проверяем на NaN (не число)
-            if isinstance(value, float):
-                if math.isnan(value):
-                    return "[ПУСТО]"
-                # Форматируем с 2 знаками после запятой
-                return f"{value:.2f}"
+        if self.snapshot_enabled:
+            from snapshot import ColumnarSnapshot
+            self.snapshot = ColumnarSnapshot.for_collection(self.collection)
+            if self.snapshot.load():
+                from distributions import snapshot_distributions
+                self.column_distributions = snapshot_distributions(self.snapshot)
+                return "snapshot"
 
-            # Проверяем на другие числовые типы
-            if isinstance(value, (int, numbers.Integral)):
-                return str(value)
+        self.detect_schema()
+        return "live"
+
+    def on_backend_error(self, error):
+        print(f"Ошибка подключения к базе: {error}")
+        self.records_count_label.configure(text="Нет подключения к базе")
+        messagebox.showerror("Ошибка", f"Ошибка подключения к базе: {str(error)}")
+
+    def load_initial_data(self, source):
+        """Показывает данные, как только готова схема: сначала страница, затем счетчики и статистика"""
+        self.backend_ready = True
+
+        if source == "snapshot":
+            # Схема, статистика и первые страницы берутся из снимка, коллекция догоняется в фоне
+            self.apply_snapshot_schema()
+            self.serving_from_snapshot = True
+            directory = self.snapshot.directory
+            self.run_in_background(lambda: self.sync_snapshot_for_view(directory), self.on_snapshot_synced)
+            self.load_data()
+        else:
+            self.apply_schema_to_ui()
+            if self.snapshot is not None:
+                # Снимка еще нет - строим его в фоне для следующего запуска
+                directory = self.snapshot.directory
+                self.run_in_background(lambda: self.sync_snapshot(directory))
+            self.stream_initial_data()
+
+        # При запуске показываем фильтры по всем столбцам, создавая карточки порциями
+        self.root.after(100, self.create_all_filters)
 
-            # Для списков показываем количество элементов
-            if isinstance(value, list):
-                return f"[{len(value)} значений]"
+    def stream_initial_data(self):
+        """Первая страница сразу, количество записей и статистика - из фонового потока"""
+        self.load_page_data()
+        query = self.build_query()
+        generation = self.refresh_generation
 
-            # Для словарей преобразуем в строку
-            if isinstance(value, dict):
-                return "{...}"
+        def work():
+            # Поток только считает: состояние окна меняется в done, если вид за это время не сменился
+            total_all = self.metadata.total_count()
+            total = self.collection.count_documents(query, **time_limit()) if query else total_all
+            return (total, total_all, *self.compute_filtered_column_stats(query, total))
 
-            # Для остальных типов просто преобразуем в строку
-            return str(value)
+        def done(result):
+            if generation != self.refresh_generation or self.aggregation_mode:
+                return
+            total, total_all, self.filtered_column_stats, self.filtered_distributions = result
+            self.total_records = total
+            self.records_count_label.configure(text=self.count_text(total, total_all))
+            self.update_all_statistics()
+            self.update_info()
 
-        except Exception as e:
-            print(f"Ошибка форматирования значения {value}: {e}")
-            return "[ОШИБКА]"
+        def failed(error):
+            print(f"Ошибка подсчета записей: {error}")
+            if generation == self.refresh_generation and not self.aggregation_mode:
+                self.records_count_label.configure(
+                    text="Подсчет не уложился в лимит времени (NISSAN_MAX_TIME_MS)" if is_timeout(error)
+                    else "Ошибка подсчета записей")
 
-    def load_initial_data(self):
-        self.detect_schema()
-        # При запуске сразу показываем все фильтры по всем столбцам
-        self.root.after(100, self.create_all_filters)
-        self.load_data()
+        self.records_count_label.configure(text="Подсчет записей...")
+        self.run_in_background(work, done, failed)
 
     def create_all_filters(self):
-        """Создает фильтры для всех столбцов при запуске"""
+        """Создает фильтры по столбцам при запуске: первые карточки сразу, остальные по мере прокрутки"""
         if not self.all_columns:
             return
 
@@ -1442,152 +1414,294 @@ class EnhancedNissanGUI:
                 condition['widgets']['frame'].destroy()
             self.filter_conditions.clear()
             self.filter_widgets.clear()
+        self.filter_header_labels.clear()
+        self.widget_texts.clear()
 
-        # Создаем фильтры для всех столбцов
-        for i, col in enumerate(self.all_columns):
-            self.create_filter_for_column(col, i)
+        self.filter_cards_next = 0
+        self.filter_cards_pending = True
+        # Создаем фильтры порциями, чтобы окно оставалось отзывчивым
+        self.create_filters_chunk(0, min(FILTER_CARDS_INITIAL, len(self.all_columns)))
 
-        # Обновляем данные после создания всех фильтров
-        self.load_data()
+    def create_more_filters(self, count=FILTER_CARDS_STEP):
+        """Создает следующие по порядку карточки, если прокрутка дошла до конца созданных"""
+        if self.filter_cards_pending or self.filter_cards_next >= len(self.all_columns):
+            return
+        self.filter_cards_pending = True
+        self.create_filters_chunk(self.filter_cards_next, min(self.filter_cards_next + count, len(self.all_columns)))
+
+    def create_filters_chunk(self, start, stop, chunk_size=3):
+        """Создает очередную порцию карточек фильтров до колонки stop и планирует следующую"""
+        end = min(start + chunk_size, stop)
+        for i in range(start, end):
+            if self.all_columns[i] not in self.filter_header_labels:
+                self.create_filter_for_column(self.all_columns[i], i)
+        self.filter_cards_next = end
+
+        if end < stop:
+            self.root.after(1, lambda: self.create_filters_chunk(end, stop, chunk_size))
+        else:
+            self.filter_cards_pending = False
+            # Обновляем статистику в заголовках после создания порции
+            self.update_all_statistics()
+
+    def ensure_filter_card(self, col_name):
+        """Виджеты карточки фильтра колонки; карточка создается, если ее еще нет"""
+        widgets = next((condition['widgets'] for condition in self.filter_conditions
+                        if condition['widgets']['col_name'] == col_name), None)
+        if widgets is None and col_name in self.all_columns:
+            self.create_filter_for_column(col_name, self.all_columns.index(col_name))
+            widgets = self.filter_conditions[-1]['widgets']
+        return widgets
+
+    def show_filter_for_column(self, col_name):
+        """Прокручивает панель к фильтру колонки и ставит курсор в поле значения"""
+        widgets = self.ensure_filter_card(col_name)
+        if widgets is None:
+            return
+        self.update_all_statistics()
+
+        # Положение карточки - доля высоты содержимого панели
+        self.filters_scroll.update_idletasks()
+        content_height = self.filters_scroll.winfo_height()
+        if content_height > 0:
+            self.filters_scroll._parent_canvas.yview_moveto(widgets['frame'].winfo_y() / content_height)
+        widgets['value_rows'][0]['value_entry'].focus_set()
+
+    def set_widget_text(self, widget, text):
+        """Меняет текст виджета, только если он изменился: configure у CTk перерисовывает виджет"""
+        if self.widget_texts.get(widget) == text:
+            return
+        widget.configure(text=text)
+        self.widget_texts[widget] = text
+
+    def set_heading_text(self, col, text, **options):
+        """Меняет текст заголовка колонки таблицы, только если он изменился (или переданы другие опции)"""
+        if not options and self.heading_texts.get(col) == text:
+            return
+        self.tree.heading(col, text=text, **options)
+        self.heading_texts[col] = text
 
     def detect_schema(self):
+        """Определяет колонки, типы и статистику по всей коллекции (без обращений к интерфейсу).
+
+        Документы читаются курсором пачками (streaming_stats): в памяти только текущая пачка
+        и статистика по колонкам, а не вся коллекция списком и DataFrame.
+        """
+        from streaming_stats import collect_stats
+
         try:
             # Получаем общее количество записей из базы данных
-            total_records = self.collection.count_documents({})
+            total_records = self.metadata.total_count()
             print(f"Всего записей в базе: {total_records}")
 
             if total_records == 0:
                 print("База данных пуста")
                 return
 
-            # Берем ВСЕ данные для точной статистики
-            cursor = self.collection.find({}, {'_id': 0})
-            records = list(cursor)
+            # Проходим ВСЕ данные для точной статистики
+            stats = collect_stats(self.collection, {}, projection=document_projection(), query_log=self.query_log)
 
-            if not records:
+            if not stats.rows:
                 print("Не удалось получить записи из базы")
                 return
 
-            print(f"Получено записей для анализа: {len(records)}")
+            print(f"Получено записей для анализа: {stats.rows}")
 
-            df = pd.DataFrame(records)
-            self.all_columns = [col for col in df.columns if col != '_id']
+            self.all_columns = list(stats.columns)
+            self.query_builder.columns = self.all_columns
 
             print(f"Найдено колонок: {len(self.all_columns)}")
             print(f"Колонки: {self.all_columns}")
 
-            # Вычисляем точную статистику для каждой колонки
-            for col in self.all_columns:
-                if col in df.columns:
-                    # Получаем тип данных
-                    dtype = str(df[col].dtype)
-                    self.column_types[col] = dtype
-
-                    # ТОЧНЫЙ расчет непустых значений
-                    # Проверяем каждое значение на пустоту (None, NaN, пустая строка)
-                    non_empty_count = 0
-                    for value in df[col]:
-                        if pd.isna(value) or value is None:
-                            continue
-                        if isinstance(value, float) and math.isnan(value):
-                            continue
-                        if isinstance(value, str) and value.strip() == "":
-                            continue
-                        non_empty_count += 1
-
-                    # Сохраняем статистику для всех данных
-                    self.column_stats[col] = {
-                        'total': total_records,
-                        'non_empty': non_empty_count,
-                        'empty': total_records - non_empty_count,
-                        'fill_rate': (non_empty_count / total_records * 100) if total_records > 0 else 0
-                    }
+            self.column_distributions = stats.distributions()
+            # Типы и границы значений колонок для построения и отсечения условий
+            self.query_builder.registry.set_types(stats.registry_types())
+            self.query_builder.registry.set_stats(stats.registry_stats(), self.metadata.version())
+            # Вид колонки - по исходным значениям: целые с пропусками остаются целыми
+            self.set_column_kinds(stats.column_kinds())
+            self.column_types.update(stats.column_types())
 
-                    print(
-                        f"{col}: непустых={non_empty_count:,}, всего={total_records:,}, заполненность={self.column_stats[col]['fill_rate']:.1f}%")
-
-                    # Кэшируем уникальные значения для фильтров
-                    if df[col].nunique() < 100:
-                        unique_vals = df[col].dropna().unique().tolist()
-                        unique_vals_str = [str(val) for val in unique_vals]
-                        self.unique_values_cache[col] = sorted(unique_vals_str)[:50]
+            # Статистика заполненности для всех данных
+            self.column_stats.update(stats.column_stats(total_records))
+            for col in self.all_columns:
+                print(f"{col}: непустых={self.column_stats[col]['non_empty']:,}, всего={total_records:,}, "
+                      f"заполненность={self.column_stats[col]['fill_rate']:.1f}%")
 
-            # Обновляем комбобоксы
-            if self.all_columns:
-                self.group_by_combo.configure(values=self.all_columns)
-                self.agg_col_combo.configure(values=self.all_columns)
+            # Кэшируем уникальные значения для фильтров
+            self.unique_values_cache.update(stats.unique_values())
 
         except Exception as e:
             print(f"Ошибка определения схемы: {e}")
             import traceback
             traceback.print_exc()
 
-    def calculate_filtered_column_stats(self):
-        """Рассчитывает статистику по колонкам для отфильтрованных данных"""
-        query = self.build_query()
+    def apply_schema_to_ui(self):
+        """Обновляет комбобоксы агрегации после определения схемы"""
+        if self.all_columns:
+            for combo in self.group_by_combos + self.agg_col_combos:
+                combo.configure(values=self.all_columns)
+            self.filter_column_combo.configure(values=self.all_columns)
 
-        # Очищаем предыдущую статистику
-        self.filtered_column_stats.clear()
+    def run_in_background(self, work, on_done=None, on_error=None):
+        """Выполняет work в фоновом потоке и вызывает on_done(результат) в главном потоке"""
+        state = {}
 
-        try:
-            # Получаем отфильтрованные данные
-            cursor = self.collection.find(query, {'_id': 0})
-            records = list(cursor)
+        def worker():
+            try:
+                state['result'] = work()
+            except Exception as e:
+                state['error'] = e
 
-            if not records:
-                # Если нет данных, сбрасываем статистику
-                for col in self.all_columns:
-                    self.filtered_column_stats[col] = {
-                        'total': 0,
-                        'non_empty': 0,
-                        'empty': 0,
-                        'fill_rate': 0
-                    }
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                self.root.after(50, poll)
                 return
+            if 'error' in state:
+                if on_error:
+                    on_error(state['error'])
+                else:
+                    print(f"Ошибка фоновой задачи: {state['error']}")
+            elif on_done:
+                on_done(state.get('result'))
+
+        self.root.after(50, poll)
+
+    def sync_snapshot(self, directory):
+        """Догоняет снимок до живой коллекции (в фоновом потоке, в отдельном экземпляре)"""
+        from snapshot import ColumnarSnapshot
+
+        snapshot = ColumnarSnapshot(directory)
+        added = snapshot.catch_up(self.collection, query_log=self.query_log)
+        print("Снимок перестроен" if added < 0 else f"Снимок догнан, новых документов: {added:,}")
+        return snapshot
+
+    def sync_snapshot_for_view(self, directory):
+        """Догоняет снимок и сразу считает по нему распределения для заголовков (в фоновом потоке)"""
+        from distributions import snapshot_distributions
+
+        snapshot = self.sync_snapshot(directory)
+        return snapshot, snapshot_distributions(snapshot)
+
+    def on_snapshot_synced(self, result):
+        """Переключает интерфейс со снимка на живую коллекцию"""
+        old_columns = list(self.all_columns)
+        self.snapshot, self.column_distributions = result
+        self.stats_cache.invalidate()
+        self.apply_snapshot_schema(self.metadata.version())
+        self.serving_from_snapshot = False
+
+        if self.all_columns != old_columns:
+            self.create_all_filters()
+        self.load_data()
+
+    def apply_snapshot_schema(self, version=None):
+        """Заполняет колонки, типы, статистику и уникальные значения из снимка"""
+        from cell_format import kind_from_dtype
+
+        meta = self.snapshot.meta
+        self.all_columns = list(self.snapshot.columns)
+        self.query_builder.columns = self.all_columns
+        self.column_types = dict(meta['column_types'])
+        # Пока снимок догоняет коллекцию (version=None), границам значений из него не доверяем
+        self.query_builder.registry.learn_snapshot(self.snapshot, version)
+        self.set_column_kinds({col: kind_from_dtype(dtype, col in self.snapshot.integer_columns)
+                               for col, dtype in self.column_types.items()})
+        self.column_stats = {col: dict(stats) for col, stats in meta['column_stats'].items()}
+
+        self.unique_values_cache.clear()
+        for col, values in meta['unique_values'].items():
+            if values is not None:
+                self.unique_values_cache[col] = values[:50]
+
+        print(f"Схема из снимка: {self.snapshot.count:,} записей, колонки: {self.all_columns}")
+
+        self.apply_schema_to_ui()
+
+    def load_data_from_snapshot(self):
+        """Показывает количество, статистику и страницу из снимка (без фильтров и сортировки)"""
+        self.total_records = self.snapshot.count
+        self.records_count_label.configure(
+            text=f"Найдено: {self.total_records:,} из {self.total_records:,} записей (снимок)"
+        )
+
+        self.filtered_column_stats = {col: dict(stats) for col, stats in self.column_stats.items()}
+        self.filtered_distributions = self.column_distributions
+        self.update_all_statistics()
 
-            df = pd.DataFrame(records)
+        rows = self.snapshot.page(self.current_page * self.page_size, self.page_size)
+        self.create_table_rows(rows)
+        self.update_info()
 
-            # Рассчитываем статистику для каждой колонки
+    def calculate_filtered_column_stats(self, query=None):
+        """Рассчитывает статистику и распределения по колонкам для отфильтрованных данных"""
+        if query is None:
+            query = self.build_query()
+        self.filtered_column_stats, self.filtered_distributions = self.compute_filtered_column_stats(
+            query, self.total_records)
+
+    def compute_filtered_column_stats(self, query, total_records):
+        """Возвращает (статистика, распределения) по колонкам для запроса, не меняя состояние окна.
+
+        Результат кэшируется по отпечатку запроса, количеству найденных записей и отметке записи коллекции,
+        поэтому смена страницы или повтор фильтра не читают коллекцию заново.
+        """
+        from streaming_stats import collect_stats
+
+        version = self.metadata.current_version() if self.metadata is not None else None
+        key = cache_key("column_stats", query, total_records, self.all_columns, version)
+        cached = self.stats_cache.get(key)
+        if cached is not None:
+            return cached
+
+        filtered_column_stats = {}
+        filtered_distributions = {}
+
+        # Без фильтров статистика совпадает со статистикой снимка, если количество записей сходится
+        if (not query and self.snapshot is not None and self.snapshot.meta
+                and self.snapshot.count == total_records):
             for col in self.all_columns:
-                if col in df.columns:
-                    # ТОЧНЫЙ расчет непустых значений для отфильтрованных данных
-                    non_empty_count = 0
-                    for value in df[col]:
-                        if pd.isna(value) or value is None:
-                            continue
-                        if isinstance(value, float) and math.isnan(value):
-                            continue
-                        if isinstance(value, str) and value.strip() == "":
-                            continue
-                        non_empty_count += 1
-
-                    # Сохраняем статистику для отфильтрованных данных
-                    self.filtered_column_stats[col] = {
-                        'total': len(records),
-                        'non_empty': non_empty_count,
-                        'empty': len(records) - non_empty_count,
-                        'fill_rate': (non_empty_count / len(records) * 100) if len(records) > 0 else 0
-                    }
-                else:
-                    # Если колонка отсутствует в результатах
-                    self.filtered_column_stats[col] = {
+                filtered_column_stats[col] = dict(self.snapshot.meta['column_stats'].get(
+                    col, {'total': 0, 'non_empty': 0, 'empty': 0, 'fill_rate': 0}))
+            self.stats_cache.put(key, (filtered_column_stats, self.column_distributions))
+            return filtered_column_stats, self.column_distributions
+
+        try:
+            # Отфильтрованные данные - потоковым проходом курсора, без списка записей и DataFrame
+            stats = collect_stats(self.collection, query, self.all_columns, document_projection(),
+                                  query_log=self.query_log, max_time_ms=max_time_ms())
+
+            if not stats.rows:
+                # Если нет данных, сбрасываем статистику
+                for col in self.all_columns:
+                    filtered_column_stats[col] = {
                         'total': 0,
                         'non_empty': 0,
                         'empty': 0,
                         'fill_rate': 0
                     }
+                return filtered_column_stats, filtered_distributions
+
+            # Гистограммы и частые значения - из того же прохода, без отдельного запроса
+            filtered_column_stats = stats.column_stats()
+            filtered_distributions = stats.distributions()
+            self.stats_cache.put(key, (filtered_column_stats, filtered_distributions))
 
         except Exception as e:
             print(f"Ошибка расчета статистики по отфильтрованным данным: {e}")
             # В случае ошибки сбрасываем статистику
             for col in self.all_columns:
-                self.filtered_column_stats[col] = {
+                filtered_column_stats[col] = {
                     'total': 0,
                     'non_empty': 0,
                     'empty': 0,
                     'fill_rate': 0
                 }
 
+        return filtered_column_stats, filtered_distributions
+
     def update_all_statistics(self):
         """Обновляет всю статистику в интерфейсе"""
         # Обновляем заголовки фильтров
@@ -1601,17 +1715,17 @@ class EnhancedNissanGUI:
                 if col_name in self.filtered_column_stats and not self.aggregation_mode:
                     stats = self.filtered_column_stats[col_name]
                     if stats['total'] > 0:
-                        stats_text = f" ({stats['non_empty']:,}/{stats['total']:,})"
+                        stats_text = f" {self.fill_text(stats)}"
                     else:
                         stats = self.column_stats.get(col_name, {'non_empty': 0, 'total': 0})
-                        stats_text = f" ({stats['non_empty']:,}/{stats['total']:,})"
+                        stats_text = f" {self.fill_text(stats)}"
                 elif col_name in self.column_stats:
                     stats = self.column_stats[col_name]
-                    stats_text = f" ({stats['non_empty']:,}/{stats['total']:,})"
+                    stats_text = f" {self.fill_text(stats)}"
 
                 # Обновляем заголовок
-                header_text = f"Фильтр #{condition['id'] + 1}: {col_name}{stats_text}"
-                widgets['header_label'].configure(text=header_text)
+                header_text = f"Фильтр #{widgets['index'] + 1}: {col_name}{stats_text}"
+                self.set_widget_text(widgets['header_label'], header_text)
 
         # Обновляем заголовки таблицы
         self.update_table_headers()
@@ -1623,165 +1737,216 @@ class EnhancedNissanGUI:
 
         columns = self.tree["columns"]
 
+        sort_symbols = self.current_sort_symbols()
         for col in columns:
             # Создаем заголовок с символом сортировки
-            sort_symbol = ""
-            if self.sort_column == col:
-                sort_symbol = " ↑" if self.sort_direction == 1 else " ↓"
-
-            # Добавляем статистику во вторую строку заголовка
-            # Используем статистику для отфильтрованных данных, если она есть
-            stats_text = ""
-            if col in self.filtered_column_stats and not self.aggregation_mode:
-                stats = self.filtered_column_stats[col]
-                if stats['total'] > 0:
-                    stats_text = f"\n({stats['non_empty']:,}/{stats['total']:,})"
-                else:
-                    stats = self.column_stats.get(col, {'non_empty': 0, 'total': 0})
-                    stats_text = f"\n({stats['non_empty']:,}/{stats['total']:,})"
-            elif col in self.column_stats:
-                stats = self.column_stats[col]
-                stats_text = f"\n({stats['non_empty']:,}/{stats['total']:,})"
+            sort_symbol = sort_symbols.get(col, "")
 
             # Создаем многострочный текст заголовка
-            header_text = f"{col}{sort_symbol}{stats_text}"
+            header_text = f"{col}{sort_symbol}{self.header_stats_text(col)}"
 
             # Обновляем заголовок колонки
-            self.tree.heading(col, text=header_text)
+            self.set_heading_text(col, header_text)
 
     def apply_aggregation(self):
-        group_by = self.group_by_var.get()
-        agg_func = self.agg_func_var.get()
-        agg_col = self.agg_col_var.get()
+        if not self.backend_ready:
+            return
+
+        group_by, metrics = self.collect_aggregation_spec()
 
-        if not group_by or not agg_func:
+        if not group_by or not metrics:
             messagebox.showwarning("Предупреждение",
                                    "Выберите колонку для группировки и агрегационную функцию")
             return
 
+        self.group_by_column = group_by
+        self.aggregation_metrics = metrics
+        self.current_page = 0
+        # Явное применение пересчитывает приближенные функции; страницы и сортировка берут их из кэша
+        self.approximate_cache = None
+        self.load_aggregation_page()
+
+    def load_aggregation_page(self):
+        """Загружает одну страницу групп и общее число групп одним запросом"""
+        group_by, metrics = self.group_by_column, self.aggregation_metrics
+        self.refresh_generation += 1
+
         try:
-            # Преобразуем человеческое название функции в MongoDB оператор
-            mongo_func = {
-                "сумма": "$sum",
-                "среднее": "$avg",
-                "минимум": "$min",
-                "максимум": "$max",
-                "первое значение": "$first",
-                "последнее значение": "$last",
-                "все значения": "$push",
-                "уникальные значения": "$addToSet",
-                "количество": "$count",
-                "выборочная дисперсия": "$stdDevPop",
-                "генерируемая дисперсия": "$stdDevSamp"
-            }.get(agg_func, "$sum")
-
-            # Строим пайплайн агрегации
-            pipeline = []
-
-            # Добавляем стадию матча из текущих фильтров
-            match_stage = self.build_query()
-            if match_stage:
-                pipeline.append({"$match": match_stage})
-
-            # Стадия группировки
-            group_stage = {"_id": f"${group_by}"}
-
-            if mongo_func == "$count":
-                group_stage["count"] = {"$sum": 1}
-            elif agg_col:
-                # Для большинства функций просто применяем оператор
-                if mongo_func in ["$sum", "$avg", "$min", "$max", "$first", "$last", "$push", "$addToSet"]:
-                    group_stage["result"] = {mongo_func: f"${agg_col}"}
-                elif mongo_func in ["$stdDevPop", "$stdDevSamp"]:
-                    # Для стандартного отклонения фильтруем числовые значения
-                    group_stage["result"] = {
-                        mongo_func: {
-                            "$cond": {
-                                "if": {"$and": [
-                                    {"$ne": [f"${agg_col}", None]},
-                                    {"$ne": [{"$type": f"${agg_col}"}, "null"]},
-                                    {"$in": [{"$type": f"${agg_col}"}, ["double", "int", "long", "decimal"]]}
-                                ]},
-                                "then": f"${agg_col}",
-                                "else": None
-                            }
-                        }
-                    }
-            else:
-                # Если колонка не выбрана, но функция требует ее
-                if mongo_func not in ["$count"]:
-                    messagebox.showwarning("Предупреждение",
-                                           "Выберите колонку для агрегации")
-                    return
+            query = self.build_query()
 
-            pipeline.append({"$group": group_stage})
+            if has_approximate_metrics(metrics):
+                self.load_approximate_aggregation_page(query, group_by, metrics)
+                return
 
-            # Фильтруем группы с пустыми результатами для числовых функций
-            if mongo_func in ["$stdDevPop", "$stdDevSamp"]:
-                pipeline.append({"$match": {"result": {"$ne": None}}})
+            # Если есть свертка с подходящими ключами, метриками и фильтрами - считаем по ней
+            rollup, rollup_match = None, None
+            if self.rollups is not None:
+                try:
+                    rollup, rollup_match = self.rollups.find_for(group_by, metrics, query)
+                except Exception as e:
+                    print(f"Ошибка выбора свертки: {e}")
 
-            # Сортировка
-            sort_direction = self.sort_direction if self.sort_column else 1
-            if self.sort_column:
-                sort_field = "result" if self.sort_column != group_by else "_id"
-                pipeline.append({"$sort": {sort_field: sort_direction}})
-            else:
-                pipeline.append({"$sort": {"_id": 1}})
+            # Строим один пайплайн на все ключи и метрики с учетом текущих фильтров и сортировки;
+            # массивы значений обрезаются на сервере, на клиент приходит только текущая страница
+            try:
+                if rollup is not None:
+                    source = rollup.collection
+                    pipeline = rollup.build_pipeline(rollup_match, group_by, metrics,
+                                                     self.sort_column, self.sort_direction)
+                else:
+                    source = self.collection
+                    pipeline = build_group_pipeline(query, group_by, metrics, self.sort_column,
+                                                    self.sort_direction, array_limit=ARRAY_PREVIEW_SIZE)
+                pipeline = paginate_pipeline(pipeline, self.current_page * self.page_size, self.page_size)
+            except ValueError as e:
+                messagebox.showwarning("Предупреждение", str(e))
+                return
+
+            # В режиме оценки сначала группы по выборке, точная страница - из фонового потока
+            population = self.sampling_population() if rollup is None else None
+            if population is not None:
+                exact_key = cache_key("aggregation", pipeline, self.metadata.current_version())
+                exact = self.stats_cache.get(exact_key)
+                if exact is None:
+                    self.load_estimated_aggregation_page(query, group_by, metrics, pipeline, population, exact_key)
+                    return
+                result, total_groups = exact
+                self.show_aggregation_page(result, total_groups, group_by, metrics)
+                return
 
             # Выполняем агрегацию
             try:
-                result = list(self.collection.aggregate(pipeline, allowDiskUse=True))
+                with self.query_log.track("aggregate", source, pipeline) as entry:
+                    result, total_groups = facet_page(source.aggregate(pipeline, allowDiskUse=True, **time_limit()))
+                    entry['result_size'] = len(result)
             except Exception as agg_error:
                 print(f"Ошибка агрегации: {agg_error}")
+                if is_timeout(agg_error):
+                    self.show_aggregation_timeout()
+                    return
                 messagebox.showwarning("Предупреждение",
                                        f"Ошибка агрегации: {str(agg_error)}\nПопробуйте другие параметры.")
                 return
 
-            # Обновляем таблицу с результатами
-            self.display_aggregation_results(result, group_by, agg_func, agg_col)
-
-            self.aggregation_mode = True
-            self.group_by_column = group_by
-            self.aggregation_function = agg_func
-            self.aggregation_column = agg_col
+            self.show_aggregation_page(result, total_groups, group_by, metrics,
+                                       f"свертки {rollup.name}" if rollup is not None else None)
 
         except Exception as e:
+            # Группы по выборке считаются здесь же, в потоке окна
+            if is_timeout(e):
+                self.show_aggregation_timeout()
+                return
             messagebox.showerror("Ошибка", f"Ошибка агрегации: {str(e)}")
             import traceback
             traceback.print_exc()
 
-    def display_aggregation_results(self, results, group_by, agg_func, agg_col):
-        """Отображение результатов агрегации"""
-        # Создаем данные для отображения в таблице
-        table_data = []
-
-        for record in results:
-            row_data = {}
-            row_data[group_by] = record.get("_id", "N/A")
-
-            if agg_func == "количество" or "count" in record:
-                row_data["Количество"] = record.get("count", 0)
-            elif agg_col:
-                # Красивое отображение функции
-                func_display = {
-                    "сумма": "Сумма",
-                    "среднее": "Среднее",
-                    "минимум": "Минимум",
-                    "максимум": "Максимум",
-                    "первое значение": "Первое",
-                    "последнее значение": "Последнее",
-                    "все значения": "Все значения",
-                    "уникальные значения": "Уникальные",
-                    "выборочная дисперсия": "Выб. дисперсия",
-                    "генерируемая дисперсия": "Ген. дисперсия"
-                }.get(agg_func, agg_func)
-                column_name = f"{func_display}({agg_col})"
-                row_data[column_name] = record.get("result", 0)
-
-            table_data.append(row_data)
+    @staticmethod
+    def show_aggregation_timeout():
+        messagebox.showwarning("Предупреждение", "Агрегация не уложилась в лимит времени "
+                               "(NISSAN_MAX_TIME_MS).\nСузьте фильтры или уменьшите число групп.")
+
+    def show_aggregation_page(self, records, total_groups, group_by, metrics, source=None):
+        """Показывает страницу результатов $group"""
+        self.aggregation_mode = True
+        self.total_records = total_groups
+        self.aggregation_source = source
+
+        # Обновляем таблицу с результатами
+        self.display_aggregation_results([group_result_row(record, group_by, metrics) for record in records],
+                                         group_by, metrics)
+
+    def load_estimated_aggregation_page(self, query, group_by, metrics, pipeline, population, exact_key):
+        """Группы по случайной выборке с интервалами; точная страница заменяет их по готовности"""
+        from sampling import estimate_group_rows, SAMPLE_SIZE
+
+        generation = self.refresh_generation
+        rows, groups = estimate_group_rows(self.collection, query, group_by, metrics, population,
+                                           sort_column=self.sort_column, sort_direction=self.sort_direction,
+                                           array_limit=ARRAY_PREVIEW_SIZE, query_log=self.query_log)
+        self.aggregation_mode = True
+        self.total_records = groups
+        self.aggregation_source = f"выборки {min(SAMPLE_SIZE, population):,} документов, точные значения считаются..."
+        skip = self.current_page * self.page_size
+        self.display_aggregation_results(rows[skip:skip + self.page_size], group_by, metrics)
+
+        def work():
+            with self.query_log.track("aggregate", self.collection, pipeline) as entry:
+                result = facet_page(self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit()))
+                entry['result_size'] = len(result[0])
+            return result
+
+        def done(result):
+            self.stats_cache.put(exact_key, result)
+            if generation != self.refresh_generation or not self.aggregation_mode:
+                return
+            self.show_aggregation_page(*result, group_by, metrics)
+
+        def failed(error):
+            print(f"Ошибка агрегации: {error}")
+            if generation == self.refresh_generation:
+                messagebox.showwarning("Предупреждение", f"Ошибка агрегации: {str(error)}\nПопробуйте другие параметры.")
+
+        self.run_in_background(work, done, failed)
+
+    def load_approximate_aggregation_page(self, query, group_by, metrics):
+        """Страница группировки с приближенными функциями: все группы считаются один раз в фоне,
+        листаются в памяти; после изменения коллекции считаются заново"""
+        from sketches import approximate_group_rows
+
+        key = cache_key(query, group_by, metrics, self.metadata.current_version())
+        if self.approximate_cache is not None and self.approximate_cache[0] == key:
+            _, rows, store_name = self.approximate_cache
+            self.show_approximate_page(rows, store_name, group_by, metrics)
+            return
+
+        generation = self.refresh_generation
+
+        def work():
+            # Без подходящего хранилища скетчей это проход по всем найденным документам
+            return approximate_group_rows(self.collection, query, group_by, metrics, self.sketches,
+                                          ARRAY_PREVIEW_SIZE, self.query_log)
+
+        def done(result):
+            rows, store_name = result
+            self.approximate_cache = (key, rows, store_name)
+            if generation != self.refresh_generation:
+                return
+            self.show_approximate_page(rows, store_name, group_by, metrics)
+
+        def failed(error):
+            print(f"Ошибка агрегации: {error}")
+            if generation != self.refresh_generation:
+                return
+            if is_timeout(error):
+                self.show_aggregation_timeout()
+            else:
+                messagebox.showwarning("Предупреждение",
+                                       f"Ошибка агрегации: {str(error)}\nПопробуйте другие параметры.")
+
+        self.records_count_label.configure(text="Агрегация по скетчам...")
+        self.run_in_background(work, done, failed)
+
+    def show_approximate_page(self, rows, store_name, group_by, metrics):
+        from sketches import sort_rows
+
+        columns = group_result_columns(group_by, metrics, ARRAY_PREVIEW_SIZE)
+        sort_column = self.sort_column if self.sort_column in columns else None
+        rows = sort_rows(rows, sort_column, self.sort_direction, group_by)
+
+        self.aggregation_mode = True
+        self.total_records = len(rows)
+        self.aggregation_source = f"скетчей {store_name}" if store_name else "скетчей, посчитанных за один проход"
+
+        skip = self.current_page * self.page_size
+        self.display_aggregation_results(rows[skip:skip + self.page_size], group_by, metrics)
+
+    def display_aggregation_results(self, table_data, group_by, metrics):
+        """Отображение страницы результатов агрегации: ключи группы и каждая метрика в своей колонке"""
+        # Строки текущей страницы нужны для перехода к записям группы по двойному клику
+        self.aggregation_rows = table_data
 
         # Определяем колонки для отображения
-        columns = list(table_data[0].keys()) if table_data else []
+        columns = group_result_columns(group_by, metrics, ARRAY_PREVIEW_SIZE)
 
         # Создаем заголовки
         self.create_table_headers(columns)
@@ -1790,24 +1955,88 @@ class EnhancedNissanGUI:
         self.create_table_rows(table_data)
 
         # Обновляем информацию о записях
+        source_text = f", из {self.aggregation_source}" if self.aggregation_source else ""
         self.records_count_label.configure(
-            text=f"Агрегировано {len(results):,} групп"
+            text=f"Агрегировано {self.total_records:,} групп{source_text} (двойной клик - записи группы)"
         )
 
-        # Обновляем информацию о странице
-        self.page_label.configure(text="Агрегация")
-        self.page_combo_var.set("")
+        self.update_info()
+
+    def register_rollup(self):
+        """Сохраняет текущие ключи группировки и колонки метрик как инкрементальную свертку"""
+        if not self.backend_ready:
+            return
+
+        group_by, metrics = self.collect_aggregation_spec()
+        if not group_by:
+            messagebox.showwarning("Предупреждение", "Выберите колонку для группировки")
+            return
+
+        # Точные метрики идут в свертку, приближенные - в скетчи по тем же ключам
+        columns = list(dict.fromkeys(agg_col for agg_func, agg_col in metrics
+                                     if agg_col and not is_approximate_metric(agg_func)))
+        sketch_columns = list(dict.fromkeys(agg_col for agg_func, agg_col in metrics
+                                            if agg_col and is_approximate_metric(agg_func)))
+
+        def work():
+            built = []
+            if columns or not sketch_columns:
+                rollup = self.rollups.register(group_by, columns)
+                built.append(f"свертка {rollup.name}: {rollup.collection.count_documents({}):,} ключей")
+            if sketch_columns:
+                store = self.sketches.register(group_by, sketch_columns)
+                built.append(f"скетчи {store.name}: {store.collection.count_documents({}):,} партиций")
+            return built
+
+        def done(built):
+            messagebox.showinfo("Свертка", "Готово:\n" + "\n".join(built))
+
+        self.records_count_label.configure(text="Построение свертки...")
+        self.run_in_background(work, done,
+                               lambda e: messagebox.showerror("Ошибка", f"Ошибка построения свертки: {str(e)}"))
+
+    def on_tree_double_click(self, event):
+        """Двойной клик по группе в режиме агрегации: фильтры по ключам группы и переход к записям"""
+        if not self.aggregation_mode or self.tree.identify("region", event.x, event.y) != "cell":
+            return
+
+        item = self.tree.identify_row(event.y)
+        if not item or int(item) >= len(self.aggregation_rows):
+            return
+        row = self.aggregation_rows[int(item)]
+
+        for col in self.group_by_column:
+            widgets = self.ensure_filter_card(col)
+            if widgets is None:
+                continue
+
+            value = row.get(col)
+            value_rows = widgets['value_rows']
+            value_rows[0]['operator_var'].set("равно")
+            value_rows[0]['value_entry'].delete(0, "end")
+            value_rows[0]['value_entry'].insert(0, "[пусто]" if value is None else str(value))
+            # Остальные условия колонки очищаем, чтобы фильтр совпадал с группой
+            for value_row in value_rows[1:]:
+                value_row['value_entry'].delete(0, "end")
+
+        self.reset_aggregation()
 
     def reset_aggregation(self):
         self.aggregation_mode = False
         self.group_by_column = None
-        self.aggregation_function = None
-        self.aggregation_column = None
+        self.aggregation_metrics = []
+        self.aggregation_rows = []
+        self.current_page = 0
+
+        # Убираем дополнительные ключи и метрики
+        for row in self.agg_extra_rows:
+            row.destroy()
+        self.agg_extra_rows.clear()
+        del self.group_by_vars[1:], self.group_by_combos[1:]
+        del self.metric_vars[1:], self.agg_col_combos[1:]
 
         # Обновляем комбобоксы
-        if self.all_columns:
-            self.group_by_combo.configure(values=self.all_columns)
-            self.agg_col_combo.configure(values=self.all_columns)
+        self.apply_schema_to_ui()
 
         self.group_by_var.set("")
         self.agg_func_var.set("")
@@ -1817,25 +2046,67 @@ class EnhancedNissanGUI:
         self.load_data()
 
     def load_data(self):
+        if not self.backend_ready:
+            # Подключение еще не готово - данные загрузятся по его завершении
+            return
+
         try:
             if self.aggregation_mode:
                 # Если в режиме агрегации, не обновляем обычные данные
                 return
 
+            self.refresh_generation += 1
+            self.count_lower_bound = False
             query = self.build_query()
 
-            # Исправляем: проверяем запрос перед использованием
-            if query:
-                self.total_records = self.collection.count_documents(query)
-            else:
-                self.total_records = self.collection.count_documents({})
+            # Пока коллекция догоняется в фоне, вид без фильтров и сортировки берем из снимка
+            if self.serving_from_snapshot and not query and not self.sort_column:
+                self.load_data_from_snapshot()
+                return
 
-            total_all = self.collection.count_documents({})
+            # В режиме оценки точные количества берем из кэша, а если их еще нет - показываем оценку
+            population = self.sampling_population()
+            # Ключ с отметкой записи: после изменения коллекции точные значения считаются заново
+            exact_counts = (self.stats_cache.get(cache_key("counts", query, self.metadata.current_version()))
+                            if population is not None else None)
+            if population is not None and exact_counts is None:
+                self.load_data_estimated(query, population)
+                return
+
+            exact = True
+            if exact_counts is not None:
+                self.total_records, total_all = exact_counts
+            else:
+                # Общее количество - из кэша метаданных; считаем только отфильтрованные записи
+                total_all = self.metadata.total_count()
+                counts_key = cache_key("counts", query, self.metadata.version())
+                if self.view_counts is not None and self.view_counts[0] == counts_key:
+                    # Запрос и коллекция не изменились (смена сортировки) - количество то же
+                    self.total_records, exact = self.view_counts[1:]
+                elif is_impossible(query):
+                    # Условие отсечено по статистике колонок - считать нечего
+                    self.total_records = 0
+                elif query and self.progressive:
+                    # Страница сразу, количество и статистика - из фонового потока
+                    self.load_data_progressive(query, total_all, counts_key)
+                    return
+                elif query:
+                    with self.query_log.track("count", self.collection, query) as entry:
+                        self.total_records = self.collection.count_documents(query, **time_limit())
+                        entry['result_size'] = self.total_records
+                else:
+                    self.total_records = total_all
+                self.view_counts = (counts_key, self.total_records, exact)
 
+            self.count_lower_bound = not exact
             # Обновляем метку с количеством записей
-            self.records_count_label.configure(
-                text=f"Найдено: {self.total_records:,} из {total_all:,} записей"
-            )
+            self.records_count_label.configure(text=self.count_text(self.total_records, total_all, exact))
+
+            if not exact:
+                # Точное количество не уложилось в лимит - статистика по всем найденным заняла бы не меньше
+                self.load_page_data()
+                self.update_info()
+                return
 
             # Рассчитываем статистику по отфильтрованным данным
             self.calculate_filtered_column_stats()
@@ -1851,51 +2122,235 @@ class EnhancedNissanGUI:
             import traceback
             traceback.print_exc()
 
+    @staticmethod
+    def count_text(total, total_all, exact=True):
+        if exact:
+            return f"Найдено: {total:,} из {total_all:,} записей"
+        return f"Найдено: не меньше {total:,} из {total_all:,} записей (подсчет прерван по лимиту времени)"
+
+    def load_data_progressive(self, query, total_all, counts_key):
+        """Показывает страницу сразу, количество и статистику считает в фоне.
+
+        Подсчет идет шагами с limit (progressive_count) в пределах NISSAN_COUNT_TIME_MS: если точное
+        количество не успело посчитаться, показывается нижняя граница, а статистика не считается.
+        """
+        generation = self.refresh_generation
+        self.total_records = 0
+        self.count_lower_bound = True
+        self.records_count_label.configure(text=f"Подсчет записей... (всего {total_all:,})")
+        self.load_page_data()
+        self.update_info()
+
+        def work():
+            total, exact = progressive_count(self.collection, query, query_log=self.query_log)
+            stats = self.compute_filtered_column_stats(query, total) if exact else None
+            return total, exact, stats
+
+        def done(result):
+            total, exact, stats = result
+            # Пока считали, пользователь мог сменить фильтр или перейти к агрегации
+            if generation != self.refresh_generation or self.aggregation_mode:
+                return
+            self.total_records = total
+            self.count_lower_bound = not exact
+            self.view_counts = (counts_key, total, exact)
+            self.records_count_label.configure(text=self.count_text(total, total_all, exact))
+            if exact:
+                self.filtered_column_stats, self.filtered_distributions = stats
+                self.update_all_statistics()
+            self.update_info()
+
+        def failed(error):
+            print(f"Ошибка подсчета записей: {error}")
+            if generation == self.refresh_generation:
+                self.records_count_label.configure(text="Ошибка подсчета записей")
+
+        self.run_in_background(work, done, failed)
+
+    def sampling_population(self):
+        """Размер коллекции, если включена оценка и коллекция достаточно велика для выборки, иначе None"""
+        if self.sampling_var.get() != "true":
+            return None
+        from sampling import worth_sampling
+
+        population = self.collection.estimated_document_count()
+        return population if worth_sampling(population) else None
+
+    def load_data_estimated(self, query, population):
+        """Показывает оценку количества и заполненности по выборке, точные значения считает в фоне"""
+        from sampling import estimate_stats
+
+        generation = self.refresh_generation
+        try:
+            count, stats = estimate_stats(self.collection, query, self.all_columns, population,
+                                          query_log=self.query_log, validated=self.query_builder.validated)
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            # Выборка идет в потоке окна: по лимиту обрываем ее и ждем точных значений из фона
+            print(f"Оценка по выборке не уложилась в лимит времени: {e}")
+            self.records_count_label.configure(text="Подсчет записей (оценка не уложилась в лимит времени)...")
+        else:
+            self.total_records = round(count.value)
+            self.records_count_label.configure(
+                text=f"Найдено: {count} из ≈{population:,} записей (оценка, уточняется...)"
+            )
+            self.filtered_column_stats, self.filtered_distributions = stats, {}
+            self.update_all_statistics()
+
+        self.load_page_data()
+        self.update_info()
+
+        def work():
+            total_all = self.metadata.total_count()
+            if not query:
+                total = total_all
+            else:
+                with self.query_log.track("count", self.collection, query) as entry:
+                    total = self.collection.count_documents(query, **time_limit())
+                    entry['result_size'] = total
+            return total, total_all, self.metadata.version(), self.compute_filtered_column_stats(query, total)
+
+        def done(result):
+            total, total_all, version, column_stats = result
+            self.stats_cache.put(cache_key("counts", query, version), (total, total_all))
+            # Пока считали, пользователь мог сменить фильтр, страницу или перейти к агрегации
+            if generation != self.refresh_generation or self.aggregation_mode:
+                return
+            self.total_records = total
+            self.records_count_label.configure(text=f"Найдено: {total:,} из {total_all:,} записей")
+            self.filtered_column_stats, self.filtered_distributions = column_stats
+            self.update_all_statistics()
+            self.update_info()
+
+        def failed(error):
+            print(f"Ошибка подсчета записей: {error}")
+            if generation == self.refresh_generation and not self.aggregation_mode:
+                self.records_count_label.configure(
+                    text="Подсчет не уложился в лимит времени (NISSAN_MAX_TIME_MS)" if is_timeout(error)
+                    else "Ошибка подсчета записей")
+
+        self.run_in_background(work, done, failed)
+
     def load_page_data(self):
-        skip = self.current_page * self.page_size
         query = self.build_query()
 
         try:
-            sort_spec = []
-            if self.sort_column:
-                sort_spec = [(self.sort_column, self.sort_direction)]
+            sort_spec = self.build_sort_spec()
+            key = self.page_key(query, sort_spec, self.current_page)
+
+            # Страница могла быть загружена заранее (соседняя или первая в обратной сортировке)
+            data = self.page_prefetcher.get(key)
+            if data is None:
+                data = self.fetch_page_rows(query, sort_spec, self.current_page, self.page_size)
+                self.page_prefetcher.put(key, data)
+
+            # Создаем строки с данными
+            self.create_table_rows(data)
+            self.prefetch_pages(query, sort_spec)
+
+        except Exception as e:
+            print(f"Ошибка загрузки данных: {e}")
+            # Очищаем таблицу в случае ошибки
+            self.table_renderer.clear()
 
-            cursor = self.collection.find(query, {'_id': 0})
+    def page_key(self, query, sort_spec, page):
+        version = self.metadata.version() if self.metadata is not None else None
+        return page_key(query, sort_spec, page, self.page_size, version, self.all_columns)
+
+    def fetch_page_rows(self, query, sort_spec, page, page_size):
+        """Строки страницы для таблицы (без обращений к Tk: вызывается и из потока предзагрузки)"""
+        with self.query_log.track("find", self.collection, query) as entry:
+            # Большие сортировки без индекса могут сбрасываться на диск вместо ошибки по памяти
+            cursor = self.collection.find(query, document_projection(), allow_disk_use=bool(sort_spec))
+            cursor = limit_cursor(cursor)
 
             if sort_spec:
                 cursor = cursor.sort(sort_spec)
 
-            cursor = cursor.skip(skip).limit(self.page_size)
+            cursor = cursor.skip(page * page_size).limit(page_size)
 
             # Преобразуем данные в формат для отображения
             data = []
+            columns = list(self.all_columns)
+            validated = self.query_builder.validated
             for record in cursor:
+                if validated:
+                    # NaN в проверенной коллекции не бывает
+                    data.append({col: record.get(col, '') for col in columns})
+                    continue
                 row_data = {}
-                for col in self.all_columns:
+                for col in columns:
                     val = record.get(col, '')
                     # Обработка nan значений
                     if isinstance(val, float) and math.isnan(val):
                         val = None
                     row_data[col] = val
                 data.append(row_data)
+            entry['result_size'] = len(data)
+        return data
 
-            # Создаем строки с данными
-            self.create_table_rows(data)
+    def prefetch_pages(self, query, sort_spec):
+        """Ставит в очередь предзагрузки следующую и предыдущую страницы и первую страницу обратной сортировки"""
+        total_pages = max(1, (self.total_records + self.page_size - 1) // self.page_size)
+        requests = []
+        for page in (self.current_page + 1, self.current_page - 1):
+            if 0 <= page < total_pages:
+                requests.append((self.page_key(query, sort_spec, page), query, sort_spec, page, self.page_size))
+        # Повторный клик по заголовку при сортировке по одной колонке меняет направление
+        if self.prefetch_reversed and len(self.sort_spec) == 1:
+            reverse = reversed_sort(sort_spec)
+            requests.append((self.page_key(query, reverse, 0), query, reverse, 0, self.page_size))
+        self.page_prefetcher.schedule(requests)
+
+    def build_sort_spec(self):
+        """Возвращает спецификацию сортировки для find: выбранные колонки и уникальный id в конце"""
+        return with_tiebreaker(self.sort_spec)
+
+    def current_sort_symbols(self):
+        """Значки сортировки для заголовков (в режиме агрегации - одна колонка)"""
+        if self.aggregation_mode:
+            return sort_symbols([(self.sort_column, self.sort_direction)] if self.sort_column else [])
+        return sort_symbols(self.sort_spec)
 
+    def check_sort_index(self):
+        """Предупреждает о сортировке большого результата без подходящего индекса и предлагает создать его"""
+        sort_spec = self.build_sort_spec()
+        if not sort_spec or self.sort_index_advisor is None or self.total_records < SORT_INDEX_WARN_ROWS:
+            return
+        if tuple(sort_spec) in self.sort_index_asked:
+            return
+        try:
+            if self.sort_index_advisor.supporting_index(sort_spec, self.build_query()) is not None:
+                return
         except Exception as e:
-            print(f"Ошибка загрузки данных: {e}")
-            # Очищаем таблицу в случае ошибки
-            for item in self.tree.get_children():
-                self.tree.delete(item)
+            print(f"Не удалось прочитать индексы коллекции: {e}")
+            return
 
-    def update_info(self):
-        if self.aggregation_mode:
+        self.sort_index_asked.add(tuple(sort_spec))
+        order = ", ".join(f"{col} {'↑' if direction == 1 else '↓'}" for col, direction in sort_spec)
+        if not messagebox.askyesno(
+                "Сортировка без индекса",
+                f"Для сортировки ({order}) нет подходящего индекса: сервер сортирует "
+                f"{self.total_records:,} записей в памяти, а большие сортировки упираются в ее ограничение.\n\n"
+                f"Создать составной индекс?"):
             return
 
+        def done(name):
+            messagebox.showinfo("Индекс", f"Индекс {name} создан")
+
+        def failed(error):
+            messagebox.showerror("Ошибка", f"Не удалось создать индекс: {error}")
+
+        self.run_in_background(lambda: self.sort_index_advisor.create_index(sort_spec), done, failed)
+
+    def update_info(self):
         total_pages = max(1, (self.total_records + self.page_size - 1) // self.page_size)
         current_page = min(self.current_page + 1, total_pages)
 
-        self.page_label.configure(text=f"Страница {current_page} из {total_pages}")
+        # При нижней границе количества страниц может быть больше
+        more = "+" if self.count_lower_bound and not self.aggregation_mode else ""
+        self.page_label.configure(text=f"Страница {current_page} из {total_pages}{more}")
 
         # Обновляем значения в комбобоксе страниц
         page_values = [str(i) for i in range(1, total_pages + 1)]
@@ -1906,43 +2361,140 @@ class EnhancedNissanGUI:
         try:
             self.page_size = int(value)
             self.current_page = 0
-            self.load_data()
+            self.reload_current_page()
         except:
             pass
 
+    def reload_current_page(self):
+        """Перезагружает текущую страницу записей или групп агрегации"""
+        if self.aggregation_mode:
+            self.load_aggregation_page()
+        else:
+            self.load_data()
+
     def change_page(self, page_num):
         total_pages = max(1, (self.total_records + self.page_size - 1) // self.page_size)
         if 0 <= page_num < total_pages:
-            self.current_page = page_num
-            self.load_data()
+            self.show_page(page_num)
+
+    def show_page(self, page_num):
+        """Переход на страницу: если запрос и коллекция не менялись, количество и статистика не пересчитываются,
+        а страница берется из буфера предзагрузки"""
+        self.current_page = page_num
+        if (self.aggregation_mode or self.serving_from_snapshot or self.view_counts is None
+                or self.metadata is None):
+            self.reload_current_page()
+            return
+
+        query = self.build_query()
+        if self.view_counts[0] != cache_key("counts", query, self.metadata.version()):
+            self.reload_current_page()
+            return
+
+        self.refresh_generation += 1
+        self.load_page_data()
+        self.update_info()
 
     def prev_page(self):
         if self.current_page > 0:
-            self.current_page -= 1
-            self.load_data()
+            self.show_page(self.current_page - 1)
 
     def next_page(self):
         total_pages = max(1, (self.total_records + self.page_size - 1) // self.page_size)
-        if self.current_page < total_pages - 1:
-            self.current_page += 1
-            self.load_data()
+        # Количество известно только снизу - за последней известной страницей могут быть еще записи
+        if self.current_page < total_pages - 1 or self.count_lower_bound:
+            self.show_page(self.current_page + 1)
 
     def last_page(self):
         total_pages = max(1, (self.total_records + self.page_size - 1) // self.page_size)
         self.change_page(total_pages - 1)
 
+    def start_export(self):
+        """Потоково выгружает текущий отфильтрованный вид (с сортировкой) в CSV, JSONL или Parquet"""
+        if not self.backend_ready:
+            return
+        if self.aggregation_mode:
+            messagebox.showwarning("Предупреждение", "Сбросьте агрегацию, чтобы экспортировать записи")
+            return
+
+        path = filedialog.asksaveasfilename(
+            title="Экспорт данных",
+            defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("JSON Lines", "*.jsonl"), ("Parquet", "*.parquet")]
+        )
+        if not path:
+            return
+
+        query = self.build_query()
+        sort_spec = self.build_sort_spec()
+        total = self.total_records
+        state = {'written': 0, 'done': False, 'error': None, 'cancelled': False}
+        cancel_event = threading.Event()
+
+        # Окно прогресса с кнопкой отмены
+        dialog = ctk.CTkToplevel(self.root)
+        dialog.title("Экспорт")
+        dialog.geometry("420x150")
+        dialog.transient(self.root)
+
+        ctk.CTkLabel(dialog, text=path, wraplength=380).pack(padx=20, pady=(15, 5))
+        progress_bar = ctk.CTkProgressBar(dialog, width=380)
+        progress_bar.set(0)
+        progress_bar.pack(padx=20, pady=5)
+        progress_label = ctk.CTkLabel(dialog, text=f"0 из {total:,}")
+        progress_label.pack(padx=20)
+        ctk.CTkButton(dialog, text="Отмена", width=100, command=cancel_event.set).pack(pady=(5, 10))
+        dialog.protocol("WM_DELETE_WINDOW", cancel_event.set)
+
+        def on_progress(written):
+            state['written'] = written
+
+        def worker():
+            try:
+                export_query(self.collection, query, path, fmt=format_from_path(path), sort_spec=sort_spec,
+                             columns=self.all_columns or None, progress=on_progress,
+                             cancel_event=cancel_event, query_log=self.query_log,
+                             column_types=dict(self.column_types))
+            except ExportCancelled:
+                state['cancelled'] = True
+            except Exception as e:
+                state['error'] = e
+            finally:
+                state['done'] = True
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(200, lambda: self.poll_export(dialog, progress_bar, progress_label, state, total, path))
+
+    def poll_export(self, dialog, progress_bar, progress_label, state, total, path):
+        """Обновляет окно прогресса экспорта из главного потока"""
+        written = state['written']
+        if total > 0:
+            progress_bar.set(min(1.0, written / total))
+        progress_label.configure(text=f"{written:,} из {total:,}")
+
+        if not state['done']:
+            self.root.after(200, lambda: self.poll_export(dialog, progress_bar, progress_label, state, total, path))
+            return
+
+        dialog.destroy()
+        if state['error'] is not None:
+            print(f"Ошибка экспорта: {state['error']}")
+            messagebox.showerror("Ошибка", f"Ошибка экспорта: {str(state['error'])}")
+        elif state['cancelled']:
+            messagebox.showinfo("Экспорт", "Экспорт отменен")
+        else:
+            messagebox.showinfo("Экспорт", f"Выгружено {written:,} записей в {path}")
+
     def apply_search(self):
         self.current_page = 0
         self.load_data()
 
-    def apply_sort(self, column, direction):
-        if self.sort_column == column:
-            self.sort_direction *= -1
-        else:
-            self.sort_column = column
-            self.sort_direction = 1
+    def apply_sort(self, column, additive=False):
+        self.sort_spec = toggle_sort(self.sort_spec, column, additive)
+        self.sort_column, self.sort_direction = self.sort_spec[0]
 
         self.load_data()
+        self.check_sort_index()
 
     def clear_all_filters(self):
         # Очищаем все условия во всех фильтрах (оставляем только по одному пустому условию)
@@ -1967,6 +2519,7 @@ class EnhancedNissanGUI:
         self.search_entry.delete(0, 'end')
         self.sort_column = None
         self.sort_direction = 1
+        self.sort_spec = []
         self.current_page = 0
         self.load_data()
 
@@ -0,0 +1,67 @@
+import queue
+import threading
+
+from result_cache import ResultCache, cache_key
+
+
+PREFETCH_PAGES = 8  # Емкость буфера: текущая, соседние и первая страница обратной сортировки с запасом
+PAGE_TTL_SECONDS = 60  # Страницы из буфера не старше минуты (коллекция могла измениться без смены отметки)
+
+
+def page_key(query, sort_spec, page, page_size, version=None, columns=None):
+    """Ключ страницы: запрос, сортировка, номер, размер, версия коллекции и набор колонок"""
+    return cache_key("page", query, sort_spec, page, page_size, version, columns)
+
+
+def reversed_sort(sort_spec):
+    return [(col, -direction) for col, direction in sort_spec]
+
+
+class PagePrefetcher:
+    """Загружает страницы в фоне в небольшой буфер (LRU с временем жизни).
+
+    fetch(query, sort_spec, page, page_size) выполняется в одном фоновом потоке по очереди.
+    Каждый schedule начинает новое поколение: задания прежних поколений, до которых очередь
+    еще не дошла, пропускаются, чтобы после смены фильтра поток не читал ненужные страницы.
+    """
+
+    def __init__(self, fetch, max_pages=PREFETCH_PAGES, ttl_seconds=PAGE_TTL_SECONDS):
+        self.fetch = fetch
+        self.buffer = ResultCache(max_entries=max_pages, ttl_seconds=ttl_seconds)
+        self._queue = queue.Queue()
+        self._generation = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.buffer.get(key)
+
+    def put(self, key, rows):
+        self.buffer.put(key, rows)
+
+    def schedule(self, requests):
+        """requests: [(ключ, query, sort_spec, page, page_size)]; страницы, уже лежащие в буфере, пропускаются"""
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="page-prefetch", daemon=True)
+                self._thread.start()
+        for request in requests:
+            if request[0] not in self.buffer:
+                self._queue.put((generation, request))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+        self.buffer.invalidate()
+
+    def _run(self):
+        while True:
+            generation, (key, *args) = self._queue.get()
+            if generation != self._generation or key in self.buffer:
+                continue
+            try:
+                self.buffer.put(key, self.fetch(*args))
+            except Exception as e:
+                print(f"Ошибка предзагрузки страницы: {e}")
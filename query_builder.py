@@ -0,0 +1,828 @@
+import re
+import sys
+from decimal import Decimal, InvalidOperation
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from query_timeouts import is_timeout
+from shadow_fields import shadow_path
+from type_registry import NUMBER, TypeRegistry
+
+
+# Поля, которые хранятся в базе как числа (пока типы не определены по схеме)
+NUMERIC_FIELDS = ['id', 'age', 'performance', 'km', 'price']
+
+# Условие, которое заведомо не выполняется ни для одного документа (по статистике колонок);
+# MongoDB отвечает на него по индексу _id без чтения документов
+IMPOSSIBLE_QUERY = {"_id": {"$in": []}}
+# Символы строкового представления чисел: искать по ним текст без этих символов бессмысленно
+NUMBER_TEXT_CHARS = set("0123456789.-+e")
+REGEX_SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+# Повторение с верхней границей больше этой считается неограниченным при проверке вложенности
+UNSAFE_REPEAT = 100
+
+# Операторы сравнения, доступные в фильтрах
+OPERATORS = ["равно", "не равно", "больше", "больше или равно",
+             "меньше", "меньше или равно", "в списке", "не в списке",
+             "содержит", "не содержит", "начинается с", "заканчивается на",
+             "regex содержит", "regex не содержит", "похоже на"]
+
+# Логические операторы между условиями одной колонки
+LOGIC_OPERATORS = ["И", "ИЛИ", "НЕ"]
+
+# Человеческие названия агрегационных функций и соответствующие операторы MongoDB
+AGGREGATION_FUNCTIONS = {
+    "сумма": "$sum",
+    "среднее": "$avg",
+    "минимум": "$min",
+    "максимум": "$max",
+    "первое значение": "$first",
+    "последнее значение": "$last",
+    "все значения": "$push",
+    "уникальные значения": "$addToSet",
+    "количество": "$count",
+    "выборочная дисперсия": "$stdDevPop",
+    "генерируемая дисперсия": "$stdDevSamp",
+    # Приближенные функции считаются по скетчам (sketches.py), а не оператором MongoDB
+    "≈ уникальных": "~distinct",
+    "≈ медиана": "~p50",
+    "≈ p95": "~p95",
+    "≈ p99": "~p99"
+}
+
+# Названия функций для заголовков колонок с результатами
+AGGREGATION_DISPLAY_NAMES = {
+    "сумма": "Сумма",
+    "среднее": "Среднее",
+    "минимум": "Минимум",
+    "максимум": "Максимум",
+    "первое значение": "Первое",
+    "последнее значение": "Последнее",
+    "все значения": "Все значения",
+    "уникальные значения": "Уникальные",
+    "выборочная дисперсия": "Выб. дисперсия",
+    "генерируемая дисперсия": "Ген. дисперсия",
+    "≈ уникальных": "≈Уникальных",
+    "≈ медиана": "≈Медиана",
+    "≈ p95": "≈p95",
+    "≈ p99": "≈p99"
+}
+
+
+# Функции, возвращающие массивы значений; в интерфейсе показывается только начало массива
+ARRAY_FUNCTIONS = ["$push", "$addToSet"]
+ARRAY_PREVIEW_SIZE = 20
+
+
+class UnsafeRegexError(re.error):
+    """Регулярное выражение с катастрофическим перебором (вложенные неограниченные квантификаторы)"""
+
+
+class QueryError(ValueError):
+    """Условие фильтра нельзя выполнить: оно пропускается, построитель сообщает через on_query_error"""
+
+
+def print_regex_error(error):
+    print(f"Некорректное регулярное выражение: {error}")
+
+
+def print_query_error(error):
+    # В stderr: в консольной утилите stdout - поток данных
+    print(f"Условие пропущено: {error}", file=sys.stderr)
+
+
+def has_nested_quantifier(items, inside=False):
+    """Есть ли в разобранном выражении неограниченное повторение внутри другого: (a+)+, (\\w+\\s?)*.
+
+    На несовпадающей строке такие выражения перебирают экспоненциальное число разбиений.
+    Атомарные группы и притяжательные квантификаторы не откатываются - их не проверяем.
+    """
+    for op, av in items:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, body = av
+            unbounded = high == sre_parse.MAXREPEAT or high > UNSAFE_REPEAT
+            if (unbounded and inside) or has_nested_quantifier(body, inside or unbounded):
+                return True
+        elif op == sre_parse.SUBPATTERN:
+            if has_nested_quantifier(av[-1], inside):
+                return True
+        elif op == sre_parse.BRANCH:
+            if any(has_nested_quantifier(branch, inside) for branch in av[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if has_nested_quantifier(av[1], inside):
+                return True
+    return False
+
+
+def check_regex(pattern):
+    """Проверяет выражение до отправки на сервер: re.error для некорректного, UnsafeRegexError для опасного"""
+    if has_nested_quantifier(sre_parse.parse(pattern)):
+        raise UnsafeRegexError(f"вложенные квантификаторы в {pattern!r} могут выполняться экспоненциально долго")
+
+
+def is_impossible(query):
+    return query == IMPOSSIBLE_QUERY
+
+
+def could_match_number(text):
+    """Может ли текст (без спецсимволов regex) встретиться в строковой записи числа"""
+    text = text.lower()
+    return set(text) <= NUMBER_TEXT_CHARS or text in "nan" or text in "infinity"
+
+
+def group_filters(filters):
+    """Группирует условия (логика, колонка, оператор, значение) по колонкам в формат build_query"""
+    grouped = {}
+    for logic, col, operator, value in filters or []:
+        value_conditions, logic_operators = grouped.setdefault(col, ([], []))
+        # Для первого условия колонки логический оператор не нужен
+        if value_conditions:
+            logic_operators.append(logic)
+        value_conditions.append({'value': value, 'operator': operator})
+    return [(col, conditions, logic) for col, (conditions, logic) in grouped.items()]
+
+
+class QueryBuilder:
+    """Строит MongoDB запросы из условий фильтрации независимо от интерфейса"""
+
+    def __init__(self, columns=None, numeric_fields=None, on_regex_error=None, validated=False, registry=None,
+                 shadow_columns=None, fuzzy=None, on_query_error=None):
+        self.columns = list(columns or [])
+        # Типы и статистика колонок: выбор числовых условий и отсечение заведомо ложных
+        self.registry = registry or TypeRegistry.from_numeric_fields(
+            numeric_fields if numeric_fields is not None else NUMERIC_FIELDS)
+        self.on_regex_error = on_regex_error or print_regex_error
+        # Условия, которые нельзя выполнить (QueryError), например "похоже на" без индекса триграмм
+        self.on_query_error = on_query_error or print_query_error
+        # Коллекция загружена через validation.py: пропуски хранятся только как null,
+        # категории - в каноническом написании
+        self.validated = validated
+        # Колонки с теневыми полями (shadow_fields.py): строка значения в нижнем регистре с индексом
+        self.shadow_columns = set(shadow_columns or [])
+        # Индексы триграмм для "похоже на" (fuzzy.FuzzyIndexes)
+        self.fuzzy = fuzzy
+
+    def build_query(self, column_filters, search_value=""):
+        """Строит запрос из списка (колонка, условия значений, логические операторы) и глобального поиска"""
+        final_query = {}
+
+        filter_parts = []
+        for col, value_conditions, logic_operators in column_filters:
+            # Пропускаем пустые условия
+            if not col or not value_conditions:
+                continue
+
+            # Строим условие с учетом логических операторов между значениями
+            condition_dict = self.build_value_conditions(col, value_conditions, logic_operators)
+
+            if condition_dict:
+                filter_parts.append(condition_dict)
+
+        # Заведомо ложное условие делает ложным весь запрос
+        if any(is_impossible(part) for part in filter_parts):
+            return IMPOSSIBLE_QUERY
+
+        # Если есть условия фильтрации, объединяем их через И
+        if filter_parts:
+            if len(filter_parts) == 1:
+                final_query = filter_parts[0]
+            else:
+                final_query = {"$and": filter_parts}
+
+        # Затем применяем глобальный поиск по всем полям
+        search_value = (search_value or "").strip()
+        if search_value:
+            search_query = self.build_search_conditions(search_value)
+            if is_impossible(search_query):
+                return IMPOSSIBLE_QUERY
+            if search_query:
+                # Если уже есть условия фильтрации, объединяем с поиском через И
+                if final_query:
+                    final_query = {"$and": [final_query, search_query]}
+                else:
+                    final_query = search_query
+
+        return final_query
+
+    def build_search_conditions(self, search_value):
+        """Строит условия поиска по всем полям с поддержкой регулярных выражений"""
+        if not search_value:
+            return None
+
+        try:
+            # Всегда используем режим regex для поиска
+            is_regex = True
+
+            # Проверяем, является ли значение валидным регулярным выражением
+            try:
+                check_regex(search_value)
+                # Это валидное регулярное выражение
+                pattern = search_value
+                is_valid_regex = True
+            except UnsafeRegexError as e:
+                # Опасное выражение на сервер не отправляем: предупреждаем и ищем как обычный текст
+                self.on_regex_error(e)
+                pattern = re.escape(search_value)
+                is_valid_regex = False
+            except:
+                # Не валидное regex, используем как обычный текст
+                pattern = re.escape(search_value)
+                is_valid_regex = False
+
+            # Простой текст без цифр не найдется в числах: $toString по чисто числовым колонкам не нужен
+            is_literal = not REGEX_SPECIAL.search(search_value)
+            skip_numbers = is_literal and not could_match_number(search_value)
+
+            # Создаем список условий для поиска по всем полям
+            or_conditions = []
+
+            # Для числовых полей нужно специальное условие для regex
+            for col in self.columns:
+                if skip_numbers and self.registry.kind(col) == NUMBER:
+                    continue
+                if col in self.shadow_columns and (is_literal or self.registry.is_numeric(col)):
+                    # Простой текст - без флага i по строке в нижнем регистре, regex по числам - без $toString
+                    or_conditions.append(self.shadow_regex(col, pattern, ignore_case=not is_literal))
+                elif self.registry.is_numeric(col):
+                    # Для числовых полей преобразуем в строку для regex поиска
+                    if is_valid_regex:
+                        # Для валидных regex создаем условие $toString для преобразования числа в строку
+                        or_conditions.append({
+                            "$expr": {
+                                "$regexMatch": {
+                                    "input": {"$toString": f"${col}"},
+                                    "regex": pattern,
+                                    "options": "i"
+                                }
+                            }
+                        })
+                    else:
+                        # Для простого текста используем прямое сравнение через $regex
+                        or_conditions.append({
+                            "$expr": {
+                                "$regexMatch": {
+                                    "input": {"$toString": f"${col}"},
+                                    "regex": pattern,
+                                    "options": "i"
+                                }
+                            }
+                        })
+                else:
+                    # Для текстовых полей используем обычный regex поиск
+                    if is_valid_regex:
+                        or_conditions.append({col: {"$regex": pattern, "$options": "i"}})
+                    else:
+                        or_conditions.append({col: {"$regex": pattern, "$options": "i"}})
+
+            # Если есть условия поиска, возвращаем их
+            if or_conditions:
+                return {"$or": or_conditions}
+            elif self.columns:
+                # Все колонки отсечены по типу - совпадений нет
+                return IMPOSSIBLE_QUERY
+            else:
+                return None
+
+        except Exception as e:
+            print(f"Ошибка построения условий поиска: {e}")
+            # Возвращаем простой regex поиск по всем полям
+            or_conditions = []
+            for col in self.columns:
+                or_conditions.append({col: {"$regex": search_value, "$options": "i"}})
+
+            return {"$or": or_conditions} if or_conditions else None
+
+    def build_value_conditions(self, col, value_conditions, logic_operators):
+        """Строит условия для колонки с учетом операторов сравнения и логических операторов между значениями"""
+        if not col or not value_conditions:
+            return None
+
+        try:
+            # Если только одно условие
+            if len(value_conditions) == 1:
+                vc = value_conditions[0]
+                return self.build_single_condition(col, vc['operator'], vc['value'])
+
+            # Если несколько условия, объединяем их с учетом логических операторов
+            conditions = []
+
+            for vc in value_conditions:
+                condition = self.build_single_condition(col, vc['operator'], vc['value'])
+                if condition:
+                    conditions.append(condition)
+
+            if not conditions:
+                return None
+
+            if len(conditions) == 1:
+                return conditions[0]
+
+            # Объединяем условия с учетом логических операторов
+            combined_condition = conditions[0]
+
+            for i in range(1, len(conditions)):
+                if i - 1 < len(logic_operators):
+                    logic = logic_operators[i - 1]
+                else:
+                    logic = "И"  # По умолчанию
+
+                # Заведомо ложные условия: И дает ложь, ИЛИ берет другую часть, НЕ ничего не отсекает
+                if is_impossible(conditions[i]):
+                    if logic == "И":
+                        combined_condition = IMPOSSIBLE_QUERY
+                    continue
+                if is_impossible(combined_condition):
+                    if logic == "ИЛИ":
+                        combined_condition = conditions[i]
+                    continue
+
+                if logic == "И":
+                    combined_condition = {"$and": [combined_condition, conditions[i]]}
+                elif logic == "ИЛИ":
+                    combined_condition = {"$or": [combined_condition, conditions[i]]}
+                elif logic == "НЕ":
+                    combined_condition = {"$and": [combined_condition, {"$not": conditions[i]}]}
+
+            return combined_condition
+
+        except Exception as e:
+            print(f"Ошибка построения условий: {e}")
+            return None
+
+    @staticmethod
+    def shadow_regex(col, pattern, ignore_case=False):
+        """Регулярное выражение по теневому полю; без ignore_case шаблон приводится к нижнему регистру"""
+        if ignore_case:
+            return {shadow_path(col): {"$regex": pattern, "$options": "i"}}
+        return {shadow_path(col): {"$regex": pattern.lower()}}
+
+    @staticmethod
+    def negate(condition):
+        """{поле: {"$not": условие}}: документы без поля (пустые значения) тоже подходят, как и по исходным полям"""
+        (path, regex), = condition.items()
+        return {path: {"$not": regex}}
+
+    def build_single_condition(self, col, operator, value):
+        """Строит одно условие для MongoDB с обработкой числовых значений и регулярных выражений"""
+        if not col or not value:
+            return None
+
+        try:
+            # Проверяем специальные значения
+            if value.lower() in ["nan", "null", "none", "[пусто]", ""]:
+                # Обработка пустых значений
+                if self.validated and operator in ("равно", "не равно"):
+                    return {col: None} if operator == "равно" else {col: {"$ne": None}}
+                if operator == "равно":
+                    return {"$or": [
+                        {col: None},
+                        {col: {"$type": "null"}},
+                        {col: float('nan')}
+                    ]}
+                elif operator == "не равно":
+                    return {"$nor": [
+                        {col: None},
+                        {col: {"$type": "null"}},
+                        {col: float('nan')}
+                    ]}
+                else:
+                    return None
+
+            # Определяем, является ли поле числовым
+            is_numeric_field = self.registry.is_numeric(col)
+            canonical = self.canonical_value if self.validated else (lambda _, val: val)
+
+            # Для операторов "regex содержит" и "regex не содержит" - всегда используем regex
+            if operator in ["regex содержит", "regex не содержит"]:
+                try:
+                    # Проверяем валидность regex и отсутствие катастрофического перебора
+                    check_regex(value)
+
+                    if is_numeric_field and col in self.shadow_columns:
+                        # Строка числа уже хранится в теневом поле: regex без $expr
+                        condition = self.shadow_regex(col, value, ignore_case=True)
+                        return condition if operator == "regex содержит" else self.negate(condition)
+                    elif is_numeric_field:
+                        # Для числовых полей используем $toString для преобразования в строку
+                        if operator == "regex содержит":
+                            return {
+                                "$expr": {
+                                    "$regexMatch": {
+                                        "input": {"$toString": f"${col}"},
+                                        "regex": value,
+                                        "options": "i"
+                                    }
+                                }
+                            }
+                        else:  # "regex не содержит"
+                            return {
+                                "$expr": {
+                                    "$not": {
+                                        "$regexMatch": {
+                                            "input": {"$toString": f"${col}"},
+                                            "regex": value,
+                                            "options": "i"
+                                        }
+                                    }
+                                }
+                            }
+                    else:
+                        # Для текстовых полей используем обычный regex
+                        if operator == "regex содержит":
+                            return {col: {"$regex": value, "$options": "i"}}
+                        else:  # "regex не содержит"
+                            return {col: {"$not": {"$regex": value, "$options": "i"}}}
+
+                except re.error as e:
+                    self.on_regex_error(e)
+                    return None
+
+            # Для текстовых операторов (содержит, не содержит, начинается с, заканчивается на)
+            elif operator in ["содержит", "не содержит", "начинается с", "заканчивается на"]:
+                # Создаем pattern в зависимости от оператора
+                if operator == "содержит":
+                    pattern = re.escape(value)
+                elif operator == "не содержит":
+                    pattern = re.escape(value)
+                elif operator == "начинается с":
+                    pattern = "^" + re.escape(value)
+                elif operator == "заканчивается на":
+                    pattern = re.escape(value) + "$"
+
+                if col in self.shadow_columns:
+                    # Регистр уже снят в теневом поле: "начинается с" - якорь без флага i, диапазон по индексу
+                    condition = self.shadow_regex(col, pattern)
+                    return self.negate(condition) if operator == "не содержит" else condition
+                elif is_numeric_field:
+                    # Для числовых полей преобразуем в строку
+                    if operator == "не содержит":
+                        return {
+                            "$expr": {
+                                "$not": {
+                                    "$regexMatch": {
+                                        "input": {"$toString": f"${col}"},
+                                        "regex": pattern,
+                                        "options": "i"
+                                    }
+                                }
+                            }
+                        }
+                    else:
+                        return {
+                            "$expr": {
+                                "$regexMatch": {
+                                    "input": {"$toString": f"${col}"},
+                                    "regex": pattern,
+                                    "options": "i"
+                                }
+                            }
+                        }
+                else:
+                    # Для текстовых полей используем обычный regex
+                    if operator == "не содержит":
+                        return {col: {"$not": {"$regex": pattern, "$options": "i"}}}
+                    else:
+                        return {col: {"$regex": pattern, "$options": "i"}}
+
+            # Для числовых операторов (равно, не равно, больше, меньше и т.д.)
+            elif operator in ["равно", "не равно", "больше", "больше или равно", "меньше", "меньше или равно"]:
+                # Пробуем преобразовать в число
+                is_numeric_value = False
+                numeric_value = None
+
+                try:
+                    # Убираем возможные пробелы и запятые
+                    clean_value = value.replace(' ', '').replace(',', '')
+                    # Пробуем преобразовать в Decimal
+                    numeric_value = Decimal(clean_value)
+                    if numeric_value == numeric_value.to_integral_value():
+                        numeric_value = int(numeric_value)
+                    else:
+                        numeric_value = float(numeric_value)
+                    is_numeric_value = True
+                except (ValueError, InvalidOperation):
+                    is_numeric_value = False
+
+                # Если значение числовое и поле числовое
+                if is_numeric_field and is_numeric_value:
+                    operator_map = {
+                        "равно": "$eq",
+                        "не равно": "$ne",
+                        "больше": "$gt",
+                        "больше или равно": "$gte",
+                        "меньше": "$lt",
+                        "меньше или равно": "$lte"
+                    }
+
+                    if operator in operator_map:
+                        if self.registry.impossible_comparison(col, operator_map[operator], numeric_value):
+                            return IMPOSSIBLE_QUERY
+                        return {col: {operator_map[operator]: numeric_value}}
+
+                # Если значение не числовое или поле не числовое
+                else:
+                    # Используем строковое сравнение
+                    if operator == "равно":
+                        if self.registry.impossible_comparison(col, "$eq", canonical(col, value)):
+                            return IMPOSSIBLE_QUERY
+                        return {col: canonical(col, value)}
+                    elif operator == "не равно":
+                        return {col: {"$ne": canonical(col, value)}}
+                    else:
+                        # Для других операторов с нечисловыми значениями возвращаем None
+                        return None
+
+            # Для операторов списка
+            elif operator in ["в списке", "не в списке"]:
+                # Разделяем значения, если они введены через запятую
+                if ',' in value:
+                    values_list = [v.strip() for v in value.split(',')]
+                else:
+                    values_list = [value]
+
+                # Преобразуем числовые значения если поле числовое
+                final_values = []
+                for val in values_list:
+                    if is_numeric_field:
+                        try:
+                            clean_val = val.replace(' ', '').replace(',', '')
+                            num_val = Decimal(clean_val)
+                            if num_val == num_val.to_integral_value():
+                                final_values.append(int(num_val))
+                            else:
+                                final_values.append(float(num_val))
+                        except (ValueError, InvalidOperation):
+                            final_values.append(val)
+                    else:
+                        final_values.append(canonical(col, val))
+
+                if operator == "в списке":
+                    if self.registry.impossible_membership(col, final_values):
+                        return IMPOSSIBLE_QUERY
+                    return {col: {"$in": final_values}}
+                else:  # "не в списке"
+                    return {col: {"$nin": final_values}}
+
+            # Нечеткий поиск: похожие значения находятся по индексу триграмм, в базу уходит точный $in
+            elif operator == "похоже на":
+                try:
+                    matches = self.fuzzy.search(col, value) if self.fuzzy is not None else None
+                except Exception as e:
+                    if not is_timeout(e):
+                        raise
+                    self.on_query_error(QueryError(f"индекс триграмм по колонке {col} не построен "
+                                                   f"за лимит времени (NISSAN_MAX_TIME_MS)"))
+                    return None
+                if matches is None:
+                    self.on_query_error(QueryError(f"нечеткий поиск по колонке {col} недоступен "
+                                                   f"(нет индекса триграмм или он еще строится)"))
+                    return None
+                if not matches:
+                    return IMPOSSIBLE_QUERY
+                return {col: {"$in": [match_value for match_value, _, _ in matches]}}
+
+            else:
+                return None
+
+        except Exception as e:
+            print(f"Ошибка построения условия для {col} с оператором {operator} и значением {value}: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+    @staticmethod
+    def canonical_value(col, value):
+        """Значение категории в написании, в котором оно хранится после проверки при импорте"""
+        from validation import canonical_value
+
+        return canonical_value(col, value)
+
+
+
+def metric_name(agg_func, agg_col):
+    """Заголовок колонки результата для метрики (функция, колонка)"""
+    if AGGREGATION_FUNCTIONS.get(agg_func) == "$count":
+        return "Количество"
+    func_display = AGGREGATION_DISPLAY_NAMES.get(agg_func, agg_func)
+    return f"{func_display}({agg_col})"
+
+
+def normalize_metrics(metrics):
+    """Убирает повторяющиеся метрики; ValueError, если функция требует колонку, а она не выбрана"""
+    result = []
+    for agg_func, agg_col in metrics:
+        if AGGREGATION_FUNCTIONS.get(agg_func, "$sum") != "$count" and not agg_col:
+            raise ValueError("Выберите колонку для агрегации")
+        metric = (agg_func, agg_col if AGGREGATION_FUNCTIONS.get(agg_func) != "$count" else "")
+        if metric not in result:
+            result.append(metric)
+    if not result:
+        raise ValueError("Добавьте хотя бы одну агрегационную функцию")
+    return result
+
+
+def metric_expression(agg_func, agg_col):
+    """Выражение аккумулятора $group для одной метрики"""
+    mongo_func = AGGREGATION_FUNCTIONS.get(agg_func, "$sum")
+
+    if mongo_func == "$count":
+        return {"$sum": 1}
+    if mongo_func in ["$stdDevPop", "$stdDevSamp"]:
+        # Для стандартного отклонения фильтруем числовые значения
+        return {
+            mongo_func: {
+                "$cond": {
+                    "if": {"$and": [
+                        {"$ne": [f"${agg_col}", None]},
+                        {"$ne": [{"$type": f"${agg_col}"}, "null"]},
+                        {"$in": [{"$type": f"${agg_col}"}, ["double", "int", "long", "decimal"]]}
+                    ]},
+                    "then": f"${agg_col}",
+                    "else": None
+                }
+            }
+        }
+    # Для остальных функций просто применяем оператор
+    return {mongo_func: f"${agg_col}"}
+
+
+def metric_size_name(agg_func, agg_col):
+    """Заголовок колонки с полным размером обрезанного массива"""
+    return f"{metric_name(agg_func, agg_col)} (всего)"
+
+
+def is_array_metric(agg_func):
+    return AGGREGATION_FUNCTIONS.get(agg_func) in ARRAY_FUNCTIONS
+
+
+def is_approximate_metric(agg_func):
+    return AGGREGATION_FUNCTIONS.get(agg_func, "").startswith("~")
+
+
+def has_approximate_metrics(metrics):
+    return any(is_approximate_metric(agg_func) for agg_func, _ in metrics)
+
+
+def group_result_columns(group_by, metrics, array_limit=None):
+    """Колонки таблицы результата в порядке group_result_row"""
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    columns = list(group_by)
+    for agg_func, agg_col in normalize_metrics(metrics):
+        columns.append(metric_name(agg_func, agg_col))
+        if array_limit and is_array_metric(agg_func):
+            columns.append(metric_size_name(agg_func, agg_col))
+    return columns
+
+
+def group_key_expression(group_by):
+    """_id группы: одна колонка - ее значение, несколько - документ {k0: ..., k1: ...}"""
+    if len(group_by) == 1:
+        return f"${group_by[0]}"
+    return {f"k{i}": f"${col}" for i, col in enumerate(group_by)}
+
+
+def build_group_pipeline(match_query, group_by, metrics, sort_column=None, sort_direction=1,
+                         array_limit=None):
+    """Строит один $group по составному ключу со всеми метриками [(функция, колонка), ...]
+
+    С array_limit массивы ("все значения", "уникальные значения") сразу после группировки
+    обрезаются до array_limit элементов, а полный размер сохраняется в поле m{i}_size.
+    """
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    if not group_by:
+        raise ValueError("Выберите колонку для группировки")
+    metrics = normalize_metrics(metrics)
+    if has_approximate_metrics(metrics):
+        raise ValueError("Приближенные функции считаются по скетчам, а не в $group")
+
+    pipeline = []
+
+    # Добавляем стадию матча из текущих фильтров
+    if match_query:
+        pipeline.append({"$match": match_query})
+
+    # Стадия группировки: метрики хранятся в полях m0, m1, ...
+    group_stage = {"_id": group_key_expression(group_by)}
+    for i, (agg_func, agg_col) in enumerate(metrics):
+        group_stage[f"m{i}"] = metric_expression(agg_func, agg_col)
+    pipeline.append({"$group": group_stage})
+
+    if array_limit:
+        trim_stage = {}
+        for i, (agg_func, _) in enumerate(metrics):
+            if is_array_metric(agg_func):
+                trim_stage[f"m{i}_size"] = {"$size": f"$m{i}"}
+                trim_stage[f"m{i}"] = {"$slice": [f"$m{i}", array_limit]}
+        if trim_stage:
+            pipeline.append({"$set": trim_stage})
+
+    # Для единственной метрики-дисперсии убираем группы без числовых значений
+    if len(metrics) == 1 and AGGREGATION_FUNCTIONS.get(metrics[0][0]) in ["$stdDevPop", "$stdDevSamp"]:
+        pipeline.append({"$match": {"m0": {"$ne": None}}})
+
+    pipeline.append(group_sort_stage(group_by, metrics, sort_column, sort_direction, array_limit))
+
+    return pipeline
+
+
+def group_sort_stage(group_by, metrics, sort_column=None, sort_direction=1, array_limit=None):
+    """Сортировка результата группировки по колонке таблицы: ключу группы или метрике"""
+    sort_field = "_id"
+    if sort_column in group_by:
+        if len(group_by) > 1:
+            sort_field = f"_id.k{group_by.index(sort_column)}"
+    else:
+        names = [metric_name(agg_func, agg_col) for agg_func, agg_col in metrics]
+        size_names = [metric_size_name(agg_func, agg_col) for agg_func, agg_col in metrics]
+        if sort_column in names:
+            sort_field = f"m{names.index(sort_column)}"
+        elif array_limit and sort_column in size_names:
+            sort_field = f"m{size_names.index(sort_column)}_size"
+        elif sort_column and len(metrics) == 1:
+            sort_field = "m0"
+    return {"$sort": {sort_field: sort_direction if sort_column else 1}}
+
+
+def group_result_row(record, group_by, metrics):
+    """Преобразует документ результата $group в строку таблицы: ключи группы и метрики по колонкам"""
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    metrics = normalize_metrics(metrics)
+
+    row_data = {}
+    key = record.get("_id", "N/A")
+    if len(group_by) == 1:
+        row_data[group_by[0]] = key
+    else:
+        key = key if isinstance(key, dict) else {}
+        for i, col in enumerate(group_by):
+            row_data[col] = key.get(f"k{i}")
+
+    for i, (agg_func, agg_col) in enumerate(metrics):
+        row_data[metric_name(agg_func, agg_col)] = record.get(f"m{i}", 0)
+        if f"m{i}_size" in record:
+            row_data[metric_size_name(agg_func, agg_col)] = record[f"m{i}_size"]
+
+    return row_data
+
+
+def paginate_pipeline(pipeline, skip, limit):
+    """Добавляет к пайплайну одну страницу групп и общее число групп в одном ответе ($facet)"""
+    return pipeline + [{"$facet": {
+        "rows": [{"$skip": skip}, {"$limit": limit}],
+        "total": [{"$count": "groups"}]
+    }}]
+
+
+def facet_page(result):
+    """Разбирает ответ paginate_pipeline: (документы страницы, общее число групп)"""
+    page = next(iter(result), None) or {}
+    total = page.get("total") or [{}]
+    return page.get("rows", []), total[0].get("groups", 0)
+
+
+def non_empty_expression(col, validated=False):
+    """Выражение агрегации: значение колонки не пустое (не null, не NaN, не пустая строка).
+
+    Для проверенной при импорте коллекции пропуск - только null, остальные проверки не нужны.
+    """
+    if validated:
+        return {"$ne": [{"$ifNull": [f"${col}", None]}, None]}
+    return {"$and": [
+        {"$not": [{"$in": [{"$type": f"${col}"}, ["missing", "null"]]}]},
+        {"$ne": [f"${col}", float('nan')]},
+        {"$cond": [{"$eq": [{"$type": f"${col}"}, "string"]},
+                   {"$ne": [{"$trim": {"input": f"${col}"}}, ""]},
+                   True]}
+    ]}
+
+
+def build_column_stats_pipeline(match_query, columns, validated=False):
+    """Пайплайн, считающий на сервере общее количество и непустые значения по каждой колонке"""
+    pipeline = []
+    if match_query:
+        pipeline.append({"$match": match_query})
+
+    group_stage = {"_id": None, "_total": {"$sum": 1}}
+    for i, col in enumerate(columns):
+        group_stage[f"c{i}"] = {"$sum": {"$cond": [non_empty_expression(col, validated), 1, 0]}}
+    pipeline.append({"$group": group_stage})
+    return pipeline
+
+
+def column_stats_from_result(result, columns):
+    """Преобразует результат build_column_stats_pipeline в словарь статистики по колонкам"""
+    total = result.get("_total", 0) if result else 0
+    stats = {}
+    for i, col in enumerate(columns):
+        non_empty = result.get(f"c{i}", 0) if result else 0
+        stats[col] = {
+            'total': total,
+            'non_empty': non_empty,
+            'empty': total - non_empty,
+            'fill_rate': (non_empty / total * 100) if total > 0 else 0
+        }
+    return stats
@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+
+DEFAULT_LOG_PATH = "slow_queries.jsonl"
+DEFAULT_THRESHOLD_MS = 200
+# queryPlanner не выполняет запрос повторно (только план), executionStats выполняет и дает docs_examined
+EXPLAIN_VERBOSITIES = ("queryPlanner", "executionStats")
+EXPLAIN_INTERVAL_SECONDS = 60  # Одна форма запроса объясняется не чаще раза в минуту
+EXPLAIN_QUEUE_SIZE = 16  # Записи сверх очереди пишутся без explain
+
+
+def query_shape(query):
+    """Возвращает форму запроса: структура и операторы сохраняются, значения заменяются на '?'"""
+    if isinstance(query, dict):
+        return {key: query_shape(value) for key, value in sorted(query.items())}
+
+    if isinstance(query, (list, tuple)):
+        shapes = [query_shape(item) for item in query]
+        # Списки скаляров ($in, $nin) сворачиваем - их длина не меняет форму запроса
+        if all(shape == "?" for shape in shapes):
+            return ["?"] if shapes else []
+        return shapes
+
+    # Ссылки на поля ("$price") являются частью формы, а не значением
+    if isinstance(query, str) and query.startswith("$"):
+        return query
+
+    return "?"
+
+
+def query_fingerprint(query):
+    """Возвращает короткий отпечаток формы запроса"""
+    shape = json.dumps(query_shape(query), sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(shape.encode("utf-8")).hexdigest()[:12]
+
+
+def find_plan(explain):
+    """Стадии выигравшего плана из результата explain: "FETCH>IXSCAN", "COLLSCAN" """
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            stages = []
+            plan = explain["winningPlan"]
+            while isinstance(plan, dict):
+                plan = plan.get("queryPlan", plan)
+                if "stage" in plan:
+                    stages.append(plan["stage"])
+                plan = plan.get("inputStage") or next(iter(plan.get("inputStages") or []), None)
+            return ">".join(stages) or None
+        values = explain.values()
+    elif isinstance(explain, list):
+        values = explain
+    else:
+        return None
+    for value in values:
+        found = find_plan(value)
+        if found is not None:
+            return found
+    return None
+
+
+def find_docs_examined(explain):
+    """Достает totalDocsExamined из результата explain (в том числе вложенного в стадии агрегации)"""
+    if isinstance(explain, dict):
+        if "totalDocsExamined" in explain:
+            return explain["totalDocsExamined"]
+        for value in explain.values():
+            found = find_docs_examined(value)
+            if found is not None:
+                return found
+    elif isinstance(explain, list):
+        for item in explain:
+            found = find_docs_examined(item)
+            if found is not None:
+                return found
+    return None
+
+
+class SlowQueryLog:
+    """Журнал медленных запросов в ротируемом JSONL файле.
+
+    С explain_slow медленные запросы дополнительно объясняются в фоновом потоке (не чаще раза
+    в explain_interval секунд на форму запроса), и запись попадает в журнал после explain;
+    поток, выполнивший запрос, не ждет.
+    """
+
+    def __init__(self, path=DEFAULT_LOG_PATH, threshold_ms=DEFAULT_THRESHOLD_MS,
+                 max_bytes=5 * 1024 * 1024, backup_count=5, explain_slow=False,
+                 explain_verbosity="executionStats", explain_interval=EXPLAIN_INTERVAL_SECONDS):
+        if explain_verbosity not in EXPLAIN_VERBOSITIES:
+            raise ValueError(f"Неизвестная детальность explain: {explain_verbosity}")
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.explain_slow = explain_slow
+        self.explain_verbosity = explain_verbosity
+        self.explain_interval = explain_interval
+        self._explained = {}  # Отпечаток формы -> время последнего explain
+        self._explain_queue = queue.Queue(maxsize=EXPLAIN_QUEUE_SIZE)
+        self._explain_thread = None
+        self._lock = threading.Lock()
+
+        # Отдельный логгер на каждый файл, чтобы не смешивать записи
+        self.logger = logging.getLogger(f"nissan.slow_queries.{os.path.abspath(path)}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                          encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    @classmethod
+    def from_env(cls):
+        """Создает журнал с настройками из переменных окружения.
+
+        NISSAN_SLOW_QUERY_EXPLAIN: 0 (по умолчанию) - без explain, 1 или executionStats - план
+        и число просмотренных документов (запрос выполняется повторно), queryPlanner - только план.
+        """
+        explain = os.environ.get("NISSAN_SLOW_QUERY_EXPLAIN", "0")
+        return cls(
+            path=os.environ.get("NISSAN_SLOW_QUERY_LOG", DEFAULT_LOG_PATH),
+            threshold_ms=float(os.environ.get("NISSAN_SLOW_QUERY_MS", DEFAULT_THRESHOLD_MS)),
+            explain_slow=explain != "0",
+            explain_verbosity=explain if explain in EXPLAIN_VERBOSITIES else "executionStats"
+        )
+
+    def record(self, operation, collection, query, duration_ms,
+               result_size=None, docs_examined=None, error=None):
+        """Записывает запрос в журнал, если он медленнее порога или завершился ошибкой"""
+        if duration_ms < self.threshold_ms and error is None:
+            return
+
+        entry = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "op": operation,
+            "collection": getattr(collection, "name", str(collection)),
+            "shape_id": query_fingerprint(query),
+            "shape": query_shape(query),
+            "duration_ms": round(duration_ms, 2),
+            "docs_examined": docs_examined,
+            "result_size": result_size,
+        }
+        if error is not None:
+            entry["error"] = str(error)
+
+        if (docs_examined is None and error is None and operation in ("find", "count", "aggregate")
+                and self.should_explain(entry["shape_id"])):
+            try:
+                self._explain_queue.put_nowait((entry, operation, collection, query))
+                self._start_explain_thread()
+                return
+            except queue.Full:
+                pass
+        self.write(entry)
+
+    def write(self, entry):
+        try:
+            self.logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"Ошибка записи в журнал медленных запросов: {e}")
+
+    def should_explain(self, shape_id):
+        """Включен ли explain и не объяснялась ли эта форма запроса за последние explain_interval секунд"""
+        if not self.explain_slow:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._explained.get(shape_id)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self._explained[shape_id] = now
+        return True
+
+    def _start_explain_thread(self):
+        with self._lock:
+            if self._explain_thread is None or not self._explain_thread.is_alive():
+                self._explain_thread = threading.Thread(target=self._explain_worker, name="slow-query-explain",
+                                                        daemon=True)
+                self._explain_thread.start()
+
+    def _explain_worker(self):
+        while True:
+            entry, operation, collection, query = self._explain_queue.get()
+            explain = self.explain(operation, collection, query)
+            if explain is not None:
+                entry["plan"] = find_plan(explain)
+                entry["docs_examined"] = find_docs_examined(explain)
+            self.write(entry)
+
+    def explain(self, operation, collection, query):
+        """Результат explain с детальностью explain_verbosity или None при ошибке"""
+        try:
+            if operation == "aggregate":
+                command = {"aggregate": collection.name, "pipeline": query, "cursor": {}}
+            elif operation == "count":
+                command = {"count": collection.name, "query": query}
+            else:
+                command = {"find": collection.name, "filter": query}
+
+            return collection.database.command("explain", command, verbosity=self.explain_verbosity)
+        except Exception:
+            return None
+
+    @contextmanager
+    def track(self, operation, collection, query):
+        """Замеряет время блока; в словарь можно записать result_size и docs_examined"""
+        entry = {"result_size": None, "docs_examined": None}
+        start = time.perf_counter()
+        try:
+            yield entry
+        except Exception as e:
+            duration_ms = (time.perf_counter() - start) * 1000
+            self.record(operation, collection, query, duration_ms, entry["result_size"],
+                        entry["docs_examined"], error=e)
+            raise
+        duration_ms = (time.perf_counter() - start) * 1000
+        self.record(operation, collection, query, duration_ms, entry["result_size"],
+                    entry["docs_examined"])
+
+
+def read_entries(path):
+    """Читает записи журнала вместе с ротированными файлами (path.N ... path)"""
+    paths = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        paths.append(f"{path}.{index}")
+        index += 1
+    paths.reverse()
+    if os.path.exists(path):
+        paths.append(path)
+
+    for file_path in paths:
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def aggregate_by_shape(entries):
+    """Группирует записи журнала по форме запроса"""
+    groups = defaultdict(lambda: {
+        "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+        "docs_examined": 0, "result_size": 0, "ops": set(), "shape": None, "last_seen": ""
+    })
+
+    for entry in entries:
+        group = groups[entry.get("shape_id")]
+        duration = entry.get("duration_ms") or 0
+        group["count"] += 1
+        group["total_ms"] += duration
+        group["max_ms"] = max(group["max_ms"], duration)
+        group["docs_examined"] += entry.get("docs_examined") or 0
+        group["result_size"] += entry.get("result_size") or 0
+        group["ops"].add(entry.get("op"))
+        group["shape"] = entry.get("shape")
+        group["last_seen"] = max(group["last_seen"], entry.get("ts", ""))
+        if "error" in entry:
+            group["errors"] += 1
+
+    report = []
+    for shape_id, group in groups.items():
+        report.append({
+            "shape_id": shape_id,
+            "ops": ",".join(sorted(op for op in group["ops"] if op)),
+            "count": group["count"],
+            "errors": group["errors"],
+            "total_ms": group["total_ms"],
+            "avg_ms": group["total_ms"] / group["count"],
+            "max_ms": group["max_ms"],
+            "avg_docs_examined": group["docs_examined"] / group["count"],
+            "avg_result_size": group["result_size"] / group["count"],
+            "last_seen": group["last_seen"],
+            "shape": group["shape"],
+        })
+    return report
+
+
+def print_report(path, sort_by="total_ms", top=20, show_shapes=True):
+    """Печатает отчет по формам запросов, отсортированный по заданной метрике"""
+    report = aggregate_by_shape(read_entries(path))
+    if not report:
+        print(f"Журнал {path} пуст")
+        return
+
+    report.sort(key=lambda row: row[sort_by], reverse=True)
+
+    print(f"{'shape_id':<12} {'ops':<16} {'кол-во':>7} {'ошибки':>7} {'всего мс':>11} "
+          f"{'сред. мс':>10} {'макс. мс':>10} {'просм. док.':>12} {'результат':>10}")
+    for row in report[:top]:
+        print(f"{row['shape_id']:<12} {row['ops']:<16} {row['count']:>7,} {row['errors']:>7,} "
+              f"{row['total_ms']:>11,.1f} {row['avg_ms']:>10,.1f} {row['max_ms']:>10,.1f} "
+              f"{row['avg_docs_examined']:>12,.0f} {row['avg_result_size']:>10,.0f}")
+        if show_shapes:
+            print(f"    {json.dumps(row['shape'], ensure_ascii=False)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Журнал медленных запросов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report_parser = subparsers.add_parser("report", help="Сгруппировать записи журнала по форме запроса")
+    report_parser.add_argument("path", nargs="?",
+                               default=os.environ.get("NISSAN_SLOW_QUERY_LOG", DEFAULT_LOG_PATH))
+    report_parser.add_argument("--sort", default="total_ms",
+                               choices=["total_ms", "count", "avg_ms", "max_ms", "avg_docs_examined"])
+    report_parser.add_argument("--top", type=int, default=20)
+    report_parser.add_argument("--no-shapes", action="store_true", help="Не печатать формы запросов")
+
+    args = parser.parse_args(argv)
+    if args.command == "report":
+        print_report(args.path, sort_by=args.sort, top=args.top, show_shapes=not args.no_shapes)
+
+
+if __name__ == "__main__":
+    main()
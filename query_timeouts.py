@@ -0,0 +1,86 @@
+import os
+import time
+
+
+# Лимит времени на сервере для каждой операции по условиям пользователя (find, count, aggregate), мс;
+# неудачное регулярное выражение или фильтр без индекса не занимают сервер дольше. 0 - без лимита
+DEFAULT_MAX_TIME_MS = 30_000
+# Лимит на точный подсчет в прогрессивном режиме: страница уже показана, количество может подождать
+DEFAULT_COUNT_TIME_MS = 10_000
+# Подсчеты с limit перед точным: дешевые, дают нижнюю границу, если точный подсчет не успеет
+COUNT_STEPS = (1_000, 100_000)
+
+# Код ошибки MaxTimeMSExpired на сервере
+MAX_TIME_EXPIRED_CODE = 50
+
+
+def _env_ms(name, default):
+    value = int(os.environ.get(name, default))
+    return value if value > 0 else None
+
+
+def max_time_ms():
+    """Лимит операции из NISSAN_MAX_TIME_MS; None - без лимита"""
+    return _env_ms("NISSAN_MAX_TIME_MS", DEFAULT_MAX_TIME_MS)
+
+
+def count_time_ms():
+    """Лимит точного подсчета из NISSAN_COUNT_TIME_MS (не больше общего лимита)"""
+    limit, count_limit = max_time_ms(), _env_ms("NISSAN_COUNT_TIME_MS", DEFAULT_COUNT_TIME_MS)
+    if limit is None or count_limit is None:
+        return limit or count_limit
+    return min(limit, count_limit)
+
+
+def time_limit(ms=None):
+    """Аргументы для count_documents/aggregate: {"maxTimeMS": ms} или пусто без лимита"""
+    ms = max_time_ms() if ms is None else ms
+    return {"maxTimeMS": ms} if ms else {}
+
+
+def limit_cursor(cursor, ms=None):
+    ms = max_time_ms() if ms is None else ms
+    return cursor.max_time_ms(ms) if ms else cursor
+
+
+def is_timeout(error):
+    """Операция прервана по maxTimeMS"""
+    from pymongo.errors import ExecutionTimeout
+
+    return isinstance(error, ExecutionTimeout) or getattr(error, "code", None) == MAX_TIME_EXPIRED_CODE
+
+
+def progressive_count(collection, query, ms=None, on_progress=None, query_log=None):
+    """(количество, точное ли) в пределах ms миллисекунд на все шаги.
+
+    Сначала считает с limit из COUNT_STEPS: если найдено меньше limit, это уже точное количество.
+    Иначе найденное - нижняя граница (передается в on_progress), и следующий шаг считает дальше.
+    Если время вышло, возвращается последняя нижняя граница с признаком False.
+    """
+    ms = count_time_ms() if ms is None else ms
+    deadline = time.monotonic() + ms / 1000 if ms else None
+    at_least = 0
+    for limit in COUNT_STEPS + (None,):
+        kwargs = {"limit": limit} if limit else {}
+        if deadline is not None:
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                return at_least, False
+            kwargs["maxTimeMS"] = remaining
+        try:
+            if query_log is not None:
+                with query_log.track("count", collection, query) as entry:
+                    count = collection.count_documents(query, **kwargs)
+                    entry['result_size'] = count
+            else:
+                count = collection.count_documents(query, **kwargs)
+        except Exception as e:
+            if is_timeout(e):
+                return at_least, False
+            raise
+        if limit is None or count < limit:
+            return count, True
+        at_least = count
+        if on_progress is not None:
+            on_progress(at_least)
+    return at_least, False
@@ -0,0 +1,375 @@
+import argparse
+import math
+import os
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from query_builder import AGGREGATION_FUNCTIONS, normalize_metrics, group_sort_stage
+
+
+REGISTRY_COLLECTION = "rollups"
+
+# Функции, которые восстанавливаются из накопленных count/sum/sum_sq/min/max
+ROLLUP_FUNCTIONS = ["$count", "$sum", "$avg", "$min", "$max", "$stdDevPop", "$stdDevSamp"]
+
+
+def rollup_name(source_name, group_by):
+    return f"rollup_{source_name}_{'_'.join(group_by)}"
+
+
+def numeric_value(value):
+    """Число для накопления метрик; пустые значения (None, NaN) и нечисловые не учитываются"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def is_empty(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def accumulate(docs, group_by, columns):
+    """Сворачивает документы в приращения по ключам группы.
+
+    Возвращает ({ключ: {"count", "cols": {колонка: {n, sum, sum_sq, min, max}}}},
+    количество документов, максимальный id, колонки с нечисловыми значениями).
+    """
+    deltas = {}
+    total = 0
+    max_id = None
+    non_numeric = set()
+
+    for doc in docs:
+        total += 1
+        doc_id = doc.get("id")
+        if numeric_value(doc_id) is not None and (max_id is None or doc_id > max_id):
+            max_id = doc_id
+
+        key = tuple(doc.get(col) for col in group_by)
+        try:
+            delta = deltas.get(key)
+        except TypeError:
+            # Списки и документы в ключе группы не хэшируются - сравниваем по строковому виду
+            key = tuple(str(part) for part in key)
+            delta = deltas.get(key)
+        if delta is None:
+            delta = deltas[key] = {"count": 0, "cols": {}}
+        delta["count"] += 1
+
+        for col in columns:
+            value = doc.get(col)
+            number = numeric_value(value)
+            if number is None:
+                if not is_empty(value):
+                    non_numeric.add(col)
+                continue
+            stats = delta["cols"].get(col)
+            if stats is None:
+                delta["cols"][col] = {"n": 1, "sum": number, "sum_sq": number * number,
+                                      "min": number, "max": number}
+            else:
+                stats["n"] += 1
+                stats["sum"] += number
+                stats["sum_sq"] += number * number
+                stats["min"] = min(stats["min"], number)
+                stats["max"] = max(stats["max"], number)
+
+    return deltas, total, max_id, non_numeric
+
+
+def rollup_updates(deltas):
+    """Upsert-операции для bulk_write: счетчики через $inc, границы через $min/$max"""
+    updates = []
+    for key, delta in deltas.items():
+        inc = {"count": delta["count"]}
+        minimum, maximum = {}, {}
+        for col, stats in delta["cols"].items():
+            inc[f"cols.{col}.n"] = stats["n"]
+            inc[f"cols.{col}.sum"] = stats["sum"]
+            inc[f"cols.{col}.sum_sq"] = stats["sum_sq"]
+            minimum[f"cols.{col}.min"] = stats["min"]
+            maximum[f"cols.{col}.max"] = stats["max"]
+
+        update = {"$inc": inc}
+        if minimum:
+            update["$min"] = minimum
+            update["$max"] = maximum
+        key_doc = {f"k{i}": part for i, part in enumerate(key)}
+        updates.append(UpdateOne({"_id": key_doc}, update, upsert=True))
+    return updates
+
+
+def rewrite_query(query, field_map):
+    """Переименовывает поля запроса в поля свертки; None, если запрос затрагивает другие поля"""
+    rewritten = {}
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            parts = [rewrite_query(part, field_map) for part in value]
+            if any(part is None for part in parts):
+                return None
+            rewritten[key] = parts
+        elif key in field_map:
+            rewritten[field_map[key]] = value
+        else:
+            # $expr, $text и фильтры по колонкам вне ключа свертки ей не ответить
+            return None
+    return rewritten
+
+
+def stat_sum(col, stat):
+    return {"$sum": f"$cols.{col}.{stat}"}
+
+
+def metric_from_stats(mongo_func, col):
+    """Выражение $project, восстанавливающее метрику из сумм по группе"""
+    n, total, total_sq = f"$c_{col}_n", f"$c_{col}_sum", f"$c_{col}_sum_sq"
+    mean = {"$divide": [total, n]}
+
+    if mongo_func == "$count":
+        return "$count"
+    if mongo_func == "$sum":
+        return total
+    if mongo_func == "$min":
+        return f"$c_{col}_min"
+    if mongo_func == "$max":
+        return f"$c_{col}_max"
+    if mongo_func == "$avg":
+        return {"$cond": [{"$gt": [n, 0]}, mean, None]}
+    if mongo_func == "$stdDevPop":
+        variance = {"$subtract": [{"$divide": [total_sq, n]}, {"$multiply": [mean, mean]}]}
+        return {"$cond": [{"$gt": [n, 0]}, {"$sqrt": {"$max": [0, variance]}}, None]}
+    # $stdDevSamp
+    variance = {"$divide": [{"$subtract": [total_sq, {"$divide": [{"$multiply": [total, total]}, n]}]},
+                            {"$subtract": [n, 1]}]}
+    return {"$cond": [{"$gt": [n, 1]}, {"$sqrt": {"$max": [0, variance]}}, None]}
+
+
+class Rollup:
+    """Материализованная свертка: count, sum, sum_sq, min, max по колонкам для каждого ключа группы"""
+
+    def __init__(self, db, definition):
+        self.db = db
+        self.definition = definition
+        self.name = definition["_id"]
+        self.group_by = list(definition["group_by"])
+        self.columns = list(definition["columns"])
+        self.non_numeric = set(definition.get("non_numeric") or [])
+        self.collection = db[self.name]
+
+    @property
+    def count(self):
+        return self.definition.get("count", 0)
+
+    @property
+    def high_water_mark(self):
+        return self.definition.get("high_water_mark")
+
+    def match_for(self, group_by, metrics, query):
+        """Условие $match по свертке, если она отвечает на запрос, иначе None"""
+        if not set(group_by) <= set(self.group_by):
+            return None
+        for agg_func, agg_col in metrics:
+            mongo_func = AGGREGATION_FUNCTIONS.get(agg_func)
+            if mongo_func not in ROLLUP_FUNCTIONS:
+                return None
+            if mongo_func == "$count":
+                continue
+            if agg_col not in self.columns:
+                return None
+            # Минимум и максимум по строкам свертка не хранит
+            if mongo_func in ("$min", "$max") and agg_col in self.non_numeric:
+                return None
+
+        field_map = {col: f"_id.k{i}" for i, col in enumerate(self.group_by)}
+        return rewrite_query(query or {}, field_map)
+
+    def build_pipeline(self, match, group_by, metrics, sort_column=None, sort_direction=1):
+        """Пайплайн по свертке в том же формате результата, что и build_group_pipeline"""
+        metrics = normalize_metrics(metrics)
+        key_fields = [f"$_id.k{self.group_by.index(col)}" for col in group_by]
+
+        pipeline = []
+        if match:
+            pipeline.append({"$match": match})
+
+        # Свертка может быть детальнее запроса - досворачиваем ее по нужным ключам
+        group_stage = {"_id": key_fields[0] if len(group_by) == 1
+                       else {f"k{i}": field for i, field in enumerate(key_fields)},
+                       "count": {"$sum": "$count"}}
+        for col in {agg_col for _, agg_col in metrics if agg_col}:
+            group_stage[f"c_{col}_n"] = stat_sum(col, "n")
+            group_stage[f"c_{col}_sum"] = stat_sum(col, "sum")
+            group_stage[f"c_{col}_sum_sq"] = stat_sum(col, "sum_sq")
+            group_stage[f"c_{col}_min"] = {"$min": f"$cols.{col}.min"}
+            group_stage[f"c_{col}_max"] = {"$max": f"$cols.{col}.max"}
+        pipeline.append({"$group": group_stage})
+
+        pipeline.append({"$project": {f"m{i}": metric_from_stats(AGGREGATION_FUNCTIONS[agg_func], agg_col)
+                                      for i, (agg_func, agg_col) in enumerate(metrics)}})
+
+        # Как и в build_group_pipeline, для единственной метрики-дисперсии убираем пустые группы
+        if len(metrics) == 1 and AGGREGATION_FUNCTIONS[metrics[0][0]] in ["$stdDevPop", "$stdDevSamp"]:
+            pipeline.append({"$match": {"m0": {"$ne": None}}})
+        pipeline.append(group_sort_stage(group_by, metrics, sort_column, sort_direction))
+        return pipeline
+
+
+class RollupManager:
+    """Реестр сверток коллекции и их инкрементальное обновление"""
+
+    def __init__(self, collection, query_log=None):
+        self.source = collection
+        self.db = collection.database
+        self.registry = self.db[REGISTRY_COLLECTION]
+        self.query_log = query_log
+
+    def rollups(self):
+        return [Rollup(self.db, definition) for definition in self.registry.find({"source": self.source.name})]
+
+    def find_for(self, group_by, metrics, query):
+        """Подходящая свертка и условие по ней: (Rollup, $match) или (None, None)"""
+        for rollup in self.rollups():
+            match = rollup.match_for(group_by, metrics, query)
+            if match is not None:
+                return rollup, match
+        return None, None
+
+    def register(self, group_by, columns, batch_size=50000):
+        """Регистрирует свертку по ключам group_by с метриками по columns и строит ее"""
+        name = rollup_name(self.source.name, group_by)
+        existing = self.registry.find_one({"_id": name})
+        if existing:
+            # Колонки новой регистрации добавляются к уже собранным - свертку нужно пересчитать
+            columns = list(dict.fromkeys(list(existing["columns"]) + list(columns)))
+        self.registry.replace_one({"_id": name}, {"_id": name, "source": self.source.name,
+                                                  "group_by": list(group_by), "columns": list(columns)},
+                                  upsert=True)
+        rollup = Rollup(self.db, self.registry.find_one({"_id": name}))
+        return self.rebuild(rollup, batch_size)
+
+    def drop(self, name):
+        self.db[name].drop()
+        self.registry.delete_one({"_id": name})
+
+    def rebuild(self, rollup, batch_size=50000):
+        """Пересчитывает свертку с нуля потоковым проходом по коллекции"""
+        rollup.collection.drop()
+        self.registry.update_one({"_id": rollup.name}, {"$set": {"count": 0, "non_numeric": []},
+                                                        "$unset": {"high_water_mark": ""}})
+        self._apply_cursor(rollup, {}, batch_size)
+        return Rollup(self.db, self.registry.find_one({"_id": rollup.name}))
+
+    def apply_documents(self, docs):
+        """Добавляет только что вставленные документы во все свертки коллекции"""
+        docs = list(docs)
+        if not docs:
+            return
+        for rollup in self.rollups():
+            self._apply(rollup, docs)
+
+    def catch_up(self, batch_size=50000):
+        """Догоняет все свертки по отметке id; при расхождении количества перестраивает свертку.
+
+        Возвращает {имя свертки: добавлено документов или -1 при перестройке}.
+        """
+        total = self.source.count_documents({})
+        result = {}
+        for rollup in self.rollups():
+            hwm = rollup.high_water_mark
+            added = -1
+            if hwm is not None:
+                added = self._apply_cursor(rollup, {"id": {"$gt": hwm}}, batch_size)
+
+            # Изменения и удаления старых документов отметка по id не видит - проверяем количество
+            definition = self.registry.find_one({"_id": rollup.name})
+            if added < 0 or definition.get("count", 0) != total:
+                self.rebuild(rollup, batch_size)
+                added = -1
+            result[rollup.name] = added
+        return result
+
+    def _apply_cursor(self, rollup, query, batch_size):
+        projection = {"_id": 0, "id": 1}
+        projection.update({col: 1 for col in rollup.group_by + rollup.columns})
+
+        added = 0
+        batch = []
+        cursor = self.source.find(query, projection, batch_size=batch_size)
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    added += self._apply(rollup, batch)
+                    batch = []
+            if batch:
+                added += self._apply(rollup, batch)
+        finally:
+            cursor.close()
+        return added
+
+    def _apply(self, rollup, docs):
+        deltas, total, max_id, non_numeric = accumulate(docs, rollup.group_by, rollup.columns)
+        updates = rollup_updates(deltas)
+        if updates:
+            if self.query_log is not None:
+                with self.query_log.track("bulk_write", rollup.collection, {"upserts": len(updates)}) as entry:
+                    rollup.collection.bulk_write(updates, ordered=False)
+                    entry['result_size'] = len(updates)
+            else:
+                rollup.collection.bulk_write(updates, ordered=False)
+
+        update = {"$inc": {"count": total}, "$set": {"updated_at": datetime.now()}}
+        if max_id is not None:
+            update["$max"] = {"high_water_mark": max_id}
+        if non_numeric:
+            update["$addToSet"] = {"non_numeric": {"$each": sorted(non_numeric)}}
+        self.registry.update_one({"_id": rollup.name}, update)
+        return total
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Материализованные свертки для частых агрегаций")
+    parser.add_argument("command", choices=["register", "catch-up", "list", "drop"])
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    parser.add_argument("--group-by", help="Колонки ключа свертки через запятую (register)")
+    parser.add_argument("--columns", default="", help="Колонки метрик через запятую (register)")
+    parser.add_argument("--name", help="Имя свертки (drop)")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    manager = RollupManager(client[args.db][args.collection])
+
+    start = time.perf_counter()
+    if args.command == "register":
+        if not args.group_by:
+            raise SystemExit("Укажите --group-by")
+        group_by = [col.strip() for col in args.group_by.split(",") if col.strip()]
+        columns = [col.strip() for col in args.columns.split(",") if col.strip()]
+        rollup = manager.register(group_by, columns)
+        print(f"{rollup.name}: {rollup.count:,} документов, {rollup.collection.count_documents({}):,} ключей")
+    elif args.command == "catch-up":
+        for name, added in manager.catch_up().items():
+            print(f"{name}: " + ("перестроена" if added < 0 else f"добавлено документов: {added:,}"))
+    elif args.command == "drop":
+        if not args.name:
+            raise SystemExit("Укажите --name")
+        manager.drop(args.name)
+    else:
+        for rollup in manager.rollups():
+            print(f"{rollup.name}: ключ {', '.join(rollup.group_by)}; колонки {', '.join(rollup.columns) or '-'}; "
+                  f"{rollup.count:,} документов, отметка id={rollup.high_water_mark}")
+
+    print(f"Готово за {time.perf_counter() - start:.2f} с")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
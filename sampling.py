@@ -0,0 +1,144 @@
+import math
+
+from query_builder import (AGGREGATION_FUNCTIONS, build_column_stats_pipeline, build_group_pipeline,
+                           column_stats_from_result, group_result_row, metric_name, normalize_metrics,
+                           is_array_metric)
+from query_timeouts import time_limit
+
+
+SAMPLE_SIZE = 5000
+SAMPLING_THRESHOLD = 200_000  # Коллекции меньше этого размера считаются точно сразу
+Z_SCORE = 1.96  # 95% доверительный интервал
+
+
+class Estimate:
+    """Оценка по выборке с 95% доверительным интервалом (low/high могут отсутствовать)"""
+
+    def __init__(self, value, low=None, high=None):
+        self.value = value
+        self.low = low
+        self.high = high
+
+    def __str__(self):
+        digits = 0 if abs(self.value) >= 100 or float(self.value).is_integer() else 2
+        text = f"≈{self.value:,.{digits}f}"
+        if self.low is None or self.high is None:
+            return text
+        return f"{text} ±{(self.high - self.low) / 2:,.{digits}f}"
+
+    def __repr__(self):
+        return f"Estimate({self.value!r}, {self.low!r}, {self.high!r})"
+
+
+def wilson_interval(successes, trials, z=Z_SCORE):
+    """Доверительный интервал Уилсона для доли successes/trials (устойчив при долях около 0 и 1)"""
+    if trials <= 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    half = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def scaled_count(successes, trials, population):
+    """Оценка количества в генеральной совокупности по доле в выборке"""
+    low, high = wilson_interval(successes, trials)
+    return Estimate(population * successes / trials if trials else 0, population * low, population * high)
+
+
+def worth_sampling(population, size=SAMPLE_SIZE):
+    return population >= max(SAMPLING_THRESHOLD, size * 2)
+
+
+def estimate_stats(collection, query, columns, population=None, size=SAMPLE_SIZE, query_log=None,
+                   validated=False):
+    """Количество записей и заполненность колонок по случайной выборке ($sample до фильтра).
+
+    Возвращает (оценка количества, статистика в формате calculate_filtered_column_stats
+    с полями 'estimated' и 'fill_rate_margin').
+    """
+    if population is None:
+        population = collection.estimated_document_count()
+    sampled = min(size, population)
+
+    pipeline = [{"$sample": {"size": size}}] + build_column_stats_pipeline(query, columns, validated)
+    if query_log is not None:
+        with query_log.track("aggregate", collection, pipeline) as entry:
+            result = next(iter(collection.aggregate(pipeline, allowDiskUse=True, **time_limit())), None)
+            entry['result_size'] = 1 if result else 0
+    else:
+        result = next(iter(collection.aggregate(pipeline, allowDiskUse=True, **time_limit())), None)
+
+    sample_stats = column_stats_from_result(result, columns)
+    matched = result.get("_total", 0) if result else 0
+    count = scaled_count(matched, sampled, population)
+
+    stats = {}
+    for col in columns:
+        non_empty = sample_stats[col]['non_empty']
+        low, high = wilson_interval(non_empty, matched)
+        fill_rate = non_empty / matched if matched else 0
+        stats[col] = {
+            'total': round(count.value),
+            'non_empty': round(count.value * fill_rate),
+            'empty': round(count.value * (1 - fill_rate)),
+            'fill_rate': fill_rate * 100,
+            'fill_rate_margin': (high - low) / 2 * 100,
+            'estimated': True,
+        }
+    return count, stats
+
+
+def estimate_group_rows(collection, query, group_by, metrics, population=None, size=SAMPLE_SIZE,
+                        sort_column=None, sort_direction=1, array_limit=None, query_log=None):
+    """Группировка по случайной выборке: количества и суммы масштабируются на всю коллекцию,
+    средние идут с интервалом по стандартной ошибке, остальные метрики - значения выборки.
+
+    Возвращает (строки таблицы с Estimate вместо чисел, число групп в выборке).
+    """
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    metrics = normalize_metrics(metrics)
+    if population is None:
+        population = collection.estimated_document_count()
+    sampled = min(size, population)
+    scale = population / sampled if sampled else 0
+
+    pipeline = [{"$sample": {"size": size}}] + build_group_pipeline(query, group_by, metrics, sort_column,
+                                                                    sort_direction, array_limit)
+    # Для интервалов нужны размер группы в выборке и разброс значений для средних
+    group_stage = next(stage["$group"] for stage in pipeline if "$group" in stage)
+    group_stage["_n"] = {"$sum": 1}
+    for i, (agg_func, agg_col) in enumerate(metrics):
+        if AGGREGATION_FUNCTIONS.get(agg_func) == "$avg":
+            group_stage[f"_sd{i}"] = {"$stdDevSamp": f"${agg_col}"}
+            group_stage[f"_k{i}"] = {"$sum": {"$cond": [{"$eq": [{"$ifNull": [f"${agg_col}", None]}, None]}, 0, 1]}}
+
+    if query_log is not None:
+        with query_log.track("aggregate", collection, pipeline) as entry:
+            records = list(collection.aggregate(pipeline, allowDiskUse=True, **time_limit()))
+            entry['result_size'] = len(records)
+    else:
+        records = list(collection.aggregate(pipeline, allowDiskUse=True, **time_limit()))
+
+    rows = []
+    for record in records:
+        row = group_result_row(record, group_by, metrics)
+        for i, (agg_func, agg_col) in enumerate(metrics):
+            name = metric_name(agg_func, agg_col)
+            value = row.get(name)
+            mongo_func = AGGREGATION_FUNCTIONS.get(agg_func)
+            if (is_array_metric(agg_func) or not isinstance(value, (int, float)) or isinstance(value, bool)
+                    or (isinstance(value, float) and math.isnan(value))):
+                continue
+            if mongo_func == "$count":
+                row[name] = scaled_count(record["_n"], sampled, population)
+            elif mongo_func == "$sum":
+                row[name] = Estimate(value * scale)
+            elif mongo_func == "$avg" and record.get(f"_k{i}", 0) > 1 and record.get(f"_sd{i}") is not None:
+                margin = Z_SCORE * record[f"_sd{i}"] / math.sqrt(record[f"_k{i}"])
+                row[name] = Estimate(value, value - margin, value + margin)
+            else:
+                row[name] = Estimate(value)
+        rows.append(row)
+    return rows, len(records)
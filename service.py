@@ -0,0 +1,475 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from pymongo import MongoClient
+
+from query_builder import (QueryBuilder, OPERATORS, LOGIC_OPERATORS, AGGREGATION_FUNCTIONS, group_filters,
+                           NUMERIC_FIELDS, ARRAY_PREVIEW_SIZE, build_group_pipeline, group_result_row,
+                           paginate_pipeline, facet_page, has_approximate_metrics,
+                           build_column_stats_pipeline, column_stats_from_result)
+from query_log import SlowQueryLog
+from query_timeouts import is_timeout, limit_cursor, max_time_ms, progressive_count, time_limit
+from fuzzy import DEFAULT_LIMIT, DEFAULT_THRESHOLD, FuzzyIndexes
+from sorting import with_tiebreaker
+from shadow_fields import SHADOW_FIELD, document_projection
+from collection_meta import CollectionMetadata
+from distributions import build_distribution_pipeline, distributions_from_result
+from type_registry import TypeRegistry, build_range_pipeline, overrides_from_env
+from validation import COLUMN_TYPES, is_validated
+from result_cache import ResultCache, cache_key
+from sketches import SketchManager, approximate_group_rows, sort_rows
+
+
+DEFAULT_URI = "mongodb://localhost:27017"
+MAX_BODY_SIZE = 1024 * 1024
+MAX_PAGE_SIZE = 1000
+
+
+class RequestError(Exception):
+    """Ошибка в параметрах запроса клиента (ответ 400)"""
+
+
+def int_param(params, name, default, low=None, high=None):
+    """Целый параметр клиента в пределах [low, high]; некорректное значение - RequestError"""
+    value = params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(f"Параметр {name} должен быть целым числом: {value!r}")
+    if low is not None:
+        value = max(low, value)
+    if high is not None:
+        value = min(high, value)
+    return value
+
+
+def float_param(params, name, default):
+    value = params.get(name, default)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RequestError(f"Параметр {name} должен быть числом: {value!r}")
+
+
+def sort_param(params):
+    """[(колонка, 1 или -1)] из "sort": [[колонка, направление], ...]"""
+    spec = params.get("sort") or []
+    if not isinstance(spec, list):
+        raise RequestError("sort должен быть списком пар [колонка, направление]")
+    result = []
+    for item in spec:
+        try:
+            column, direction = item
+            result.append((str(column), -1 if int(direction) < 0 else 1))
+        except (TypeError, ValueError):
+            raise RequestError(f"Некорректный элемент sort: {item!r}")
+    return result
+
+
+def json_safe(value):
+    """Заменяет NaN/Infinity на None, чтобы ответ был валидным JSON"""
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    return value
+
+
+class QueryService:
+    """Запросы к коллекции через общий пул соединений и общий кэш результатов"""
+
+    def __init__(self, uri=DEFAULT_URI, db_name="nissan", collection_name="vehicles",
+                 pool_size=20, cache=None, query_log=None):
+        self.client = MongoClient(uri, maxPoolSize=pool_size)
+        self.collection = self.client[db_name][collection_name]
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="query")
+        self.cache = cache or ResultCache()
+        self.query_log = query_log or SlowQueryLog.from_env()
+        self.sketches = SketchManager(self.collection, self.query_log)
+        self.metadata = CollectionMetadata(self.collection, query_log=self.query_log)
+
+        self._schema = None
+        self._schema_lock = threading.Lock()
+        # Типы колонок для построения запросов; границы значений - только для проверенной коллекции
+        self.registry = TypeRegistry.from_numeric_fields(NUMERIC_FIELDS, overrides_from_env())
+        # Индексы триграмм для "похоже на" и /fuzzy: строятся при первом обращении, сбрасываются с версией коллекции
+        self.fuzzy = FuzzyIndexes(self.collection, query_log=self.query_log)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+    # --- Построение запросов ---
+
+    def build_query(self, params):
+        """Строит запрос из {"filters": [{"column", "operator", "value", "logic"}], "search": "..."}"""
+        filters = []
+        if not isinstance(params.get("filters") or [], list):
+            raise RequestError("filters должен быть списком")
+        for item in params.get("filters") or []:
+            if not isinstance(item, dict):
+                raise RequestError("Каждый фильтр должен быть объектом")
+            operator = item.get("operator", "содержит")
+            logic = item.get("logic", "И")
+            if operator not in OPERATORS:
+                raise RequestError(f"Неизвестный оператор: {operator}")
+            if logic not in LOGIC_OPERATORS:
+                raise RequestError(f"Неизвестный логический оператор: {logic}")
+            filters.append((logic, item.get("column"), operator, str(item.get("value", ""))))
+
+        # Ошибки регулярных выражений собираем и возвращаем клиенту вместо запроса без условия
+        regex_errors = []
+        # Границы значений и флаги ingest_meta устаревают при изменении коллекции
+        self.metadata.total_count()
+        schema = self.schema()
+        self.registry.expire(self.metadata.version())
+        self.fuzzy.expire(self.metadata.version())
+        query_errors = []
+        builder = QueryBuilder(columns=schema["columns"], on_regex_error=regex_errors.append,
+                               validated=schema["validated"], registry=self.registry,
+                               shadow_columns=schema["shadow_columns"], fuzzy=self.fuzzy,
+                               on_query_error=query_errors.append)
+        query = builder.build_query(group_filters(filters), params.get("search", ""))
+        if regex_errors:
+            raise RequestError(f"Некорректное регулярное выражение: {regex_errors[0]}")
+        if query_errors:
+            raise RequestError(f"Некорректное условие: {query_errors[0]}")
+        return query
+
+    # --- Операции (выполняются в пуле потоков) ---
+
+    def schema(self):
+        """Колонки и статистика по всей коллекции; считаются один раз на все подключения.
+        Флаги validated и shadow_columns перечитываются вместе с отметкой записи"""
+        with self._schema_lock:
+            if self._schema is None:
+                first = self.collection.find_one({}, document_projection()) or {}
+                columns = list(first.keys())
+
+                # Поля, отсутствующие в первом документе, добираем на сервере
+                pipeline = [{"$project": {"kv": {"$objectToArray": "$$ROOT"}}},
+                            {"$unwind": "$kv"},
+                            {"$group": {"_id": "$kv.k"}}]
+                try:
+                    for record in self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit()):
+                        if record["_id"] not in ("_id", SHADOW_FIELD) and record["_id"] not in columns:
+                            columns.append(record["_id"])
+                except Exception as e:
+                    print(f"Ошибка определения колонок: {e}")
+
+                validated = is_validated(self.collection)
+                if validated:
+                    try:
+                        self._learn_ranges()
+                    except Exception as e:
+                        if not is_timeout(e):
+                            raise
+                        # Типы уже известны; без границ условия отсекаются только по типу
+                        print(f"Границы колонок не посчитаны за {max_time_ms()} мс")
+                try:
+                    stats = self._column_stats({}, columns, validated)
+                except Exception as e:
+                    if not is_timeout(e):
+                        raise
+                    print(f"Статистика колонок не посчитана за {max_time_ms()} мс")
+                    stats = None
+                self._schema = {"columns": columns, "stats": stats}
+        # Включение и отключение теневых полей меняет отметку записи (bump_write_version)
+        self.metadata.current_version()
+        meta = self.metadata.ingest_meta()
+        return dict(self._schema, validated=bool(meta.get("validated")),
+                    shadow_columns=list(meta.get("shadow_columns") or []))
+
+    def _learn_ranges(self):
+        """Типы и границы числовых колонок проверенной коллекции (там в них только числа)"""
+        self.registry.learn_column_types(COLUMN_TYPES)
+        numeric = list(COLUMN_TYPES)
+        self.metadata.total_count()
+        version = self.metadata.version()
+        pipeline = build_range_pipeline(numeric)
+        with self.query_log.track("aggregate", self.collection, pipeline) as entry:
+            result = next(iter(self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit())), None)
+            entry['result_size'] = 1 if result else 0
+        self.registry.learn_ranges(result, numeric, version)
+
+    def _column_stats(self, query, columns, validated=False):
+        pipeline = build_column_stats_pipeline(query, columns, validated)
+        with self.query_log.track("aggregate", self.collection, pipeline) as entry:
+            result = next(iter(self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit())), None)
+            entry['result_size'] = 1 if result else 0
+        return column_stats_from_result(result, columns)
+
+    def count(self, params):
+        query = self.build_query(params)
+        if not query:
+            return {"count": self.metadata.total_count(), "exact": True}
+        # Не уложившийся в лимит подсчет отдает нижнюю границу: {"count": N, "exact": false}
+        total, exact = progressive_count(self.collection, query, max_time_ms(), query_log=self.query_log)
+        return {"count": total, "exact": exact}
+
+    def fuzzy_search(self, params):
+        """Похожие значения колонки по триграммам: {"column", "value", "limit", "threshold"}"""
+        column = params.get("column")
+        if not self.fuzzy.supports(column):
+            raise RequestError(f"Нечеткий поиск доступен для колонок: {', '.join(self.fuzzy.columns)}")
+        limit = int_param(params, "limit", DEFAULT_LIMIT, 1, MAX_PAGE_SIZE)
+        threshold = float_param(params, "threshold", DEFAULT_THRESHOLD)
+
+        self.metadata.total_count()
+        self.fuzzy.expire(self.metadata.version())
+        matches = self.fuzzy.search(column, str(params.get("value", "")), limit, threshold)
+        return {"matches": [{"value": value, "similarity": round(score, 4), "count": count}
+                            for value, score, count in matches]}
+
+    def stats(self, params):
+        """Заполненность колонок и их распределения (гистограмма или частые значения) за один проход"""
+        query = self.build_query(params)
+        schema = self.schema()
+        columns = schema["columns"]
+        pipeline = build_distribution_pipeline(query, columns, validated=schema["validated"])
+        with self.query_log.track("aggregate", self.collection, pipeline) as entry:
+            result = next(iter(self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit())), None)
+            entry['result_size'] = 1 if result else 0
+        stats, distributions = distributions_from_result(result, columns)
+        return {"stats": stats, "distributions": distributions}
+
+    def page(self, params):
+        query = self.build_query(params)
+        page = int_param(params, "page", 0, 0)
+        page_size = int_param(params, "page_size", 100, 1, MAX_PAGE_SIZE)
+        # Уникальный id в конце сортировки: страницы не пересекаются при равных значениях
+        sort_spec = with_tiebreaker(sort_param(params))
+
+        with self.query_log.track("find", self.collection, query) as entry:
+            cursor = self.collection.find(query, document_projection(), allow_disk_use=bool(sort_spec))
+            cursor = limit_cursor(cursor)
+            if sort_spec:
+                cursor = cursor.sort(sort_spec)
+            rows = list(cursor.skip(page * page_size).limit(page_size))
+            entry['result_size'] = len(rows)
+
+        return {"page": page, "page_size": page_size, "rows": rows}
+
+    def aggregate(self, params):
+        """group_by - колонка или список колонок; метрики - "metrics": [{"func", "column"}] и/или func/column.
+
+        Отдает одну страницу групп (page, page_size) и общее число групп; массивы значений
+        обрезаются до array_limit элементов с полным размером в колонке "... (всего)".
+        """
+        group_by = params.get("group_by")
+        group_by = [group_by] if isinstance(group_by, str) else list(group_by or [])
+
+        metrics = []
+        if params.get("func"):
+            metrics.append((params["func"], params.get("column", "")))
+        for item in params.get("metrics") or []:
+            if not isinstance(item, dict):
+                raise RequestError("Каждая метрика должна быть объектом {func, column}")
+            metrics.append((item.get("func"), item.get("column", "")))
+
+        if not group_by or not metrics or any(func not in AGGREGATION_FUNCTIONS for func, _ in metrics):
+            raise RequestError("Нужны group_by и функции из списка: " + ", ".join(AGGREGATION_FUNCTIONS))
+
+        sort_column, sort_direction = (sort_param(params) or [(None, 1)])[0]
+
+        page = int_param(params, "page", 0, 0)
+        page_size = int_param(params, "page_size", 100, 1, MAX_PAGE_SIZE)
+        array_limit = int_param(params, "array_limit", ARRAY_PREVIEW_SIZE, 1, MAX_PAGE_SIZE)
+
+        if has_approximate_metrics(metrics):
+            # Все группы считаются по скетчам (или одним проходом) и кэшируются вместе с ответом
+            try:
+                rows, _ = approximate_group_rows(self.collection, self.build_query(params), group_by, metrics,
+                                                 self.sketches, array_limit, self.query_log)
+            except ValueError as e:
+                raise RequestError(str(e))
+            rows = sort_rows(rows, sort_column, sort_direction, group_by)
+            return {"page": page, "page_size": page_size, "groups": len(rows),
+                    "rows": rows[page * page_size:(page + 1) * page_size]}
+
+        try:
+            pipeline = paginate_pipeline(
+                build_group_pipeline(self.build_query(params), group_by, metrics, sort_column,
+                                     sort_direction, array_limit=array_limit),
+                page * page_size, page_size)
+        except ValueError as e:
+            raise RequestError(str(e))
+
+        with self.query_log.track("aggregate", self.collection, pipeline) as entry:
+            results, total_groups = facet_page(self.collection.aggregate(pipeline, allowDiskUse=True, **time_limit()))
+            entry['result_size'] = len(results)
+
+        return {"page": page, "page_size": page_size, "groups": total_groups,
+                "rows": [group_result_row(record, group_by, metrics) for record in results]}
+
+
+class QueryServer:
+    """Асинхронный HTTP/JSON сервер; одинаковые одновременные запросы выполняются один раз"""
+
+    def __init__(self, service, host="127.0.0.1", port=8765):
+        self.service = service
+        self.host = host
+        self.port = port
+        self._inflight = {}
+        self.routes = {
+            ("GET", "/health"): None,
+            ("GET", "/schema"): self.service.schema,
+            ("POST", "/count"): self.service.count,
+            ("POST", "/stats"): self.service.stats,
+            ("POST", "/page"): self.service.page,
+            ("POST", "/aggregate"): self.service.aggregate,
+            ("POST", "/fuzzy"): self.service.fuzzy_search,
+        }
+
+    async def execute(self, path, handler, params):
+        """Отдает результат из кэша, присоединяется к уже идущему запросу или запускает новый в пуле"""
+        key = cache_key(path, params)
+        cached = self.service.cache.get(key)
+        if cached is not None:
+            return cached
+
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if params is None:
+                future = loop.run_in_executor(self.service.executor, handler)
+            else:
+                future = loop.run_in_executor(self.service.executor, handler, params)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        result = await asyncio.shield(future)
+        self.service.cache.put(key, result)
+        return result
+
+    async def dispatch(self, method, target, body):
+        path = urlsplit(target).path.rstrip("/") or "/"
+        if (method, path) not in self.routes:
+            return HTTPStatus.NOT_FOUND, {"error": f"Нет обработчика {method} {path}"}
+
+        if path == "/health":
+            return HTTPStatus.OK, {"status": "ok", "cache": self.service.cache.stats(),
+                                   "inflight": len(self._inflight)}
+
+        params = None
+        if method == "POST":
+            try:
+                params = json.loads(body.decode("utf-8") or "{}")
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                return HTTPStatus.BAD_REQUEST, {"error": f"Некорректный JSON: {e}"}
+            if not isinstance(params, dict):
+                return HTTPStatus.BAD_REQUEST, {"error": "Тело запроса должно быть JSON объектом"}
+
+        try:
+            return HTTPStatus.OK, await self.execute(path, self.routes[(method, path)], params)
+        except RequestError as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except Exception as e:
+            if is_timeout(e):
+                return HTTPStatus.GATEWAY_TIMEOUT, {"error": f"Запрос не уложился в лимит {max_time_ms()} мс"}
+            # Ошибка сервиса, а не клиента: в журнал с трассировкой, клиенту - 500
+            print(f"Ошибка обработки {method} {path}: {e}")
+            traceback.print_exc()
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Внутренняя ошибка сервиса"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.write_response(writer, HTTPStatus.BAD_REQUEST, {"error": "Некорректный запрос"}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.write_response(writer, HTTPStatus.BAD_REQUEST,
+                                              {"error": "Некорректный Content-Length"}, False)
+                    break
+                if length > MAX_BODY_SIZE:
+                    await self.write_response(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                              {"error": "Слишком большое тело запроса"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                status, payload = await self.dispatch(method.upper(), target, body)
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(json_safe(payload), ensure_ascii=False, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve_forever(self):
+        # Схему считаем заранее, чтобы первый клиент не ждал полного прохода по коллекции
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.service.executor, self.service.schema)
+
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Сервис запросов слушает http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный HTTP/JSON сервис запросов Nissan Vehicles")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", DEFAULT_URI))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    parser.add_argument("--pool-size", type=int, default=20, help="Размер пула соединений и потоков")
+    parser.add_argument("--cache-size", type=int, default=256, help="Максимум записей в кэше результатов")
+    parser.add_argument("--cache-ttl", type=float, default=30.0, help="Время жизни записи кэша, секунд")
+    args = parser.parse_args(argv)
+
+    service = QueryService(args.uri, args.db, args.collection, pool_size=args.pool_size,
+                           cache=ResultCache(args.cache_size, args.cache_ttl))
+    try:
+        asyncio.run(QueryServer(service, args.host, args.port).serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import os
+import time
+
+from collection_meta import DEFAULT_POLL_INTERVAL, INGEST_META_COLLECTION, bump_write_version
+
+
+# Теневые поля: строковые копии значений в нижнем регистре во вложенном документе _shadow.
+# По ним "начинается с" становится регулярным выражением с якорем без флага i (диапазон по индексу),
+# а текстовые условия по числовым колонкам обходятся без $expr и $toString
+SHADOW_FIELD = "_shadow"
+SHADOW_INDEX_PREFIX = "shadow_"
+DEFAULT_BATCH_SIZE = 5000
+# Целые значения float до этой границы $toString пишет без дробной части
+MAX_EXACT_FLOAT = 1e15
+
+
+def shadow_path(col):
+    return f"{SHADOW_FIELD}.{col}"
+
+
+def shadow_text(value):
+    """Строка для теневого поля: как $toString в MongoDB, в нижнем регистре; None - поле не пишется"""
+    if value is None or isinstance(value, (list, dict)):
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float):
+        if value != value:
+            return "nan"
+        if value.is_integer() and abs(value) < MAX_EXACT_FLOAT:
+            return str(int(value))
+        return repr(value).lower()
+    return str(value).lower()
+
+
+def shadow_document(doc, columns):
+    shadow = {}
+    for col in columns:
+        text = shadow_text(doc.get(col))
+        if text is not None:
+            shadow[col] = text
+    return shadow
+
+
+def add_shadow_fields(docs, columns):
+    """Дописывает теневые поля в документы перед вставкой (импорт, тестовые данные)"""
+    if columns:
+        for doc in docs:
+            doc[SHADOW_FIELD] = shadow_document(doc, columns)
+    return docs
+
+
+def document_projection(columns=None):
+    """Проекция для чтения документов: без _id и теневых полей (или только заданные колонки)"""
+    if columns:
+        projection = {"_id": 0}
+        projection.update({col: 1 for col in columns})
+        return projection
+    return {"_id": 0, SHADOW_FIELD: 0}
+
+
+# --- Метаданные: список колонок с теневыми полями хранится рядом с отметкой проверенного импорта ---
+
+def _meta(collection):
+    return collection.database[INGEST_META_COLLECTION]
+
+
+def shadow_columns(collection):
+    """Колонки, для которых у всех документов есть теневые поля и индексы"""
+    meta = _meta(collection).find_one({"_id": collection.name})
+    return list((meta or {}).get("shadow_columns") or [])
+
+
+def set_shadow_columns(collection, columns):
+    _meta(collection).update_one({"_id": collection.name}, {"$set": {"shadow_columns": list(columns)}},
+                                 upsert=True)
+
+
+def ensure_shadow_indexes(collection, columns):
+    for col in columns:
+        collection.create_index(shadow_path(col), name=f"{SHADOW_INDEX_PREFIX}{col}")
+
+
+def backfill_shadow_fields(collection, columns, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Пересчитывает теневые поля всех документов пачками; возвращает число обновленных"""
+    from pymongo import UpdateOne
+
+    projection = {col: 1 for col in columns}
+    updated = 0
+    batch = []
+    for doc in collection.find({}, projection, batch_size=batch_size):
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {SHADOW_FIELD: shadow_document(doc, columns)}}))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+            if progress is not None:
+                progress(updated)
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def enable_shadow_fields(collection, columns, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Заполняет теневые поля и индексы, затем отмечает колонки в метаданных.
+
+    Отметка ставится последней: до нее запросы строятся по исходным полям. Счетчик записей
+    в ingest_meta меняет отметку коллекции, и запущенные приложение и сервис перечитывают флаги.
+    """
+    updated = backfill_shadow_fields(collection, columns, batch_size, progress)
+    ensure_shadow_indexes(collection, columns)
+    set_shadow_columns(collection, columns)
+    bump_write_version(collection)
+    return updated
+
+
+def disable_shadow_fields(collection):
+    """Снимает отметку (запросы возвращаются к исходным полям, в запущенных процессах - со сменой
+    отметки коллекции, не позже чем через CollectionMetadata.poll_interval), затем удаляет поля и индексы"""
+    columns = shadow_columns(collection)
+    set_shadow_columns(collection, [])
+    bump_write_version(collection)
+    # Даем запущенным процессам заметить новую отметку, прежде чем поля пропадут
+    time.sleep(DEFAULT_POLL_INTERVAL)
+    for name in collection.index_information():
+        if name.startswith(SHADOW_INDEX_PREFIX):
+            collection.drop_index(name)
+    collection.update_many({SHADOW_FIELD: {"$exists": True}}, {"$unset": {SHADOW_FIELD: ""}})
+    return columns
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Теневые поля для поиска по началу строки через индекс")
+    parser.add_argument("command", choices=["enable", "disable", "info"])
+    parser.add_argument("--columns", help="Колонки через запятую (по умолчанию все колонки первого документа)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    collection = client[args.db][args.collection]
+
+    if args.command == "enable":
+        if args.columns:
+            columns = [col.strip() for col in args.columns.split(",") if col.strip()]
+        else:
+            columns = list((collection.find_one({}, document_projection()) or {}).keys())
+        start = time.perf_counter()
+        updated = enable_shadow_fields(collection, columns, args.batch_size,
+                                       progress=lambda count: print(f"\rОбновлено: {count:,}", end="", flush=True))
+        print(f"\rОбновлено: {updated:,} за {time.perf_counter() - start:.2f} с; колонки: {', '.join(columns)}")
+    elif args.command == "disable":
+        print(f"Удалены теневые поля: {', '.join(disable_shadow_fields(collection)) or 'нет'}")
+    else:
+        print(f"Теневые поля: {', '.join(shadow_columns(collection)) or 'нет'}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
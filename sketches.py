@@ -0,0 +1,505 @@
+import argparse
+import hashlib
+import math
+import os
+import time
+from datetime import datetime
+
+from pymongo import ReplaceOne
+
+from query_builder import (AGGREGATION_FUNCTIONS, normalize_metrics, is_approximate_metric,
+                           build_group_pipeline, group_result_row, metric_name)
+from query_timeouts import limit_cursor, time_limit
+from rollups import numeric_value, is_empty, rewrite_query
+
+
+REGISTRY_COLLECTION = "sketches"
+HLL_PRECISION = 12
+TDIGEST_COMPRESSION = 100
+
+# Квантиль для каждой приближенной функции t-digest
+QUANTILES = {"~p50": 0.5, "~p95": 0.95, "~p99": 0.99}
+
+
+def hll_key(value):
+    """Байтовое представление значения для хэша: 1 и 1.0 считаются одним значением, как в MongoDB"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return f"{type(value).__name__}:{value}".encode("utf-8")
+
+
+class HyperLogLog:
+    """Оценка количества уникальных значений; ошибка около 1.04 / sqrt(2^p), сливается поэлементным max"""
+
+    def __init__(self, p=HLL_PRECISION, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(hll_key(value), digest_size=8).digest(), "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("Нельзя объединить HyperLogLog с разной точностью")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Для малых количеств точнее линейный подсчет по пустым регистрам
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, p=HLL_PRECISION):
+        return cls(p, data)
+
+
+class TDigest:
+    """Сжатое распределение для квантилей (merging t-digest); точнее всего на хвостах"""
+
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.buffer) >= self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        self.buffer.extend(zip(other.means, other.weights))
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q_limit(self, q):
+        k = self._k(q) + 1
+        return 1.0 if k >= self.compression / 4 else (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        if not self.buffer:
+            return
+        items = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        total = sum(weight for _, weight in items)
+
+        means, weights = [], []
+        cumulative = 0
+        mean, weight = items[0]
+        q_limit = self._q_limit(0)
+        for next_mean, next_weight in items[1:]:
+            if (cumulative + weight + next_weight) / total <= q_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                cumulative += weight
+                q_limit = self._q_limit(cumulative / total)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    @property
+    def total(self):
+        self.compress()
+        return sum(self.weights)
+
+    def quantile(self, q):
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+
+        total = sum(self.weights)
+        target = q * total
+        if target <= self.weights[0] / 2:
+            return self.min + (self.means[0] - self.min) * target / (self.weights[0] / 2)
+
+        cumulative = 0
+        for i in range(len(self.means) - 1):
+            left = cumulative + self.weights[i] / 2
+            right = cumulative + self.weights[i] + self.weights[i + 1] / 2
+            if target <= right:
+                return self.means[i] + (self.means[i + 1] - self.means[i]) * (target - left) / (right - left)
+            cumulative += self.weights[i]
+
+        last_center = total - self.weights[-1] / 2
+        if self.weights[-1] <= 1 or target >= total:
+            return self.max
+        return self.means[-1] + (self.max - self.means[-1]) * (target - last_center) / (self.weights[-1] / 2)
+
+    def to_dict(self):
+        self.compress()
+        return {"c": [[mean, weight] for mean, weight in zip(self.means, self.weights)],
+                "min": self.min, "max": self.max, "compression": self.compression}
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data.get("compression", TDIGEST_COMPRESSION))
+        digest.means = [mean for mean, _ in data["c"]]
+        digest.weights = [weight for _, weight in data["c"]]
+        digest.min, digest.max = data.get("min"), data.get("max")
+        return digest
+
+
+class ColumnSketch:
+    """Скетчи одной колонки в одной партиции: уникальные значения и распределение чисел"""
+
+    def __init__(self, hll=None, digest=None):
+        self.hll = hll or HyperLogLog()
+        self.digest = digest or TDigest()
+
+    def add(self, value):
+        if is_empty(value):
+            return
+        self.hll.add(value)
+        number = numeric_value(value)
+        if number is not None:
+            self.digest.add(number)
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self.digest.merge(other.digest)
+        return self
+
+    def value(self, mongo_func):
+        if mongo_func == "~distinct":
+            return self.hll.count()
+        return self.digest.quantile(QUANTILES[mongo_func])
+
+    def to_doc(self):
+        return {"hll": self.hll.to_bytes(), "td": self.digest.to_dict()}
+
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(HyperLogLog.from_bytes(doc["hll"]), TDigest.from_dict(doc["td"]))
+
+
+def sketch_documents(docs, partition_by, columns):
+    """Один проход по документам: {ключ партиции: {колонка: ColumnSketch}}, количество, максимальный id"""
+    partitions = {}
+    total = 0
+    max_id = None
+    for doc in docs:
+        total += 1
+        doc_id = numeric_value(doc.get("id"))
+        if doc_id is not None and (max_id is None or doc_id > max_id):
+            max_id = doc_id
+
+        key = tuple(doc.get(col) for col in partition_by)
+        try:
+            sketches = partitions.get(key)
+        except TypeError:
+            key = tuple(str(part) for part in key)
+            sketches = partitions.get(key)
+        if sketches is None:
+            sketches = partitions[key] = {col: ColumnSketch() for col in columns}
+        for col in columns:
+            sketches[col].add(doc.get(col))
+    return partitions, total, max_id
+
+
+class SketchStore:
+    """Коллекция скетчей по партициям (ключам partition_by); партиции сливаются без пересчета"""
+
+    def __init__(self, db, definition):
+        self.db = db
+        self.definition = definition
+        self.name = definition["_id"]
+        self.partition_by = list(definition["partition_by"])
+        self.columns = list(definition["columns"])
+        self.collection = db[self.name]
+
+    @property
+    def count(self):
+        return self.definition.get("count", 0)
+
+    @property
+    def high_water_mark(self):
+        return self.definition.get("high_water_mark")
+
+    def match_for(self, group_by, columns, query):
+        """Условие $match по партициям, если скетчи отвечают на запрос, иначе None"""
+        if not set(group_by) <= set(self.partition_by) or not set(columns) <= set(self.columns):
+            return None
+        field_map = {col: f"_id.k{i}" for i, col in enumerate(self.partition_by)}
+        return rewrite_query(query or {}, field_map)
+
+    def merged(self, match, group_by, columns):
+        """Сливает скетчи подходящих партиций по ключам group_by: {ключ группы: {колонка: ColumnSketch}}"""
+        positions = [self.partition_by.index(col) for col in group_by]
+        projection = {"_id": 1}
+        projection.update({f"cols.{col}": 1 for col in columns})
+
+        groups = {}
+        for doc in self.collection.find(match or {}, projection):
+            key = tuple(doc["_id"].get(f"k{i}") for i in positions)
+            sketches = {col: ColumnSketch.from_doc(doc["cols"][col]) for col in columns}
+            if key in groups:
+                for col in columns:
+                    groups[key][col].merge(sketches[col])
+            else:
+                groups[key] = sketches
+        return groups
+
+
+class SketchManager:
+    """Реестр хранилищ скетчей коллекции и их инкрементальное обновление"""
+
+    def __init__(self, collection, query_log=None):
+        self.source = collection
+        self.db = collection.database
+        self.registry = self.db[REGISTRY_COLLECTION]
+        self.query_log = query_log
+
+    def stores(self):
+        return [SketchStore(self.db, definition) for definition in self.registry.find({"source": self.source.name})]
+
+    def find_for(self, group_by, columns, query):
+        """Подходящее хранилище и условие по нему: (SketchStore, $match) или (None, None)"""
+        for store in self.stores():
+            match = store.match_for(group_by, columns, query)
+            if match is not None:
+                return store, match
+        return None, None
+
+    def register(self, partition_by, columns, batch_size=50000):
+        """Регистрирует скетчи колонок columns по партициям partition_by и строит их"""
+        if not partition_by:
+            # Группировка всегда идет по ключам, поэтому хранилище без партиций не выбирается никогда
+            raise ValueError("Нужна хотя бы одна колонка партиций")
+        name = f"sketch_{self.source.name}_{'_'.join(partition_by)}"
+        existing = self.registry.find_one({"_id": name})
+        if existing:
+            columns = list(dict.fromkeys(list(existing["columns"]) + list(columns)))
+        self.registry.replace_one({"_id": name}, {"_id": name, "source": self.source.name,
+                                                  "partition_by": list(partition_by), "columns": list(columns)},
+                                  upsert=True)
+        return self.rebuild(SketchStore(self.db, self.registry.find_one({"_id": name})), batch_size)
+
+    def drop(self, name):
+        self.db[name].drop()
+        self.registry.delete_one({"_id": name})
+
+    def rebuild(self, store, batch_size=50000):
+        """Пересчитывает скетчи с нуля одним потоковым проходом по коллекции"""
+        store.collection.drop()
+        self.registry.update_one({"_id": store.name}, {"$set": {"count": 0},
+                                                       "$unset": {"high_water_mark": ""}})
+        self._apply_cursor(store, {}, batch_size)
+        return SketchStore(self.db, self.registry.find_one({"_id": store.name}))
+
+    def apply_documents(self, docs):
+        """Добавляет только что вставленные документы во все хранилища скетчей коллекции"""
+        docs = list(docs)
+        if not docs:
+            return
+        for store in self.stores():
+            self._apply(store, docs)
+
+    def catch_up(self, batch_size=50000):
+        """Догоняет скетчи по отметке id; при расхождении количества пересчитывает хранилище"""
+        total = self.source.count_documents({})
+        result = {}
+        for store in self.stores():
+            hwm = store.high_water_mark
+            added = -1
+            if hwm is not None:
+                added = self._apply_cursor(store, {"id": {"$gt": hwm}}, batch_size)
+
+            # Скетчи не умеют вычитать - удаления и изменения видны только по количеству
+            definition = self.registry.find_one({"_id": store.name})
+            if added < 0 or definition.get("count", 0) != total:
+                self.rebuild(store, batch_size)
+                added = -1
+            result[store.name] = added
+        return result
+
+    def _apply_cursor(self, store, query, batch_size):
+        projection = {"_id": 0, "id": 1}
+        projection.update({col: 1 for col in store.partition_by + store.columns})
+
+        added = 0
+        batch = []
+        cursor = self.source.find(query, projection, batch_size=batch_size)
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    added += self._apply(store, batch)
+                    batch = []
+            if batch:
+                added += self._apply(store, batch)
+        finally:
+            cursor.close()
+        return added
+
+    def _apply(self, store, docs):
+        partitions, total, max_id = sketch_documents(docs, store.partition_by, store.columns)
+
+        # Скетчи сливаются на клиенте: читаем затронутые партиции, объединяем и записываем целиком
+        key_docs = [{f"k{i}": part for i, part in enumerate(key)} for key in partitions]
+        existing = {tuple(doc["_id"].get(f"k{i}") for i in range(len(store.partition_by))): doc
+                    for doc in store.collection.find({"_id": {"$in": key_docs}})}
+
+        updates = []
+        for key, key_doc in zip(partitions, key_docs):
+            sketches = partitions[key]
+            previous = existing.get(key)
+            if previous is not None:
+                for col in store.columns:
+                    if col in previous.get("cols", {}):
+                        sketches[col].merge(ColumnSketch.from_doc(previous["cols"][col]))
+            updates.append(ReplaceOne({"_id": key_doc},
+                                      {"_id": key_doc, "cols": {col: sketch.to_doc()
+                                                                for col, sketch in sketches.items()}},
+                                      upsert=True))
+        if updates:
+            if self.query_log is not None:
+                with self.query_log.track("bulk_write", store.collection, {"replaces": len(updates)}) as entry:
+                    store.collection.bulk_write(updates, ordered=False)
+                    entry['result_size'] = len(updates)
+            else:
+                store.collection.bulk_write(updates, ordered=False)
+
+        update = {"$inc": {"count": total}, "$set": {"updated_at": datetime.now()}}
+        if max_id is not None:
+            update["$max"] = {"high_water_mark": max_id}
+        self.registry.update_one({"_id": store.name}, update)
+        return total
+
+
+def approximate_group_rows(collection, query, group_by, metrics, manager=None, array_limit=None, query_log=None,
+                           max_time_ms=None):
+    """Строки результата группировки с приближенными функциями (все группы, без сортировки).
+
+    Точные метрики считаются обычным $group, приближенные - по сохраненным скетчам партиций,
+    если хранилище подходит к ключам и фильтрам, иначе одним потоковым проходом по документам.
+    Проход по документам и $group ограничены max_time_ms (по умолчанию NISSAN_MAX_TIME_MS).
+    Возвращает (строки, имя хранилища скетчей или None).
+    """
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    metrics = normalize_metrics(metrics)
+    exact = [metric for metric in metrics if not is_approximate_metric(metric[0])]
+    approximate = [metric for metric in metrics if is_approximate_metric(metric[0])]
+    columns = list(dict.fromkeys(agg_col for _, agg_col in approximate))
+
+    rows = {}
+    if exact:
+        pipeline = build_group_pipeline(query, group_by, exact, array_limit=array_limit)
+        records = collection.aggregate(pipeline, allowDiskUse=True, **time_limit(max_time_ms))
+        if query_log is not None:
+            with query_log.track("aggregate", collection, pipeline) as entry:
+                records = list(records)
+                entry['result_size'] = len(records)
+        for record in records:
+            row = group_result_row(record, group_by, exact)
+            rows[tuple(row[col] for col in group_by)] = row
+
+    store, match = manager.find_for(group_by, columns, query) if manager is not None else (None, None)
+    if store is not None:
+        groups = store.merged(match, group_by, columns)
+    else:
+        projection = {"_id": 0}
+        projection.update({col: 1 for col in group_by + columns})
+        cursor = limit_cursor(collection.find(query, projection, batch_size=10000), max_time_ms)
+        try:
+            groups, _, _ = sketch_documents(cursor, group_by, columns)
+        finally:
+            cursor.close()
+
+    for key, sketches in groups.items():
+        row = rows.setdefault(key, {col: part for col, part in zip(group_by, key)})
+        for agg_func, agg_col in approximate:
+            row[metric_name(agg_func, agg_col)] = sketches[agg_col].value(AGGREGATION_FUNCTIONS[agg_func])
+
+    return list(rows.values()), store.name if store is not None else None
+
+
+def sort_rows(rows, column=None, direction=1, default_columns=()):
+    """Сортирует строки результата в памяти; пустые значения идут первыми, как null в MongoDB"""
+    columns = [column] if column else list(default_columns)
+
+    def sort_key(row):
+        parts = []
+        for col in columns:
+            value = row.get(col)
+            empty = value is None or (isinstance(value, float) and math.isnan(value))
+            parts.append((0, 0, "") if empty else
+                         (1, 0, value) if isinstance(value, (int, float)) else (1, 1, str(value)))
+        return parts
+
+    return sorted(rows, key=sort_key, reverse=direction < 0)
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Скетчи для приближенных уникальных значений и квантилей")
+    parser.add_argument("command", choices=["register", "catch-up", "list", "drop"])
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    parser.add_argument("--partition-by", help="Колонки партиций через запятую (register)")
+    parser.add_argument("--columns", default="price,km,performance,age",
+                        help="Колонки скетчей через запятую (register)")
+    parser.add_argument("--name", help="Имя хранилища (drop)")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    manager = SketchManager(client[args.db][args.collection])
+
+    start = time.perf_counter()
+    if args.command == "register":
+        partition_by = [col.strip() for col in (args.partition_by or "").split(",") if col.strip()]
+        if not partition_by:
+            raise SystemExit("Укажите --partition-by")
+        columns = [col.strip() for col in args.columns.split(",") if col.strip()]
+        store = manager.register(partition_by, columns)
+        print(f"{store.name}: {store.count:,} документов, {store.collection.count_documents({}):,} партиций")
+    elif args.command == "catch-up":
+        for name, added in manager.catch_up().items():
+            print(f"{name}: " + ("пересчитано" if added < 0 else f"добавлено документов: {added:,}"))
+    elif args.command == "drop":
+        if not args.name:
+            raise SystemExit("Укажите --name")
+        manager.drop(args.name)
+    else:
+        for store in manager.stores():
+            print(f"{store.name}: партиции {', '.join(store.partition_by) or '-'}; колонки {', '.join(store.columns)}; "
+                  f"{store.count:,} документов, отметка id={store.high_water_mark}")
+
+    print(f"Готово за {time.perf_counter() - start:.2f} с")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from collection_meta import write_version
+from shadow_fields import document_projection
+
+
+DEFAULT_SNAPSHOT_DIR = ".snapshot"
+SNAPSHOT_VERSION = 1
+UNIQUE_VALUES_LIMIT = 100
+
+
+def is_empty_value(value):
+    """Пустое значение в терминах статистики: None, NaN или строка из пробелов"""
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    if isinstance(value, str) and value.strip() == "":
+        return True
+    return False
+
+
+class ChunkedColumnWriter:
+    """Пишет колонку пачками во временные .npy, затем собирает один файл нужного типа и ширины"""
+
+    def __init__(self, temp_dir, name):
+        self.temp_dir = temp_dir
+        self.name = name
+        self.chunks = []
+        self.length = 0
+        self.numeric = True
+        self.integer = True
+        self.has_missing = False
+        self.max_width = 1
+
+    def append(self, values):
+        """values - список python значений одной колонки (None для отсутствующих)"""
+        for value in values:
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                self.has_missing = True
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.numeric = False
+                self.max_width = max(self.max_width, len(str(value)))
+            elif isinstance(value, float):
+                self.integer = False
+
+        path = os.path.join(self.temp_dir, f"{self.name}.{len(self.chunks)}.npy")
+        # Пачку храним как object-массив python значений; тип определим при сборке
+        np.save(path, np.array(values, dtype=object), allow_pickle=True)
+        self.chunks.append(path)
+        self.length += len(values)
+
+    def append_array(self, array, mask=None, integer=False, chunk_size=100000):
+        """Добавляет уже готовую колонку (из предыдущего снимка) кусками по chunk_size"""
+        # Строки максимальной ширины из старого снимка должны поместиться в новый
+        if array.dtype.kind == "U":
+            self.max_width = max(self.max_width, array.dtype.itemsize // 4)
+            if len(array):
+                self.numeric = False
+
+        for start in range(0, len(array), chunk_size):
+            values = array[start:start + chunk_size].tolist()
+            if mask is not None:
+                missing = mask[start:start + chunk_size].tolist()
+                values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+            elif array.dtype.kind == "f":
+                values = [None if math.isnan(value) else (int(value) if integer else value) for value in values]
+            self.append(values)
+
+    def dtype(self):
+        if self.numeric:
+            return np.dtype("int64") if self.integer and not self.has_missing else np.dtype("float64")
+        return np.dtype(f"<U{self.max_width}")
+
+    def finish(self, target_path, mask_path):
+        """Собирает итоговый массив через memmap, не загружая всю колонку в память"""
+        dtype = self.dtype()
+        data = np.lib.format.open_memmap(target_path, mode="w+", dtype=dtype, shape=(self.length,))
+        mask = None
+        if dtype.kind == "U":
+            mask = np.lib.format.open_memmap(mask_path, mode="w+", dtype=np.bool_, shape=(self.length,))
+
+        offset = 0
+        for chunk_path in self.chunks:
+            chunk = np.load(chunk_path, allow_pickle=True)
+            size = len(chunk)
+            if dtype.kind == "U":
+                missing = np.array([value is None for value in chunk], dtype=np.bool_)
+                data[offset:offset + size] = ["" if value is None else str(value) for value in chunk]
+                mask[offset:offset + size] = missing
+            else:
+                data[offset:offset + size] = [np.nan if value is None else value for value in chunk]
+            offset += size
+            os.remove(chunk_path)
+
+        data.flush()
+        del data
+        if mask is not None:
+            mask.flush()
+            del mask
+        return dtype
+
+
+class ColumnarSnapshot:
+    """Колоночный снимок коллекции на диске (.npy), открываемый через memory map"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.meta = None
+        self.arrays = {}
+        self.masks = {}
+        self.integer_columns = set()
+
+    @classmethod
+    def for_collection(cls, collection, base_dir=None):
+        base_dir = base_dir or os.environ.get("NISSAN_SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR)
+        name = f"{collection.database.name}.{collection.name}"
+        return cls(os.path.join(base_dir, name))
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def exists(self):
+        return os.path.exists(self.meta_path)
+
+    # --- Чтение ---
+
+    def load(self):
+        """Открывает снимок через mmap; возвращает False, если снимка нет или он поврежден"""
+        if not self.exists():
+            return False
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != SNAPSHOT_VERSION:
+                return False
+
+            arrays, masks, integer_columns = {}, {}, set()
+            for col, files in meta["files"].items():
+                if files.get("integer"):
+                    integer_columns.add(col)
+                arrays[col] = np.load(os.path.join(self.directory, files["data"]), mmap_mode="r")
+                if files.get("mask"):
+                    masks[col] = np.load(os.path.join(self.directory, files["mask"]), mmap_mode="r")
+
+            self.meta, self.arrays, self.masks = meta, arrays, masks
+            self.integer_columns = integer_columns
+            return True
+        except Exception as e:
+            print(f"Ошибка чтения снимка {self.directory}: {e}")
+            return False
+
+    @property
+    def columns(self):
+        return self.meta["columns"] if self.meta else []
+
+    @property
+    def count(self):
+        return self.meta["count"] if self.meta else 0
+
+    @property
+    def high_water_mark(self):
+        return self.meta.get("high_water_mark") if self.meta else None
+
+    def value(self, col, index):
+        array = self.arrays[col]
+        mask = self.masks.get(col)
+        if mask is not None:
+            return None if mask[index] else str(array[index])
+        value = array[index].item()
+        if isinstance(value, float):
+            if math.isnan(value):
+                return None
+            if col in self.integer_columns:
+                return int(value)
+        return value
+
+    def page(self, skip, limit):
+        """Строки снимка в порядке id, как они показываются без сортировки"""
+        end = min(self.count, skip + limit)
+        rows = []
+        for index in range(skip, end):
+            rows.append({col: self.value(col, index) for col in self.columns})
+        return rows
+
+    # --- Запись ---
+
+    def build(self, collection, batch_size=50000, query_log=None):
+        """Полностью строит снимок из коллекции потоковым проходом по id"""
+        self._write(collection, {}, previous=None, batch_size=batch_size, query_log=query_log)
+
+    def catch_up(self, collection, batch_size=50000, query_log=None):
+        """Дописывает документы с id больше сохраненной отметки; при заменах документов
+        или расхождении количества перестраивает снимок.
+
+        Возвращает количество добавленных документов (или -1 при полной перестройке).
+        """
+        if not self.load():
+            self.build(collection, batch_size, query_log)
+            self.load()
+            return -1
+
+        # Замены и удаления документов (счетчик записей импорта) отметка по id не видит - перестраиваем
+        if self.meta.get("write_version") != write_version(collection):
+            self.build(collection, batch_size, query_log)
+            self.load()
+            return -1
+
+        hwm = self.high_water_mark
+        query = {"id": {"$gt": hwm}} if hwm is not None else {}
+        added = collection.count_documents(query)
+        if added:
+            self._write(collection, query, previous=self, batch_size=batch_size, query_log=query_log)
+            self.load()
+
+        # Изменения и удаления старых документов отметка по id не видит - проверяем количество
+        if self.count != collection.count_documents({}):
+            self.build(collection, batch_size, query_log)
+            self.load()
+            return -1
+        return added
+
+    def _write(self, collection, query, previous, batch_size, query_log):
+        os.makedirs(self.directory, exist_ok=True)
+        generation = int(time.time() * 1000)
+        # Счетчик читается до прохода: запись во время прохода даст перестройку при следующем догоне
+        current_write_version = write_version(collection)
+        temp_dir = tempfile.mkdtemp(prefix="chunks-", dir=self.directory)
+
+        try:
+            writers = {}
+            columns = list(previous.columns) if previous else []
+            column_stats = {col: dict(stats) for col, stats in (previous.meta["column_stats"].items()
+                                                               if previous else [])}
+            unique_values = {col: (set(values) if values is not None else None)
+                             for col, values in (previous.meta["unique_values"].items() if previous else [])}
+            count = previous.count if previous else 0
+            hwm = previous.high_water_mark if previous else None
+
+            def writer_for(col):
+                if col not in writers:
+                    writers[col] = ChunkedColumnWriter(temp_dir, str(len(writers)))
+                    # Новая колонка: у предыдущих строк значения нет
+                    if count:
+                        writers[col].append([None] * count)
+                return writers[col]
+
+            if previous:
+                for col in columns:
+                    writers[col] = ChunkedColumnWriter(temp_dir, str(len(writers)))
+                    writers[col].append_array(previous.arrays[col], previous.masks.get(col),
+                                              col in previous.integer_columns)
+
+            cursor = collection.find(query, document_projection()).sort("id", 1).batch_size(batch_size)
+            batch = []
+
+            def flush(batch):
+                nonlocal count, hwm
+                for record in batch:
+                    for col in record:
+                        if col not in columns:
+                            columns.append(col)
+                            column_stats[col] = {'non_empty': 0}
+                            unique_values[col] = set()
+                for col in columns:
+                    values = [record.get(col) for record in batch]
+                    writer_for(col).append(values)
+
+                    stats = column_stats.setdefault(col, {'non_empty': 0})
+                    non_empty = [value for value in values if not is_empty_value(value)]
+                    stats['non_empty'] += len(non_empty)
+
+                    uniques = unique_values.get(col)
+                    if uniques is not None:
+                        uniques.update(str(value) for value in non_empty)
+                        if len(uniques) >= UNIQUE_VALUES_LIMIT:
+                            unique_values[col] = None
+                count += len(batch)
+                ids = [record.get("id") for record in batch if isinstance(record.get("id"), (int, float))]
+                if ids:
+                    hwm = max(ids) if hwm is None else max(hwm, max(ids))
+
+            if query_log is not None:
+                with query_log.track("find", collection, query) as entry:
+                    for record in cursor:
+                        batch.append(record)
+                        if len(batch) >= batch_size:
+                            flush(batch)
+                            batch = []
+                    if batch:
+                        flush(batch)
+                    entry['result_size'] = count
+            else:
+                for record in cursor:
+                    batch.append(record)
+                    if len(batch) >= batch_size:
+                        flush(batch)
+                        batch = []
+                if batch:
+                    flush(batch)
+
+            files, column_types = {}, {}
+            for i, col in enumerate(columns):
+                data_name = f"g{generation}.c{i}.npy"
+                mask_name = f"g{generation}.c{i}.mask.npy"
+                dtype = writers[col].finish(os.path.join(self.directory, data_name),
+                                            os.path.join(self.directory, mask_name))
+                files[col] = {"data": data_name, "mask": mask_name if dtype.kind == "U" else None,
+                              # Целые с пропусками хранятся как float64, но показываются как целые
+                              "integer": writers[col].numeric and writers[col].integer}
+                column_types[col] = "object" if dtype.kind == "U" else str(dtype)
+
+            for col, stats in column_stats.items():
+                stats['total'] = count
+                stats['empty'] = count - stats['non_empty']
+                stats['fill_rate'] = (stats['non_empty'] / count * 100) if count > 0 else 0
+
+            meta = {
+                "version": SNAPSHOT_VERSION,
+                "generation": generation,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "count": count,
+                "high_water_mark": hwm,
+                "write_version": current_write_version,
+                "columns": columns,
+                "column_types": column_types,
+                "column_stats": column_stats,
+                "unique_values": {col: (sorted(values) if values is not None else None)
+                                  for col, values in unique_values.items()},
+                "files": files,
+            }
+
+            # Атомарно подменяем meta.json: читатели видят либо старое, либо новое поколение
+            temp_meta = os.path.join(self.directory, f"meta.{generation}.json")
+            with open(temp_meta, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(temp_meta, self.meta_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # Файлы прошлых поколений больше не нужны (открытые mmap остаются валидными до закрытия)
+        for path in glob.glob(os.path.join(self.directory, "g*.npy")):
+            if not os.path.basename(path).startswith(f"g{generation}."):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def main(argv=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Колоночный снимок коллекции на диске")
+    parser.add_argument("command", choices=["build", "catch-up", "info"])
+    parser.add_argument("--uri", default=os.environ.get("NISSAN_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="nissan")
+    parser.add_argument("--collection", default="vehicles")
+    parser.add_argument("--dir", default=None, help="Каталог снимков (по умолчанию NISSAN_SNAPSHOT_DIR или .snapshot)")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    collection = client[args.db][args.collection]
+    snapshot = ColumnarSnapshot.for_collection(collection, args.dir)
+
+    start = time.perf_counter()
+    if args.command == "build":
+        snapshot.build(collection)
+        snapshot.load()
+    elif args.command == "catch-up":
+        added = snapshot.catch_up(collection)
+        print("Снимок перестроен" if added < 0 else f"Добавлено документов: {added:,}")
+    elif not snapshot.load():
+        print(f"Снимка нет: {snapshot.directory}")
+        return
+
+    print(f"{snapshot.directory}: {snapshot.count:,} документов, колонок {len(snapshot.columns)}, "
+          f"отметка id={snapshot.high_water_mark}, {time.perf_counter() - start:.2f} с")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import threading
+
+
+# Уникальная колонка, добавляемая в конец сортировки: без нее порядок равных значений
+# между запросами не определен, и при листании записи повторяются или пропускаются
+TIEBREAKER = "id"
+# С какого числа отфильтрованных записей сортировка без индекса считается опасной:
+# стадия SORT в памяти сервера ограничена (100 МБ), дальше - ошибка или сброс на диск
+SORT_INDEX_WARN_ROWS = 100_000
+SORT_INDEX_PREFIX = "sort_"
+
+
+def toggle_sort(sort_spec, column, additive=False):
+    """Новая сортировка после клика по заголовку.
+
+    Обычный клик сортирует только по колонке (повторный - меняет направление),
+    additive (Shift) добавляет колонку в конец или меняет направление уже выбранной.
+    """
+    sort_spec = list(sort_spec or [])
+    positions = {col: i for i, (col, _) in enumerate(sort_spec)}
+    if additive:
+        if column in positions:
+            i = positions[column]
+            sort_spec[i] = (column, -sort_spec[i][1])
+        else:
+            sort_spec.append((column, 1))
+        return sort_spec
+    if len(sort_spec) == 1 and column in positions:
+        return [(column, -sort_spec[0][1])]
+    return [(column, 1)]
+
+
+def with_tiebreaker(sort_spec, tiebreaker=TIEBREAKER):
+    """Сортировка с уникальной колонкой в конце (в направлении последней колонки - так подходит больше индексов)"""
+    sort_spec = list(sort_spec or [])
+    if not sort_spec or any(col == tiebreaker for col, _ in sort_spec):
+        return sort_spec
+    return sort_spec + [(tiebreaker, sort_spec[-1][1])]
+
+
+def sort_symbols(sort_spec):
+    """Значки для заголовков: колонка -> " ↑" (или " ↑2" при сортировке по нескольким колонкам)"""
+    symbols = {}
+    for i, (col, direction) in enumerate(sort_spec or []):
+        arrow = " ↑" if direction == 1 else " ↓"
+        symbols[col] = f"{arrow}{i + 1}" if len(sort_spec) > 1 else arrow
+    return symbols
+
+
+def equality_fields(query):
+    """Колонки с условием равенства на верхнем уровне запроса: в индексе они могут стоять перед сортировкой"""
+    fields = set()
+    for part in (query or {}).get("$and", [query or {}]):
+        for col, condition in part.items():
+            if col.startswith("$"):
+                continue
+            if not isinstance(condition, dict) or set(condition) == {"$eq"}:
+                fields.add(col)
+    return fields
+
+
+def index_supports_sort(keys, sort_spec, equal=()):
+    """Подходит ли индекс (список (поле, направление)) для сортировки без стадии SORT в памяти.
+
+    Ключи индекса должны совпадать с сортировкой по порядку и направлениям (или все направления
+    обратные); перед ними допустимы поля с условием равенства.
+    """
+    keys = [(field, direction) for field, direction in keys if direction in (1, -1)]
+    start = 0
+    while start < len(keys) and keys[start][0] in equal and keys[start][0] not in dict(sort_spec):
+        start += 1
+    prefix = keys[start:start + len(sort_spec)]
+    if len(prefix) < len(sort_spec):
+        return False
+    forward = all(key == (col, direction) for key, (col, direction) in zip(prefix, sort_spec))
+    backward = all(key == (col, -direction) for key, (col, direction) in zip(prefix, sort_spec))
+    return forward or backward
+
+
+def index_name(sort_spec):
+    return SORT_INDEX_PREFIX + "_".join(f"{col}_{direction}" for col, direction in sort_spec)
+
+
+class SortIndexAdvisor:
+    """Проверяет, есть ли у коллекции составной индекс под сортировку, и создает его.
+
+    Список индексов кэшируется и перечитывается после создания индекса через advisor.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._indexes = None
+        self._lock = threading.Lock()
+
+    def indexes(self):
+        with self._lock:
+            if self._indexes is None:
+                self._indexes = [info["key"] for info in self.collection.index_information().values()]
+            return self._indexes
+
+    def supporting_index(self, sort_spec, query=None):
+        """Ключи подходящего индекса или None; сортировка по одному _id индекса не требует"""
+        if not sort_spec or list(sort_spec) == [("_id", 1)] or list(sort_spec) == [("_id", -1)]:
+            return []
+        equal = equality_fields(query)
+        for keys in self.indexes():
+            if index_supports_sort(list(keys), sort_spec, equal):
+                return list(keys)
+        return None
+
+    def create_index(self, sort_spec):
+        name = self.collection.create_index(list(sort_spec), name=index_name(sort_spec))
+        with self._lock:
+            self._indexes = None
+        return name
@@ -0,0 +1,313 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from distributions import HISTOGRAM_BINS, TOP_VALUES
+from sketches import HLL_PRECISION, HyperLogLog, TDigest
+from type_registry import MAX_TRACKED_VALUES, MIXED, NUMBER, STRING
+
+
+DEFAULT_BATCH_SIZE = 10_000
+# Счетчиков частых значений на колонку (Misra-Gries): значение с долей больше 1/1000 не теряется,
+# недосчет частоты не больше числа документов / 1000
+TOP_CAPACITY = 1_000
+# Центроидов t-digest из одной пачки чисел (отсортированная пачка делится на равные по числу части)
+DIGEST_PARTS = 200
+# Как в прежнем detect_schema: значения для фильтров кэшируются, если их меньше 100, не больше 50
+UNIQUE_CACHE_LIMIT = 100
+UNIQUE_CACHE_SIZE = 50
+
+_NUMBER_TYPES = {int, float}
+
+
+def add_to_digest(digest, array, parts=DIGEST_PARTS):
+    """Добавляет пачку чисел в t-digest одной операцией: части отсортированной пачки становятся центроидами"""
+    array = np.sort(array)
+    parts = min(parts, array.size)
+    bounds = np.linspace(0, array.size, parts + 1).astype(np.intp)
+    sizes = np.diff(bounds)
+    means = np.add.reduceat(array, bounds[:-1]) / sizes
+    digest.buffer.extend(zip(means.tolist(), sizes.tolist()))
+    low, high = float(array[0]), float(array[-1])
+    digest.min = low if digest.min is None else min(digest.min, low)
+    digest.max = high if digest.max is None else max(digest.max, high)
+    digest.compress()
+
+
+def digest_buckets(digest, bins=HISTOGRAM_BINS):
+    """Гистограмма равной ширины от min до max по функции распределения t-digest (как np.histogram)"""
+    digest.compress()
+    total = sum(digest.weights)
+    low, high = digest.min, digest.max
+    if low == high:
+        # np.histogram на одном значении строит корзины шириной 1/bins вокруг него
+        edges = np.linspace(low - 0.5, high + 0.5, bins + 1)
+        counts = np.zeros(bins, dtype=np.int64)
+        counts[bins // 2] = total
+    else:
+        weights = np.asarray(digest.weights, dtype=np.float64)
+        xs = np.concatenate([[low], digest.means, [high]])
+        ys = np.concatenate([[0], np.cumsum(weights) - weights / 2, [total]])
+        edges = np.linspace(low, high, bins + 1)
+        counts = np.diff(np.round(np.interp(edges, xs, ys)).astype(np.int64))
+    return [[float(edges[i]), float(edges[i + 1]), int(count)] for i, count in enumerate(counts)]
+
+
+def exact_numeric_distribution(counter, bins=HISTOGRAM_BINS):
+    """Гистограмма и медиана по точным частотам значений {число: количество}, как numeric_distribution"""
+    values = np.fromiter(counter.keys(), dtype=np.float64, count=len(counter))
+    counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+    order = np.argsort(values)
+    values, cumulative = values[order], np.cumsum(counts[order])
+    total = int(cumulative[-1])
+    # Медиана как в np.median: среднее двух средних элементов при четном количестве
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2, side="right")]
+    upper = values[np.searchsorted(cumulative, total // 2, side="right")]
+    histogram, edges = np.histogram(values, bins=bins, weights=counts[order])
+    return {
+        "kind": "numeric",
+        "min": float(values[0]),
+        "median": float((lower + upper) / 2),
+        "max": float(values[-1]),
+        "buckets": [[float(edges[i]), float(edges[i + 1]), int(count)] for i, count in enumerate(histogram)],
+    }
+
+
+def hash_values(values):
+    """64-битные хэши значений без цикла в Python; числа хэшируются как float64 (1 и 1.0 - одно значение)"""
+    numbers = [value for value in values if type(value) in _NUMBER_TYPES]
+    others = [value for value in values if type(value) not in _NUMBER_TYPES]
+    hashes = [pd.util.hash_array(np.asarray(numbers, dtype=np.float64))] if numbers else []
+    if others:
+        array = np.empty(len(others), dtype=object)
+        array[:] = others
+        hashes.append(pd.util.hash_array(array, categorize=False))
+    return np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
+
+def update_registers(registers, hashes, p=HLL_PRECISION):
+    """Регистры HyperLogLog по пачке хэшей (та же схема, что HyperLogLog.add)"""
+    index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    # Длина в битах: остаток меньше 2^53 и переводится во float64 без потерь
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    np.maximum.at(registers, index, ((64 - p) - bit_length + 1).astype(np.uint8))
+
+
+class ColumnStats:
+    """Статистика одной колонки за один проход: память не зависит от числа документов.
+
+    Точные: количество пустых (None, NaN, отсутствует, строка из пробелов), типы значений, min/max чисел,
+    набор различных значений, пока их не больше MAX_TRACKED_VALUES, частоты, пока их не больше TOP_CAPACITY.
+    Приближенные: число различных значений (HyperLogLog), медиана и гистограмма (t-digest),
+    частые значения (Misra-Gries).
+    """
+
+    def __init__(self, rows=0):
+        # Колонка могла впервые встретиться не в первой пачке: предыдущие документы считаются пустыми
+        self.rows = rows
+        self.missing = rows
+        self.blank = 0
+        self.types = set()
+        self.min = None
+        self.max = None
+        self.digest = TDigest()
+        self.registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+        self.values = set()  # None - различных значений больше MAX_TRACKED_VALUES
+        self.top = Counter()
+        self.top_exact = True  # Частоты точные, пока счетчики ни разу не урезались
+
+    def update(self, values):
+        self.rows += len(values)
+        present = [value for value in values if value is not None and value == value]  # NaN != NaN
+        self.missing += len(values) - len(present)
+        if not present:
+            return
+        batch_types = set(map(type, present))
+        self.types |= batch_types
+
+        numbers = present if batch_types <= _NUMBER_TYPES else [
+            value for value in present if type(value) in _NUMBER_TYPES]
+        if numbers:
+            array = np.asarray(numbers, dtype=np.float64)
+            low, high = min(numbers), max(numbers)
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+            add_to_digest(self.digest, array)
+
+        # Частые значения - как в categorical_distribution: строки без пробелов по краям, пустые не считаются
+        top = Counter(value.strip() if type(value) is str else value for value in present)
+        self.blank += top.pop("", 0)
+        self.top.update(top)
+        if len(self.top) > TOP_CAPACITY:
+            counts = np.fromiter(self.top.values(), dtype=np.int64, count=len(self.top))
+            cut = np.partition(counts, -(TOP_CAPACITY + 1))[-(TOP_CAPACITY + 1)]
+            self.top = Counter({value: count - cut for value, count in self.top.items() if count > cut})
+            self.top_exact = False
+
+        distinct = set(present)
+        update_registers(self.registers, hash_values(list(distinct)))
+        if self.values is not None:
+            self.values |= distinct
+            if len(self.values) > MAX_TRACKED_VALUES:
+                self.values = None
+
+    @property
+    def non_empty(self):
+        return self.rows - self.missing - self.blank
+
+    @property
+    def numeric(self):
+        return bool(self.types) and self.types <= _NUMBER_TYPES
+
+    def distinct(self):
+        """Число различных непустых значений: точное, пока набор или частоты хранятся, иначе оценка HyperLogLog"""
+        if self.values is not None:
+            return len(self.values)
+        if self.top_exact and str not in self.types:
+            # У строк счетчики ведутся без пробелов по краям, у чисел - по самим значениям
+            return len(self.top)
+        return HyperLogLog(HLL_PRECISION, self.registers.tobytes()).count()
+
+    def fill_stats(self, total=None):
+        total = self.rows if total is None else total
+        return {'total': total, 'non_empty': self.non_empty, 'empty': total - self.non_empty,
+                'fill_rate': (self.non_empty / total * 100) if total > 0 else 0}
+
+    def dtype(self):
+        """dtype, который получила бы колонка в pd.DataFrame(records)"""
+        if self.types <= {int} and self.types and not self.missing:
+            return "int64"
+        if self.numeric:
+            return "float64"
+        if self.types <= {bool} and self.types and not self.missing:
+            return "bool"
+        if self.types <= {str} and self.types:
+            return "str"
+        return "object"
+
+    def kind(self):
+        """Вид колонки для показа: int - целые, float - два знака после запятой, text/object - строкой"""
+        if self.types <= {int} and self.types:
+            return "int"
+        if self.numeric:
+            return "float"
+        if self.types <= {str}:
+            return "text"
+        return "object"
+
+    def registry_type(self):
+        if self.numeric:
+            return NUMBER
+        return STRING if self.types <= {str} else MIXED
+
+    def registry_stats(self):
+        kind = self.registry_type()
+        return {"min": self.min if kind == NUMBER else None,
+                "max": self.max if kind == NUMBER else None,
+                "distinct": self.distinct(),
+                "values": set(self.values) if self.values is not None else None}
+
+    def distribution(self):
+        """Как distributions.column_distribution: гистограмма для чисел, частые значения для остальных"""
+        if self.numeric and self.top_exact:
+            # Различных чисел немного (возраст, мощность): частоты известны точно
+            return exact_numeric_distribution(self.top)
+        if self.numeric:
+            return {"kind": "numeric", "min": float(self.min), "median": float(self.digest.quantile(0.5)),
+                    "max": float(self.max), "buckets": digest_buckets(self.digest)}
+        if not self.non_empty:
+            return None
+        top = Counter()
+        for value, count in self.top.items():
+            top[str(value)] += count
+        distinct = len(top) if self.top_exact else self.distinct()
+        return {"kind": "categorical", "distinct": distinct, "non_empty": self.non_empty,
+                "top": [[value, int(count)] for value, count in top.most_common(TOP_VALUES)]}
+
+    def unique_values(self):
+        """Значения для списков в фильтрах, если их немного; иначе None"""
+        if self.values is None or len(self.values) >= UNIQUE_CACHE_LIMIT:
+            return None
+        return sorted(str(value) for value in self.values)[:UNIQUE_CACHE_SIZE]
+
+
+class StreamingStats:
+    """Статистика по колонкам коллекции, собираемая пачками документов.
+
+    Колонки берутся из columns или по порядку первого появления в документах (как в pd.DataFrame).
+    В памяти - только текущая пачка и статистика ColumnStats по каждой колонке.
+    """
+
+    def __init__(self, columns=None):
+        self.rows = 0
+        self.discover = columns is None
+        self.columns = {col: ColumnStats() for col in columns or []}
+
+    def update(self, docs):
+        if self.discover:
+            new = set().union(*docs) - self.columns.keys() - {"_id"}
+            if new:
+                for doc in docs:
+                    for col in doc:
+                        if col in new and col not in self.columns:
+                            self.columns[col] = ColumnStats(self.rows)
+        for col, stats in self.columns.items():
+            stats.update([doc.get(col) for doc in docs])
+        self.rows += len(docs)
+
+    def consume(self, cursor, batch_size=DEFAULT_BATCH_SIZE):
+        """Читает курсор пачками по batch_size документов"""
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                self.update(batch)
+                batch = []
+        if batch:
+            self.update(batch)
+        return self
+
+    def column_stats(self, total=None):
+        return {col: stats.fill_stats(total) for col, stats in self.columns.items()}
+
+    def distributions(self):
+        return {col: stats.distribution() for col, stats in self.columns.items()}
+
+    def column_types(self):
+        return {col: stats.dtype() for col, stats in self.columns.items()}
+
+    def column_kinds(self):
+        return {col: stats.kind() for col, stats in self.columns.items()}
+
+    def registry_types(self):
+        return {col: stats.registry_type() for col, stats in self.columns.items()}
+
+    def registry_stats(self):
+        """Статистика для TypeRegistry.set_stats: у смешанных колонок ее нет (условия по ним не отсекаются)"""
+        return {col: stats.registry_stats() for col, stats in self.columns.items()
+                if stats.registry_type() != MIXED}
+
+    def unique_values(self):
+        return {col: values for col, values in ((col, stats.unique_values()) for col, stats in self.columns.items())
+                if values is not None}
+
+
+def collect_stats(collection, query=None, columns=None, projection=None, batch_size=DEFAULT_BATCH_SIZE,
+                  query_log=None, max_time_ms=None):
+    """Статистика по документам запроса одним потоковым проходом курсора"""
+    cursor = collection.find(query or {}, projection, batch_size=batch_size)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+    stats = StreamingStats(columns)
+    try:
+        if query_log is not None:
+            with query_log.track("find", collection, query or {}) as entry:
+                stats.consume(cursor, batch_size)
+                entry['result_size'] = stats.rows
+        else:
+            stats.consume(cursor, batch_size)
+    finally:
+        cursor.close()
+    return stats
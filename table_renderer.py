@@ -0,0 +1,100 @@
+import time
+
+
+FRAME_BUDGET_MS = 8  # Время на одну порцию вставки, чтобы окно успевало перерисовываться
+CHECK_EVERY = 16  # Как часто (в строках) сверяться с бюджетом кадра
+ROW_TAGS = ("even_row", "odd_row")
+ROW_COLORS = {"even_row": "#2b2b2b", "odd_row": "#252525"}
+
+
+class TreeRenderer:
+    """Показ страницы в ttk.Treeview без полной перерисовки.
+
+    Строки идентифицируются позицией на странице (iid "0", "1", ...): новая страница сравнивается
+    с показанной, у совпадающих позиций меняются только отличающиеся значения, лишние строки
+    удаляются одним вызовом, недостающие вставляются сразу с тегом цвета. Работа делится на порции
+    не дольше frame_budget_ms, следующая порция планируется через after, поэтому окно
+    не замирает на больших страницах. Новый вызов render отменяет незавершенный.
+    """
+
+    def __init__(self, tree, frame_budget_ms=FRAME_BUDGET_MS):
+        self.tree = tree
+        self.frame_budget = frame_budget_ms / 1000
+        self.columns = ()
+        self.rows = []  # Значения, которые сейчас показаны в дереве
+        self.max_slice_ms = 0.0  # Самая долгая порция последнего render (для бенчмарка)
+        self._pending = []
+        self._position = 0
+        self._job = None
+        self._on_done = None
+
+        # Теги настраиваются один раз, а не на каждую страницу
+        for tag in ROW_TAGS:
+            tree.tag_configure(tag, background=ROW_COLORS[tag])
+
+    @property
+    def busy(self):
+        return self._job is not None
+
+    def cancel(self):
+        """Отменяет незавершенную вставку; уже показанные строки остаются согласованными с self.rows"""
+        if self._job is not None:
+            self.tree.after_cancel(self._job)
+            self._job = None
+
+    def clear(self):
+        self.cancel()
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+        self.rows = []
+
+    def render(self, columns, rows, on_done=None, scroll_top=True):
+        """Показывает строки (списки отформатированных значений в порядке columns)"""
+        self.cancel()
+        columns = tuple(columns)
+        if columns != self.columns:
+            # Значения старых строк относятся к другим колонкам - сравнивать не с чем
+            self.clear()
+            self.columns = columns
+
+        rows = [tuple(values) for values in rows]
+        if len(self.rows) > len(rows):
+            self.tree.delete(*[str(i) for i in range(len(rows), len(self.rows))])
+            del self.rows[len(rows):]
+        if scroll_top:
+            self.tree.yview_moveto(0)
+
+        self._pending = rows
+        self._position = 0
+        self._on_done = on_done
+        self.max_slice_ms = 0.0
+        self._run()
+
+    def _run(self):
+        self._job = None
+        start = time.perf_counter()
+        deadline = start + self.frame_budget
+        tree, shown, rows = self.tree, self.rows, self._pending
+
+        i = self._position
+        while i < len(rows):
+            values = rows[i]
+            if i < len(shown):
+                if shown[i] != values:
+                    tree.item(str(i), values=values)
+                    shown[i] = values
+            else:
+                tree.insert("", "end", iid=str(i), values=values, tags=(ROW_TAGS[i % 2],))
+                shown.append(values)
+            i += 1
+            if i % CHECK_EVERY == 0 and time.perf_counter() >= deadline:
+                break
+        self._position = i
+
+        self.max_slice_ms = max(self.max_slice_ms, (time.perf_counter() - start) * 1000)
+        if i < len(rows):
+            self._job = tree.after(1, self._run)
+        elif self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            on_done()
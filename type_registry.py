@@ -0,0 +1,169 @@
+import os
+
+from collection_meta import tracks_writes
+
+
+# Типы колонок для построения запросов
+NUMBER = "number"  # Только числа: сравнения без $toString, статистика пригодна для отсечения условий
+STRING = "string"
+MIXED = "mixed"  # Числа и строки вперемешку: regex идет через $toString, отсечения нет
+TYPES = (NUMBER, STRING, MIXED)
+
+# Для колонок с малым числом различных значений хранится весь набор значений
+MAX_TRACKED_VALUES = 256
+TYPES_ENV = "NISSAN_COLUMN_TYPES"  # Ручные типы: "col:number,col2:string"
+
+
+def overrides_from_env():
+    """Ручные типы колонок из NISSAN_COLUMN_TYPES (перекрывают определенные по данным)"""
+    overrides = {}
+    for item in os.environ.get(TYPES_ENV, "").split(","):
+        col, _, kind = item.partition(":")
+        if col.strip() and kind.strip() in TYPES:
+            overrides[col.strip()] = kind.strip()
+    return overrides
+
+
+def type_from_dtype(dtype):
+    """Тип по строке dtype (column_types из detect_schema и снимка)"""
+    dtype = str(dtype).lower()
+    if dtype.startswith(("int", "uint", "float")):
+        return NUMBER
+    if dtype in ("object", "str", "string"):
+        return STRING
+    return MIXED
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class TypeRegistry:
+    """Типы колонок и их статистика (min/max, число различных значений) для построителя запросов.
+
+    Типы определяются по схеме (detect_schema, снимок, метаданные импорта) и перекрываются вручную.
+    Статистика привязана к версии коллекции (отметке записи): после изменения коллекции
+    она сбрасывается через expire, и условия больше не отсекаются по устаревшим границам.
+    По границам и наборам значений условия отсекаются, только если отметка видит замены документов
+    (счетчик записей в ingest_meta); иначе - лишь условия, невозможные по типу колонки.
+    """
+
+    def __init__(self, types=None, overrides=None):
+        self.types = dict(types or {})
+        self.overrides = dict(overrides or {})
+        self.stats = {}
+        self.stats_version = None
+        self.bounds_trusted = False
+
+    @classmethod
+    def from_numeric_fields(cls, numeric_fields, overrides=None):
+        """Реестр из списка числовых колонок (прежний NUMERIC_FIELDS); остальные считаются строковыми"""
+        return cls({col: NUMBER for col in numeric_fields}, overrides)
+
+    def kind(self, col):
+        return self.overrides.get(col) or self.types.get(col, STRING)
+
+    def is_numeric(self, col):
+        """Сравнения с числом и regex через $toString: числовые и смешанные колонки"""
+        return self.kind(col) in (NUMBER, MIXED)
+
+    def set_types(self, types):
+        self.types = dict(types)
+
+    def set_stats(self, stats, version=None):
+        """stats: колонка -> {"min", "max", "distinct", "values" (множество или None)}"""
+        self.stats = dict(stats)
+        self.stats_version = version
+        self.bounds_trusted = tracks_writes(version)
+
+    def expire(self, version):
+        """Сбрасывает статистику, если коллекция изменилась с момента ее расчета"""
+        if self.stats and version != self.stats_version:
+            self.stats = {}
+
+    def learn_column_types(self, column_types):
+        """Типы из метаданных проверенного импорта (validation.COLUMN_TYPES): там типы гарантированы"""
+        self.set_types({col: NUMBER for col in column_types})
+
+    def learn_ranges(self, result, columns, version=None):
+        """Границы числовых колонок из результата build_range_pipeline"""
+        result = result or {}
+        stats = {}
+        for i, col in enumerate(columns):
+            low, high = result.get(f"min{i}"), result.get(f"max{i}")
+            if is_number(low) and is_number(high) and low == low:
+                stats[col] = {"min": low, "max": high, "distinct": None, "values": None}
+        self.set_stats(stats, version)
+
+    def learn_snapshot(self, snapshot, version=None):
+        """Типы и статистика по колоночному снимку: числовые массивы читаются через mmap"""
+        types, stats = {}, {}
+        for col in snapshot.columns:
+            types[col] = type_from_dtype(snapshot.meta['column_types'].get(col, "object"))
+            # Уникальные значения в снимке хранятся строками, поэтому для чисел - только границы
+            distinct = snapshot.meta['unique_values'].get(col)
+            if types[col] == NUMBER:
+                array = snapshot.arrays[col]
+                array = array[array == array]  # Без NaN
+                if array.size:
+                    stats[col] = {"min": array.min().item(), "max": array.max().item(),
+                                  "distinct": len(distinct) if distinct is not None else None, "values": None}
+            elif types[col] == STRING and distinct is not None:
+                stats[col] = self._stats(STRING, distinct)
+        self.set_types(types)
+        self.set_stats(stats, version)
+
+    @staticmethod
+    def _stats(kind, distinct):
+        """distinct - различные непустые значения колонки"""
+        return {"min": min(distinct) if kind == NUMBER and distinct else None,
+                "max": max(distinct) if kind == NUMBER and distinct else None,
+                "distinct": len(distinct),
+                "values": set(distinct) if len(distinct) <= MAX_TRACKED_VALUES else None}
+
+    # --- Отсечение заведомо ложных условий ---
+
+    def _column_stats(self, col):
+        if col in self.overrides and self.overrides[col] != self.types.get(col):
+            return None  # Ручной тип не совпадает с данными - статистике не доверяем
+        return self.stats.get(col)
+
+    def impossible_comparison(self, col, mongo_operator, value):
+        """True, если условие {col: {mongo_operator: value}} не выполняется ни для одного документа"""
+        stats = self._column_stats(col)
+        if stats is None:
+            return False
+        kind = self.kind(col)
+
+        if kind == NUMBER:
+            if not is_number(value):
+                # В числовой колонке строка не равна ни одному значению
+                return mongo_operator == "$eq"
+            low, high = stats["min"], stats["max"]
+            if low is None or not self.bounds_trusted:
+                return False
+            if mongo_operator == "$eq":
+                values = stats["values"]
+                return value < low or value > high or (values is not None and value not in values)
+            return ((mongo_operator == "$gt" and value >= high) or (mongo_operator == "$gte" and value > high)
+                    or (mongo_operator == "$lt" and value <= low) or (mongo_operator == "$lte" and value < low))
+
+        if kind == STRING and mongo_operator == "$eq":
+            if is_number(value):
+                return True
+            values = stats["values"]
+            return self.bounds_trusted and values is not None and value not in values
+        return False
+
+    def impossible_membership(self, col, values):
+        """True, если ни одно значение списка не встречается в колонке"""
+        return all(self.impossible_comparison(col, "$eq", value) for value in values)
+
+
+def build_range_pipeline(columns):
+    """Один проход на сервере: минимум и максимум каждой из колонок"""
+    group_stage = {"_id": None}
+    for i, col in enumerate(columns):
+        group_stage[f"min{i}"] = {"$min": f"${col}"}
+        group_stage[f"max{i}"] = {"$max": f"${col}"}
+    return [{"$group": group_stage}]
@@ -0,0 +1,130 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from collection_meta import INGEST_META_COLLECTION
+
+
+NULL_VALUES = ["", "None", "none", "null", "NULL", "nan", "NaN"]
+# Типы колонок выгрузки nissan-dataset.csv; остальные колонки остаются строками
+COLUMN_TYPES = {"id": "int", "age": "int", "performance": "int", "km": "int", "price": "float"}
+# Допустимые диапазоны (включительно); значения вне диапазона - причина отклонить строку
+RANGES = {"age": (14, 120), "performance": (0, 2000), "km": (0, 5_000_000), "price": (0, 10_000_000)}
+# Словари категорий: canonical - допустимые написания, aliases - опечатки и синонимы,
+# closed - неизвестное значение отклоняет строку (иначе сохраняется как есть, без лишних пробелов)
+VOCABULARIES = {
+    "condition": {
+        "canonical": ["new", "very good", "good", "old", "bad", "very bad"],
+        "aliases": {"excellent": "very good", "like new": "new", "average": "good", "used": "old",
+                    "poor": "bad", "very poor": "very bad"},
+        "closed": True,
+    },
+    "color": {
+        "canonical": ["Green", "Red", "Purple", "Yellow", "Blue", "Silver", "Black", "Orange", "White", "Gray",
+                      "Khaki", "Aquamarine", "Puce", "Teal", "Crimson", "Goldenrod", "Turquoise", "Fuchsia",
+                      "Maroon", "Violet", "Indigo", "Mauve", "Pink"],
+        "aliases": {"mauv": "Mauve", "fuscia": "Fuchsia", "grey": "Gray"},
+        "closed": False,
+    },
+    "gender": {
+        "canonical": ["Male", "Female", "Genderfluid", "Polygender", "Non-binary", "Genderqueer", "Agender",
+                      "Bigender"],
+        "aliases": {"m": "Male", "f": "Female", "nonbinary": "Non-binary"},
+        "closed": False,
+    },
+}
+
+_SEPARATORS = re.compile(r"[\s_-]+")
+
+
+def vocabulary_key(value):
+    """Ключ поиска в словаре: регистр, пробелы, дефисы и подчеркивания не различаются"""
+    return _SEPARATORS.sub(" ", value.strip().lower())
+
+
+def vocabulary_lookup(col):
+    vocabulary = VOCABULARIES[col]
+    lookup = {vocabulary_key(value): value for value in vocabulary["canonical"]}
+    lookup.update({vocabulary_key(alias): value for alias, value in vocabulary["aliases"].items()})
+    return lookup
+
+
+def canonical_value(col, value):
+    """Каноническое написание значения категории (для условий фильтра); неизвестное - без изменений"""
+    if col not in VOCABULARIES or not isinstance(value, str):
+        return value
+    return vocabulary_lookup(col).get(vocabulary_key(value), value)
+
+
+def validate_frame(raw):
+    """Проверяет и типизирует пачку строк выгрузки (DataFrame из строк) целиком по колонкам.
+
+    Возвращает (типизированный DataFrame прошедших строк, DataFrame отклоненных строк
+    в исходном виде с колонкой reason).
+    """
+    reasons = pd.Series("", index=raw.index, dtype=object)
+
+    def reject(mask, text):
+        if mask.any():
+            reasons[mask] = reasons[mask] + text + "; "
+
+    empty = raw.isin(NULL_VALUES) | raw.isna()
+    clean = {}
+
+    for col in raw.columns:
+        kind = COLUMN_TYPES.get(col)
+        values = raw[col].where(~empty[col])
+
+        if kind is not None:
+            numbers = pd.to_numeric(values.str.strip(), errors="coerce")
+            reject(numbers.isna() & ~empty[col], f"{col}: не число")
+            if col in RANGES:
+                low, high = RANGES[col]
+                reject((numbers < low) | (numbers > high), f"{col}: вне диапазона [{low}, {high}]")
+            if kind == "int":
+                fractional = numbers.notna() & (numbers != np.floor(numbers))
+                reject(fractional, f"{col}: не целое")
+                numbers = numbers.where(~fractional).round().astype("Int64")
+            clean[col] = numbers
+        elif col in VOCABULARIES:
+            stripped = values.str.strip()
+            keys = stripped.str.lower().str.replace(_SEPARATORS, " ", regex=True)
+            canonical = keys.map(vocabulary_lookup(col))
+            if VOCABULARIES[col]["closed"]:
+                reject(canonical.isna() & ~empty[col], f"{col}: неизвестное значение")
+            clean[col] = canonical.where(canonical.notna(), stripped)
+        else:
+            clean[col] = values.str.strip()
+
+    if "id" in raw.columns:
+        reject(empty["id"], "id: пустой")
+
+    accepted = reasons == ""
+    rejected = raw[~accepted].copy()
+    rejected["reason"] = reasons[~accepted].str.rstrip("; ")
+    return pd.DataFrame(clean)[accepted], rejected
+
+
+def frame_documents(frame):
+    """Документы для вставки: типы Python, пропуски - None (без NaN)"""
+    columns = list(frame.columns)
+    values = [frame[col].astype(object).where(frame[col].notna(), None).tolist() for col in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def mark_validated(collection, validated, rejected=0):
+    """Отмечает, что все документы коллекции прошли проверку при импорте"""
+    from datetime import datetime
+
+    collection.database[INGEST_META_COLLECTION].update_one(
+        {"_id": collection.name},
+        {"$set": {"validated": validated, "rejected": rejected, "column_types": COLUMN_TYPES,
+                  "updated_at": datetime.now()}},
+        upsert=True)
+
+
+def is_validated(collection):
+    """True, если коллекция загружена через проверку: пропуски - только null, числа типизированы"""
+    meta = collection.database[INGEST_META_COLLECTION].find_one({"_id": collection.name})
+    return bool(meta and meta.get("validated"))